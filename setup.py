@@ -91,9 +91,12 @@ setup(
     entry_points={
         'console_scripts': [
             'maas-image-builder = mib.core:execute',
+            'maas-image-store = mib.core:execute_store',
         ],
         'mib.builder': [
             'centos = mib.builders.centos:CentOSBuilder',
+            'centos-chroot = mib.builders.centos_chroot:CentOSChrootBuilder',
+            'customize = mib.builders.customize:CustomizeBuilder',
             'rhel = mib.builders.rhel:RHELBuilder',
             'windows = mib.builders.windows:WindowsOSBuilder',
         ],
@@ -101,7 +104,7 @@ setup(
 
     data_files=[
         ('/usr/bin',
-            ['scripts/maas-image-builder']),
+            ['scripts/maas-image-builder', 'scripts/maas-image-store']),
         ('/usr/lib/maas-image-builder/contrib/centos/centos6',
             [f for f in glob('contrib/centos/centos6/*') if isfile(f)]),
         ('/usr/lib/maas-image-builder/contrib/centos/centos6/curtin',
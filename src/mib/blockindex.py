@@ -0,0 +1,299 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Block index sidecars for delta downloads of the built images.
+
+In the manner of zsync, the index lists a weak rolling checksum and a
+strong checksum of every fixed size block of an image. A mirror holding
+the previous version of the image rolls the weak checksum over it,
+confirms candidate blocks with the strong checksum, and only downloads
+the blocks it does not find, with HTTP range requests. The image must
+be compressed with `gzip --rsyncable` for unchanged content to keep
+producing the same blocks.
+
+The sidecar has a text header, one "Key: value" per line, ended by an
+empty line, then for each block its big endian adler32 followed by its
+md5. The last block is padded with zeros.
+
+`patch` is the mirror side: it rebuilds the new image from the blocks
+of the previous version it finds, fetching the others with
+`http_range_reader`.
+"""
+
+import hashlib
+import http.client
+import mmap
+import os
+import struct
+import zlib
+from urllib.parse import urlsplit
+
+VERSION = '1'
+EXTENSION = '.blockindex'
+READ_SIZE = 1024 * 1024
+STRONG_SIZE = 16
+RECORD = struct.Struct('>L%ds' % STRONG_SIZE)
+ADLER_MODULUS = 65521
+
+
+class BlockIndexError(Exception):
+    """Error class for invalid block indexes."""
+
+
+def get_block_size(size):
+    """Returns the block size for an image of `size` bytes, the one
+    zsync picks."""
+    return 2048 if size < 100 * 1024 * 1024 else 4096
+
+
+def iter_blocks(data, block_size):
+    """Yields the blocks of `data`, the last padded with zeros."""
+    view = memoryview(data)
+    for offset in range(0, len(data), block_size):
+        block = view[offset:offset + block_size]
+        if len(block) < block_size:
+            block = bytes(block) + b'\0' * (block_size - len(block))
+        yield block
+
+
+def get_strong(block):
+    """Returns the strong checksum of `block`."""
+    return hashlib.md5(block).digest()
+
+
+def write_index(path, index_path=None, block_size=None):
+    """Writes the block index of the image at `path`, by default next to
+    it, and returns the path of the index."""
+    if index_path is None:
+        index_path = path + EXTENSION
+    size = os.path.getsize(path)
+    if block_size is None:
+        block_size = get_block_size(size)
+    digest = hashlib.sha256()
+    records = bytearray()
+    read_size = READ_SIZE - READ_SIZE % block_size
+    with open(path, 'rb') as stream:
+        for data in iter(lambda: stream.read(read_size), b''):
+            digest.update(data)
+            for block in iter_blocks(data, block_size):
+                records += RECORD.pack(zlib.adler32(block), get_strong(block))
+    header = [
+        ('mib-blockindex', VERSION),
+        ('Filename', os.path.basename(path)),
+        ('Length', size),
+        ('Blocksize', block_size),
+        ('Weak', 'adler32'),
+        ('Strong', 'md5'),
+        ('SHA-256', digest.hexdigest()),
+        ]
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as stream:
+        for key, value in header:
+            stream.write(('%s: %s\n' % (key, value)).encode('utf-8'))
+        stream.write(b'\n')
+        stream.write(records)
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+def read_header(index_path):
+    """Returns the header of the block index at `index_path`, as a dict,
+    without reading its block checksums."""
+    header = {}
+    with open(index_path, 'rb') as stream:
+        for line in stream:
+            line = line.decode('utf-8').rstrip('\n')
+            if not line:
+                break
+            key, _, value = line.partition(': ')
+            header[key] = value
+    if header.get('mib-blockindex') != VERSION:
+        raise BlockIndexError("%s is not a block index." % index_path)
+    return header
+
+
+def read_index(index_path):
+    """Returns the header of the block index at `index_path`, as a dict,
+    and the list of its (adler32, md5) block checksums."""
+    with open(index_path, 'rb') as stream:
+        data = stream.read()
+    head, sep, records = data.partition(b'\n\n')
+    if not sep or not head.startswith(b'mib-blockindex: '):
+        raise BlockIndexError("%s is not a block index." % index_path)
+    header = dict(
+        line.split(': ', 1) for line in head.decode('utf-8').splitlines())
+    if header['mib-blockindex'] != VERSION:
+        raise BlockIndexError(
+            "Unsupported block index version %s." % header['mib-blockindex'])
+    if len(records) % RECORD.size:
+        raise BlockIndexError("%s is truncated." % index_path)
+    return header, [
+        RECORD.unpack_from(records, offset)
+        for offset in range(0, len(records), RECORD.size)]
+
+
+def roll_adler32(checksum, removed, added, block_size):
+    """Returns the adler32 of the block one byte further, from the
+    `checksum` of the block, the byte `removed` from its start and the
+    byte `added` at its end."""
+    low = (checksum & 0xffff) - removed + added
+    low %= ADLER_MODULUS
+    high = (checksum >> 16) - block_size * removed + low - 1
+    high %= ADLER_MODULUS
+    return (high << 16) | low
+
+
+def get_weak_table(checksums):
+    """Returns the numbers of the blocks in `checksums` by their weak
+    checksum."""
+    weak = {}
+    for number, (adler, _) in enumerate(checksums):
+        weak.setdefault(adler, []).append(number)
+    return weak
+
+
+def find_blocks(header, checksums, old_path):
+    """Returns the offset in the file at `old_path` of each block of the
+    index found in it, by block number.
+
+    The weak checksum is rolled a byte at a time where the file does not
+    match, and computed a block at a time where it does.
+    """
+    block_size = int(header['Blocksize'])
+    weak = get_weak_table(checksums)
+    found = {}
+    if os.path.getsize(old_path) < block_size:
+        return found
+    with open(old_path, 'rb') as stream, mmap.mmap(
+            stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        size = len(data)
+        offset = 0
+        checksum = None
+        while offset + block_size <= size:
+            if checksum is None:
+                checksum = zlib.adler32(data[offset:offset + block_size])
+            numbers = weak.get(checksum)
+            if numbers:
+                strong = get_strong(data[offset:offset + block_size])
+                matched = [
+                    number for number in numbers
+                    if checksums[number][1] == strong]
+                if matched:
+                    for number in matched:
+                        found.setdefault(number, offset)
+                    offset += block_size
+                    checksum = None
+                    continue
+            if offset + block_size < size:
+                checksum = roll_adler32(
+                    checksum, data[offset], data[offset + block_size],
+                    block_size)
+            offset += 1
+    return found
+
+
+def http_range_reader(url):
+    """Returns a `read_range(offset, length)` function for `patch`,
+    reading the bytes of the file at `url` with HTTP range requests."""
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPConnection
+    if parts.scheme == 'https':
+        connection_class = http.client.HTTPSConnection
+    path = parts.path + ('?' + parts.query if parts.query else '')
+
+    def read_range(offset, length):
+        connection = connection_class(parts.netloc)
+        try:
+            connection.request('GET', path, headers={
+                'Range': 'bytes=%d-%d' % (offset, offset + length - 1)})
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status != 206 or len(data) != length:
+            raise BlockIndexError(
+                "Range request to %s failed: %d %s" % (
+                    url, response.status, response.reason))
+        return data
+
+    return read_range
+
+
+def patch(index_path, old_path, read_range, stream):
+    """Writes the image of the block index at `index_path` to the file
+    object `stream`, from the blocks found in the previous version at
+    `old_path` and those read with `read_range(offset, length)`.
+
+    Returns the number of bytes read with `read_range`.
+
+    :raises BlockIndexError: when the image written does not match the
+        index
+    """
+    header, checksums = read_index(index_path)
+    length = int(header['Length'])
+    block_size = int(header['Blocksize'])
+    found = find_blocks(header, checksums, old_path)
+    digest = hashlib.sha256()
+    fetched = 0
+    with open(old_path, 'rb') as old:
+        number = 0
+        while number < len(checksums):
+            if number in found:
+                old.seek(found[number])
+                data = old.read(min(block_size, length - number * block_size))
+                number += 1
+            else:
+                # The run of missing blocks is read in one request.
+                end = number + 1
+                while end < len(checksums) and end not in found:
+                    end += 1
+                data = read_range(
+                    number * block_size,
+                    min(end * block_size, length) - number * block_size)
+                fetched += len(data)
+                number = end
+            digest.update(data)
+            stream.write(data)
+    if digest.hexdigest() != header['SHA-256']:
+        raise BlockIndexError(
+            "Image rebuilt from %s does not match it." % index_path)
+    return fetched
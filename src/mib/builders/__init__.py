@@ -47,20 +47,46 @@ from abc import (
     abstractmethod,
     abstractproperty,
     )
+import asyncio
+import logging
 import os
 import shutil
+import time
 
 from mib import (
+    blockindex,
+    cache,
+    chunkstore,
+    compact,
+    console,
+    customize,
+    ext4,
+    hardware,
+    manifest,
+    objectstore,
+    outputs,
+    placement,
+    resize,
+    scratch,
+    simplestreams,
+    upload,
     utils,
     virt,
     )
+from mib.driver import (
+    VMDriver,
+    VMError,
+    )
+from mib.watchdog import Watchdog
+
+logger = logging.getLogger(__name__)
 
 
 class BuildError(Exception):
     """Error class for any build error."""
 
 
-class Builder:
+class Builder:  # pylint: disable=too-many-public-methods
     """Base class for all builders."""
 
     __metaclass__ = ABCMeta
@@ -74,8 +100,42 @@ class Builder:
         """List of support architectures."""
 
     @abstractmethod
+    async def build_image_async(self, params):
+        """Builds the image with the given parameters.
+
+        Builders keep per-build state on the instance, so concurrent
+        builds in one event loop must each use their own builder.
+        """
+
+    @property
+    def output_formats(self):
+        """Output formats the builder supports, the first is the
+        default."""
+        return ['root-tgz', 'squashfs']
+
+    def get_output_formats(self, params):
+        """Returns the output formats requested for the build."""
+        formats = []
+        for names in params.output_format:
+            formats.extend(name for name in names if name not in formats)
+        if not formats:
+            return self.output_formats[:1]
+        for name in formats:
+            if name not in self.output_formats:
+                raise BuildError(
+                    "The %s builder cannot output %s, supported formats "
+                    "are: %s." % (
+                        self.name, name, ', '.join(self.output_formats)))
+        for name, _ in params.upload:
+            if name not in formats:
+                raise BuildError(
+                    "Cannot upload %s, it is not an output format of the "
+                    "build." % name)
+        return formats
+
     def build_image(self, params):
-        """Builds the image with the given parameters."""
+        """Builds the image, blocking until it has finished."""
+        return utils.run_async(self.build_image_async(params))
 
     def populate_parser(self, parser):
         """Add parser options for this builder."""
@@ -85,6 +145,296 @@ class Builder:
         builder."""
         return utils.get_contrib_path(self.name, path)
 
+    def scratch_size(  # pylint: disable=no-self-use,unused-argument
+            self, params):
+        """Returns the estimated peak usage of the work space, in bytes."""
+        return 0
+
+    def workdir(self, params):
+        """Context manager: work space for the build, named after its
+        build id, on one of the scratch locations."""
+        return scratch.allocate(
+            params.build_id, self.scratch_size(params),
+            locations=params.workdir, ram=params.ram)
+
+    def squashfs_args(self, params, place):  # pylint: disable=no-self-use
+        """Returns the squashfs compression arguments of the build, its
+        threads matching the cores the build is placed on."""
+        return outputs.get_squashfs_args(
+            params.squashfs_compression, processors=len(place.cpus),
+            epoch=self.epoch(params))
+
+    def epoch(self, params):  # pylint: disable=no-self-use
+        """Returns the time deterministic outputs are dated, or None when
+        the build is not deterministic."""
+        if not params.deterministic:
+            return None
+        return params.source_date_epoch
+
+    def rsyncable(self, params):  # pylint: disable=no-self-use
+        """Returns True when gzip compressed formats are made rsyncable,
+        for versions of the image to share their chunks and blocks."""
+        return params.chunk_store is not None or params.block_index
+
+    def get_output_readers(  # pylint: disable=no-self-use
+            self, work_paths, params):
+        """Returns the name, `upload.FileFollower` and reading coroutine
+        of each output in `work_paths` that is uploaded or hashed."""
+        rate = None
+        if params.upload_rate:
+            rate = params.upload_rate * upload.MEBIBYTE
+        uploads = dict(params.upload)
+        readers = []
+        for name, path in work_paths.items():
+            if name not in uploads and params.simplestreams is None:
+                continue
+            follower = upload.FileFollower(
+                path, growing=name in outputs.SEQUENTIAL_FORMATS)
+            if name in uploads:
+                uploader = upload.Uploader(
+                    uploads[name], api_key=params.upload_api_key, rate=rate)
+                reader = utils.to_thread(uploader.upload, follower)
+            else:
+                reader = utils.to_thread(upload.checksum, follower)
+            readers.append((name, follower, reader))
+        return readers
+
+    async def upload_outputs(self, packaging, work_paths, params):
+        """Runs the coroutine `packaging`, which writes the outputs in
+        `work_paths`, while uploading those given with --upload.
+
+        The outputs are hashed as they are written, the uploaded ones by
+        their upload and the others when the simplestreams entries need
+        them. Returns the size and sha256 of each hashed output.
+        """
+        uploads = dict(params.upload)
+        readers = self.get_output_readers(work_paths, params)
+        if not readers:
+            await packaging
+            return {}
+
+        task = asyncio.ensure_future(utils.gather(*[
+            reader for _, _, reader in readers]))
+        try:
+            await packaging
+        except BaseException:
+            for _, follower, _ in readers:
+                follower.abort()
+            await asyncio.wait([task])
+            if not task.cancelled():
+                task.exception()
+            raise
+        for _, follower, _ in readers:
+            follower.finish()
+        try:
+            results = await task
+        except upload.UploadError as error:
+            raise BuildError(str(error))
+        checksums = {}
+        for (name, _, _), (size, sha256) in zip(readers, results):
+            checksums[name] = (size, sha256)
+            if name in uploads:
+                logger.info(
+                    'Uploaded %s to %s: %d bytes, sha256 %s.',
+                    name, uploads[name], size, sha256)
+        return checksums
+
+    def manifest_path(self, workdir, params):  # pylint: disable=no-self-use
+        """Returns the path the manifest of the image is written to in
+        the work directory, or None when it is not wanted."""
+        if not params.manifest:
+            return None
+        return os.path.join(workdir, 'output' + manifest.EXTENSION)
+
+    async def publish(self, work_paths, formats, params, manifest_path=None,
+                      checksums=None):
+        """Moves each format written in the work directory to its output
+        path, writes its block index, flushes them unless the durability
+        is 'none', and adds it to the chunk store and to the simplestreams
+        tree. The manifest at `manifest_path` is placed next to the
+        outputs, `checksums` are those returned by `upload_outputs`."""
+        output_paths = outputs.get_output_paths(params.output, formats)
+        await utils.to_thread(
+            outputs.move_outputs, work_paths, output_paths)
+        if manifest_path is not None:
+            await utils.to_thread(
+                shutil.move, manifest_path,
+                params.output + manifest.EXTENSION)
+        version = '%s-%s' % (
+            time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()), params.build_id)
+        # The outputs are hashed as they are written, and by each pass
+        # over them, the simplestreams entries reuse those checksums.
+        checksums = dict(checksums or {})
+        if params.block_index:
+            index_paths = await utils.gather(*[
+                utils.to_thread(blockindex.write_index, output_paths[name])
+                for name in formats])
+            for name, index_path in zip(formats, index_paths):
+                header = blockindex.read_header(index_path)
+                checksums[name] = (int(header['Length']), header['SHA-256'])
+        if params.durability != 'none':
+            published = list(output_paths.values())
+            if manifest_path is not None:
+                published.append(params.output + manifest.EXTENSION)
+            if params.block_index:
+                published.extend(index_paths)
+            await self.sync_outputs(published)
+        if params.chunk_store is not None:
+            for name in formats:
+                await utils.to_thread(
+                    chunkstore.add, params.chunk_store, output_paths[name],
+                    version=version)
+                index = chunkstore.read_index(
+                    params.chunk_store, os.path.basename(output_paths[name]),
+                    version)
+                checksums[name] = (index['size'], index['sha256'])
+        if params.simplestreams is not None:
+            missing = [name for name in formats if name not in checksums]
+            checksums.update(zip(missing, await utils.gather(*[
+                utils.to_thread(outputs.get_checksum, output_paths[name])
+                for name in missing])))
+            await utils.to_thread(
+                self.add_stream_version, output_paths, checksums, version,
+                params)
+
+    async def sync_outputs(self, paths):  # pylint: disable=no-self-use
+        """Flushes the published files at `paths`, and their directories,
+        to persistent storage."""
+        await utils.gather(*[
+            utils.to_thread(utils.sync_file, path) for path in paths])
+        for directory in sorted(set(map(os.path.dirname, paths))):
+            await utils.to_thread(utils.sync_directory, directory)
+
+    def get_cache(self, name, params):  # pylint: disable=no-self-use
+        """Returns the cache `name` of the builder, or None with
+        --no-cache."""
+        if params.no_cache:
+            return None
+        remote = None
+        if params.cache_remote is not None:
+            remote = objectstore.ObjectStore(
+                params.cache_remote, region=params.cache_remote_region)
+        return cache.get_manager(params, remote=remote).register(name)
+
+    def release(self, params):  # pylint: disable=no-self-use,unused-argument
+        """Returns the release of the built OS, if it has several."""
+        return None
+
+    def add_stream_version(self, output_paths, checksums, version, params):
+        """Adds the outputs, as `version` of the built product, to the
+        simplestreams tree."""
+        attributes = {
+            key: value for key, value in (
+                ('os', self.name),
+                ('release', self.release(params)),
+                ('arch', params.arch),
+                )
+            if value is not None
+            }
+        product_id = simplestreams.get_product_id(
+            params.simplestreams_prefix, self.name,
+            attributes.get('release'), params.arch)
+        items = {
+            name: {
+                'path': os.path.relpath(path, params.simplestreams),
+                'size': checksums[name][0],
+                'sha256': checksums[name][1],
+                }
+            for name, path in output_paths.items()
+            }
+        simplestreams.add_version(
+            params.simplestreams, product_id, version, items, attributes)
+        logger.info(
+            'Published %s version %s to %s.', product_id, version,
+            params.simplestreams)
+
+    def vcpu_count(self, params):  # pylint: disable=no-self-use
+        """Returns the number of vcpus of the build VM."""
+        try:
+            return int(params.vcpus)
+        except ValueError:
+            return 1
+
+    async def customize(  # pylint: disable=no-self-use
+            self, root, params, relabel=True):
+        """Runs the --customize scripts inside the root filesystem at
+        `root`, then labels its files unless `relabel` is False."""
+        if not params.customize:
+            return
+        try:
+            await customize.customize(
+                root, params.customize, runner=params.customize_runner,
+                relabel=relabel)
+        except (utils.ProcessExecutionError,
+                customize.CustomizeError) as error:
+            raise BuildError('Customization failed: %s' % error)
+
+    async def compact(  # pylint: disable=no-self-use
+            self, disk_path, mount_path, params):
+        """Compacts the installed filesystem mounted at `mount_path`,
+        unless disabled."""
+        if params.compact == 'auto':
+            await compact.compact(
+                disk_path, mount_path, durability=params.durability)
+
+    async def shrink(  # pylint: disable=no-self-use
+            self, disk_path, partition, params):
+        """Shrinks the disk image to its minimal size, with --auto-size."""
+        if params.auto_size:
+            await resize.shrink_disk(
+                disk_path, partition,
+                headroom=params.size_headroom * 1024 * 1024)
+
+    def place(self, params):
+        """Context manager: NUMA placement of the build VM and of its
+        post-processing."""
+        # Without nodes to choose from no placement is made.
+        nodes = [] if params.numa_placement == 'off' else None
+        return placement.allocate(
+            params.build_id, self.vcpu_count(params), params.ram,
+            nodes=nodes)
+
+    async def wait_for_install(  # pylint: disable=no-self-use
+            self, driver, domain, console_path, disk_path, params,
+            parser=None):
+        """Waits for the installation VM to power off, following its
+        serial console.
+
+        The console log and the progress events parsed from it are kept
+        next to the output, as '.console.log' and '.progress.json'. A
+        watchdog destroys the VM when the installation stalls.
+        """
+        follower = console.ConsoleFollower(
+            console_path, parser=parser,
+            progress_path='%s.progress.json' % params.output)
+        follower.add_callback(console.log_progress)
+        watchdog = Watchdog(
+            domain, follower, disk_paths=[disk_path],
+            stall_timeout=params.stall_timeout,
+            install_timeout=params.install_timeout,
+            phase_timeouts=params.phase_timeout)
+        tasks = [
+            asyncio.ensure_future(follower.follow()),
+            asyncio.ensure_future(watchdog.watch()),
+            ]
+        try:
+            await driver.wait(domain)
+        except VMError:
+            if watchdog.reason is not None:
+                raise BuildError(
+                    'Installation stalled (%s), console output kept in '
+                    '%s.console.log.' % (watchdog.reason, params.output))
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+            follower.close()
+            console.log_durations(follower.parser)
+            if os.path.exists(console_path):
+                shutil.copyfile(
+                    console_path, '%s.console.log' % params.output)
+
 
 class VirtInstallBuilder(Builder):
     """Builder that uses virt-install."""
@@ -111,82 +461,210 @@ class VirtInstallBuilder(Builder):
         """Return the name of the first part of the generated image."""
         return '%s-%s' % (self.name, params.arch)
 
+    @property
+    def output_formats(self):
+        return [
+            'root-tgz', 'squashfs', 'ddtgz', 'qcow2', 'qcow2-compressed']
+
+    def scratch_size(self, params):
+        # The raw disk, and each output compressed to at most half of it.
+        formats = self.get_output_formats(params)
+        return int(
+            self.disk_size * scratch.GIBIBYTE * (1 + 0.5 * len(formats)))
+
+    def hardware_profile(self, params):
+        """Returns the virtual hardware of the installation VM.
+
+        The kickstarts install to vda, so the disk always uses
+        virtio-blk.
+        """
+        if params.hardware_profile == 'legacy':
+            return hardware.legacy_profile(
+                disk_cache='unsafe' if params.fast_install else None)
+        return hardware.select_profile(
+            self.vcpu_count(params), disk_bus='virtio-blk')
+
     def modify_mount(self, mount_path):
         """Allows modification of the files before the final image
         is generated."""
 
-    def build_image(self, params):
+    def can_read_disk(self, disk_path, params):  # pylint: disable=no-self-use
+        """Returns True when the filesystem formats can be read straight
+        out of the disk image, without mounting it."""
+        return params.packaging == 'auto' and ext4.is_ext4(disk_path)
+
+    async def package(self, workdir, disk_path, paths, params, place,
+                      manifest_path=None):
+        """Writes every output format in `paths` from the installed
+        disk, and its manifest to `manifest_path`."""
+        fs_paths = {
+            name: path for name, path in paths.items()
+            if name in outputs.FILESYSTEM_FORMATS}
+        block_paths = {
+            name: path for name, path in paths.items()
+            if name in outputs.BLOCK_FORMATS}
+        readable = self.can_read_disk(disk_path, params) and (
+            'squashfs' not in fs_paths or outputs.has_sqfstar())
+        if readable and not block_paths and not params.customize:
+            # Nothing modifies the filesystem in place, the files added
+            # by modify_mount are appended to the tar stream.
+            overlay_path = os.path.join(workdir, "overlay")
+            os.mkdir(overlay_path)
+            await utils.to_thread(self.modify_mount, overlay_path)
+            await utils.to_thread(
+                outputs.stream_filesystem_formats, disk_path, fs_paths,
+                extra_path=overlay_path,
+                squashfs_args=self.squashfs_args(params, place),
+                rsyncable=self.rsyncable(params),
+                epoch=self.epoch(params),
+                manifest_path=manifest_path,
+                prefix=place.prefix)
+            return
+
+        # Mount the disk image
+        mount_path = os.path.join(workdir, "mount")
+        os.mkdir(mount_path)
+        try:
+            await utils.to_thread(utils.mount_loop, disk_path, mount_path)
+
+            # Allow the osystem module to install any needed files
+            # into the filesystem
+            await utils.to_thread(self.modify_mount, mount_path)
+
+            # Run the user's customization scripts
+            await self.customize(mount_path, params)
+
+            # Clear the free space left by the installation, which only
+            # the block formats carry
+            if block_paths:
+                await self.compact(disk_path, mount_path, params)
+
+            if not readable:
+                await outputs.write_filesystem_formats(
+                    mount_path, fs_paths,
+                    squashfs_args=self.squashfs_args(params, place),
+                    rsyncable=self.rsyncable(params),
+                    epoch=self.epoch(params),
+                    manifest_path=manifest_path,
+                    prefix=place.prefix)
+        finally:
+            await utils.to_thread(
+                utils.umount_loop, disk_path, mount_path)
+
+        # Shrink the root partition and the disk to the minimum
+        if block_paths:
+            await self.shrink(disk_path, 0, params)
+
+        # Read the final disk once for all the remaining formats
+        tasks = [outputs.write_block_formats(
+            disk_path, block_paths, workdir,
+            rsyncable=self.rsyncable(params), epoch=self.epoch(params),
+            prefix=place.prefix)]
+        if readable and (fs_paths or manifest_path):
+            tasks.append(utils.to_thread(
+                outputs.stream_filesystem_formats, disk_path, fs_paths,
+                squashfs_args=self.squashfs_args(params, place),
+                rsyncable=self.rsyncable(params),
+                epoch=self.epoch(params),
+                manifest_path=manifest_path,
+                prefix=place.prefix))
+        await utils.gather(*tasks)
+
+    async def build_image_async(self, params):
         """Builds the image with virt-install."""
+        with self.workdir(params) as workdir:
+            await self.build_in_workdir(workdir, params)
+
+    def network_arg(self, params):
+        """Returns the virt-install network of the build VM."""
+        network = 'bridge=%s' % params.interface
+        if self.nic_model is not None:
+            network = '%s,model=%s' % (network, self.nic_model)
+        return network
+
+    async def build_in_workdir(self, workdir, params):
+        """Builds the image with virt-install, in the work space
+        `workdir` allocated for the build."""
         # Check for valid location
         if self.install_location is None and self.install_cdrom is None:
             raise BuildError(
                 "Missing install_location or install_cdrom for virt-install.")
 
-        # Naming
-        full_name = self.full_name(params)
+        formats = self.get_output_formats(params)
 
-        # Create work space
-        with utils.tempdir() as workdir:
+        with self.place(params) as place:
             # virt-install fails to access the directory
             # unless the following permissions are used
-            utils.subp(['chmod', '777', workdir])
+            await utils.subp_async(['chmod', '777', workdir])
 
             # Create the disk, and set the permissions
             # that will allow virt-install to access it
             disk_path = os.path.join(workdir, 'disk.img')
-            virt.create_disk(disk_path, self.disk_size, disk_format='raw')
-            utils.subp(['chmod', '777', disk_path])
-            disk_str = "path=%s,format=raw" % disk_path
+            await virt.create_disk(
+                disk_path, self.disk_size, disk_format='raw')
+            await utils.subp_async(['chmod', '777', disk_path])
+            profile = self.hardware_profile(params)
 
             # Start the installation
-            vm_name = 'img-build-%s' % full_name
-            network_str = 'bridge=%s' % params.interface
-            if self.nic_model is not None:
-                network_str = '%s,model=%s' % (
-                    network_str, self.nic_model)
-            if self.install_location:
-                virt.install_location(
-                    vm_name,
-                    params.ram,
-                    params.arch,
-                    params.vcpus,
-                    self.os_type,
-                    self.os_variant,
-                    disk_str,
-                    network_str,
-                    self.install_location,
-                    initrd_inject=self.initrd_inject,
-                    extra_args=self.extra_arguments)
-            else:
-                virt.install_cdrom(
-                    vm_name,
-                    params.ram,
-                    params.arch,
-                    params.vcpus,
-                    self.os_type,
-                    self.os_variant,
-                    disk_str,
-                    network_str,
-                    self.install_cdrom)
-
-            # Remove the finished installation from virsh
-            virt.undefine(vm_name)
-
-            # Mount the disk image
-            mount_path = os.path.join(workdir, "mount")
-            os.mkdir(mount_path)
+            vm_name = 'img-build-%s-%s' % (
+                self.full_name(params), params.build_id)
+            console_path = os.path.join(workdir, 'console.log')
+            driver = VMDriver()
             try:
-                utils.mount_loop(disk_path, mount_path)
+                if self.install_location:
+                    domain = await virt.install_location(
+                        driver,
+                        vm_name,
+                        params.ram,
+                        params.arch,
+                        params.vcpus,
+                        self.os_type,
+                        self.os_variant,
+                        profile.virt_install_disk(disk_path),
+                        self.network_arg(params),
+                        self.install_location,
+                        initrd_inject=self.initrd_inject,
+                        extra_args=self.extra_arguments,
+                        serial=console_path,
+                        cpuset=place.cpulist,
+                        numa_node=place.node,
+                        hardware_args=profile.virt_install_args())
+                else:
+                    domain = await virt.install_cdrom(
+                        driver,
+                        vm_name,
+                        params.ram,
+                        params.arch,
+                        params.vcpus,
+                        self.os_type,
+                        self.os_variant,
+                        profile.virt_install_disk(disk_path),
+                        self.network_arg(params),
+                        self.install_cdrom,
+                        serial=console_path,
+                        cpuset=place.cpulist,
+                        numa_node=place.node,
+                        hardware_args=profile.virt_install_args())
 
-                # Allow the osystem module to install any needed files
-                # into the filesystem
-                self.modify_mount(mount_path)
-
-                # Create the tarball
-                output_path = os.path.join(workdir, "output.tar.gz")
-                utils.create_tarball(output_path, mount_path)
+                # Wait for the installation to power off the domain
+                await self.wait_for_install(
+                    driver, domain, console_path, disk_path, params)
             finally:
-                utils.umount_loop(disk_path, mount_path)
+                await driver.close()
+
+                # Remove the installation from virsh, also when it failed
+                # or was destroyed, the domain may never have been defined
+                await virt.undefine(vm_name, rcs=[0, 1])
+
+            await hardware.flush_install_disk(
+                profile, disk_path, params.durability)
+            work_paths = outputs.get_work_paths(workdir, formats)
+            manifest_path = self.manifest_path(workdir, params)
+            checksums = await self.upload_outputs(self.package(
+                workdir, disk_path, work_paths, params, place,
+                manifest_path=manifest_path), work_paths, params)
 
             # Place in output
-            shutil.move(output_path, params.output)
+            await self.publish(
+                work_paths, formats, params, manifest_path=manifest_path,
+                checksums=checksums)
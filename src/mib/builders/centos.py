@@ -46,6 +46,7 @@ import os
 import shutil
 import tempfile
 
+from mib import kickstart
 from mib.builders import BuildError, VirtInstallBuilder
 
 
@@ -69,6 +70,9 @@ class CentOSBuilder(VirtInstallBuilder):
     def full_name(self, params):
         return 'centos%s-%s' % (params.edition, params.arch)
 
+    def release(self, params):  # pylint: disable=no-self-use
+        return params.edition
+
     def populate_parser(self, parser):  # pylint: disable=no-self-use
         """Add parser options."""
         parser.add_argument(
@@ -93,6 +97,11 @@ class CentOSBuilder(VirtInstallBuilder):
                 "Custom kickstart file '%s' does not exist!" %
                 params.custom_kickstart)
 
+    def base_kickstart(self, params):
+        """Returns the path to the kickstart for the edition and arch."""
+        return self.get_contrib_path('centos%s/centos%s-%s.ks' % (
+            params.edition, params.edition, params.arch))
+
     def modify_mount(self, mount_path):
         """Install the curtin directory into mount point."""
         path = None
@@ -105,7 +114,7 @@ class CentOSBuilder(VirtInstallBuilder):
         opt_path = os.path.join(mount_path, 'curtin')
         shutil.copytree(path, opt_path)
 
-    def build_image(self, params):
+    async def build_image_async(self, params):
         self.validate_params(params)
         # pylint: disable=attribute-defined-outside-init
         self.edition = params.edition
@@ -114,43 +123,42 @@ class CentOSBuilder(VirtInstallBuilder):
             if params.arch == 'i386':
                 self.install_location = (
                     "http://mirror.centos.org/centos/6/os/i386")
-                base_kickstart_file = self.get_contrib_path(
-                    "centos6/centos6-i386.ks")
             elif params.arch == 'amd64':
                 self.install_location = (
                     "http://mirror.centos.org/centos/6/os/x86_64")
-                base_kickstart_file = self.get_contrib_path(
-                    "centos6/centos6-amd64.ks")
             extra_arguments_template = "console=ttyS0 ks=file:/%s text utf8"
         elif self.edition == '7':
             self.install_location = (
                 "http://mirror.centos.org/centos/7/os/x86_64")
-            base_kickstart_file = self.get_contrib_path(
-                "centos7/centos7-amd64.ks")
             extra_arguments_template = (
                 "console=ttyS0 inst.ks=file:/%s text "
                 "inst.cmdline inst.headless")
+        base_kickstart_file = self.base_kickstart(params)
 
-        if params.custom_kickstart is None:
+        compose = params.custom_kickstart is not None or params.fast_install
+        if not compose:
             self.extra_arguments = extra_arguments_template % os.path.basename(
                 base_kickstart_file)
             self.initrd_inject = base_kickstart_file
         else:
             # If a custom kickstart file was given create a new file which
             # concatenates the custom kickstart file to the end of ours.
-            tmp_file_path = tempfile.mktemp(prefix='maas-image-builder-')
-            with open(tmp_file_path, 'w') as tmp_file:
-                for ks_file_path in (
-                        base_kickstart_file, params.custom_kickstart):
-                    tmp_file.write('#\n# From %s\n#\n\n' % ks_file_path)
-                    with open(ks_file_path, 'r') as ks_file:
-                        for line in ks_file:
-                            tmp_file.write(line)
+            ks_file_paths = [base_kickstart_file]
+            if params.custom_kickstart is not None:
+                ks_file_paths.append(params.custom_kickstart)
+            tmp_file_path = tempfile.mktemp(
+                prefix='maas-image-builder-%s-' % params.build_id)
+            # The CentOS 6 installer has no --mkfsoptions.
+            kickstart.compose_kickstart(
+                tmp_file_path, ks_file_paths,
+                fast_install=params.fast_install,
+                mkfs_options=self.edition != '6')
             self.extra_arguments = extra_arguments_template % os.path.basename(
                 tmp_file_path)
             self.initrd_inject = tmp_file_path
 
-        super(CentOSBuilder, self).build_image(params)
-
-        if params.custom_kickstart is not None:
-            os.remove(self.initrd_inject)
+        try:
+            await super(CentOSBuilder, self).build_image_async(params)
+        finally:
+            if compose:
+                os.remove(self.initrd_inject)
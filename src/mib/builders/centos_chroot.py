@@ -0,0 +1,432 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Builder for CentOS root tarballs, without an installation VM."""
+
+import hashlib
+import logging
+import os
+import shutil
+
+from mib import chroot, customize, kickstart, outputs, utils
+from mib.builders import BuildError
+from mib.builders.centos import CentOSBuilder
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIRROR = 'http://mirror.centos.org/centos'
+
+# Commands that configure the installation VM, its disk or its
+# bootloader, which curtin sets up at deployment.
+IGNORED_COMMANDS = {
+    'bootloader', 'clearpart', 'cmdline', 'firstboot', 'ignoredisk',
+    'install', 'logging', 'part', 'poweroff', 'reboot', 'text', 'url',
+    'zerombr',
+    }
+
+# Files the installer leaves in the image, configuring the bootloader
+# curtin installs.
+DEFAULT_GRUB = (
+    'GRUB_TIMEOUT=%(timeout)s\n'
+    'GRUB_DISTRIBUTOR="$(sed \'s, release .*$,,g\' /etc/system-release)"\n'
+    'GRUB_DEFAULT=saved\n'
+    'GRUB_DISABLE_SUBMENU=true\n'
+    'GRUB_TERMINAL_OUTPUT="console"\n'
+    'GRUB_CMDLINE_LINUX="%(append)s"\n'
+    'GRUB_DISABLE_RECOVERY="true"\n')
+
+
+def repo_definition(name, value):
+    """Validates a NAME=BASEURL repository."""
+    repo_name, _, baseurl = value.partition('=')
+    if not repo_name or not baseurl:
+        raise BuildError(
+            "Invalid %s '%s', expected NAME=BASEURL." % (name, value))
+    return repo_name, baseurl
+
+
+class CentOSChrootBuilder(CentOSBuilder):
+    """Builds the CentOS root tarball in a chroot on the host. Packages
+    are installed with yum --installroot, then the kickstart's
+    configuration and %post scripts are applied in the chroot."""
+
+    name = "centos-chroot"
+
+    def get_contrib_path(self, path):
+        # Shares the kickstarts and curtin hooks of the centos builder.
+        return utils.get_contrib_path(CentOSBuilder.name, path)
+
+    @property
+    def output_formats(self):
+        # There is no disk image to write the block formats from.
+        return list(outputs.FILESYSTEM_FORMATS)
+
+    def populate_parser(self, parser):
+        super(CentOSChrootBuilder, self).populate_parser(parser)
+        parser.add_argument(
+            '--mirror', default=DEFAULT_MIRROR,
+            help=(
+                "CentOS mirror replacing %s in the kickstart "
+                "repositories." % DEFAULT_MIRROR))
+        parser.add_argument(
+            '--repo', action='append', default=[], metavar='NAME=BASEURL',
+            help=(
+                "Additional repository to install from, such as a local "
+                "one. Replaces the kickstart repository of the same name."))
+
+    def validate_params(self, params):
+        super(CentOSChrootBuilder, self).validate_params(params)
+        for value in params.repo:
+            repo_definition('--repo', value)
+        if shutil.which('yum') is None and shutil.which('dnf') is None:
+            raise BuildError(
+                "centos-chroot requires yum or dnf to be installed.")
+
+    def get_repos(self, config, params):  # pylint: disable=no-self-use
+        """Returns the repositories to install from, as a list of
+        (name, source, includepkgs), where source is the yum option
+        locating the repository, baseurl or mirrorlist, and its value."""
+        repos = []
+        for args in config.get_commands('repo'):
+            baseurl = kickstart.get_option(args, '--baseurl')
+            mirrorlist = kickstart.get_option(args, '--mirrorlist')
+            if baseurl is not None:
+                if baseurl.startswith(DEFAULT_MIRROR):
+                    baseurl = params.mirror + baseurl[len(DEFAULT_MIRROR):]
+                source = ('baseurl', baseurl)
+            elif mirrorlist is not None:
+                source = ('mirrorlist', mirrorlist)
+            else:
+                raise BuildError(
+                    "Kickstart repo %s has neither --baseurl nor "
+                    "--mirrorlist." % kickstart.get_option(args, '--name'))
+            repos.append((
+                kickstart.get_option(args, '--name'), source,
+                kickstart.get_option(args, '--includepkgs')))
+        for value in params.repo:
+            name, baseurl = repo_definition('--repo', value)
+            repos = [repo for repo in repos if repo[0] != name]
+            repos.append((name, ('baseurl', baseurl), None))
+        return repos
+
+    def write_yum_conf(  # pylint: disable=no-self-use
+            self, workdir, repos, cachedir=None):
+        """Writes the yum configuration for the installation, using only
+        `repos`. The packages are kept in `cachedir` when given."""
+        path = os.path.join(workdir, 'yum.conf')
+        with open(path, 'w') as stream:
+            stream.write(
+                '[main]\n'
+                'cachedir=%s\n'
+                'reposdir=/nonexistent\n'
+                'keepcache=%d\n'
+                'plugins=0\n'
+                # The installer does not check signatures either.
+                'gpgcheck=0\n' % (
+                    cachedir or os.path.join(workdir, 'yum-cache'),
+                    cachedir is not None))
+            for name, (option, url), includepkgs in repos:
+                stream.write('\n[%s]\nname=%s\n%s=%s\n' % (
+                    name, name, option, url))
+                if includepkgs is not None:
+                    stream.write('includepkgs=%s\n' % includepkgs)
+        return path
+
+    async def get_package_cache(self, repos, params):
+        """Returns the pinned entry of the package cache for `repos`, or
+        None when another build uses it."""
+        packages = self.get_cache('packages', params)
+        if packages is None:
+            return None
+        key = 'centos%s-%s-%s' % (
+            params.edition, params.arch,
+            hashlib.sha256(repr(repos).encode('utf-8')).hexdigest()[:16])
+
+        async def create(path):
+            os.mkdir(path)
+
+        return await packages.fetch(key, create, exclusive=True)
+
+    async def install_packages(  # pylint: disable=no-self-use
+            self, root, yum_conf, config, params):
+        """Installs the kickstart's %packages into `root`."""
+        packages = list(config.packages)
+        # The installer always installs the core group.
+        if '@core' not in packages:
+            packages.insert(0, '@core')
+        args = [
+            'yum' if shutil.which('yum') is not None else 'dnf',
+            '-y', '-c', yum_conf,
+            '--installroot=%s' % root,
+            '--releasever=%s' % params.edition,
+            ]
+        for exclude in config.excludes:
+            args.extend(['-x', exclude])
+        await utils.subp_async(args + ['install'] + packages)
+        # The rpm database is written by the host's rpm, rebuild it in
+        # the format of the installed rpm.
+        await chroot.run(root, ['rpm', '--rebuilddb'])
+
+    async def configure(self, root, config):
+        """Applies the configuration commands of the kickstart to `root`,
+        as the installer does before %post."""
+        for command, args in config.commands:
+            handler = getattr(self, 'configure_%s' % command, None)
+            if handler is not None:
+                await handler(root, args)
+            elif command not in IGNORED_COMMANDS and command != 'repo':
+                logger.warning(
+                    "Kickstart command '%s' is not supported in a "
+                    "chroot, ignoring.", command)
+
+    def write_file(self, root, path, content):  # pylint: disable=no-self-use
+        """Writes `content` to `path` inside `root`."""
+        path = os.path.join(root, path.lstrip('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as stream:
+            stream.write(content)
+
+    async def configure_auth(  # pylint: disable=no-self-use
+            self, root, args):
+        """Configures authentication with authconfig."""
+        await chroot.run(root, ['authconfig', '--update', '--nostart'] + args)
+
+    async def configure_lang(self, root, args):
+        """Sets the system language."""
+        lang = kickstart.get_positional(args)[0]
+        if self.edition == '6':
+            self.write_file(root, '/etc/sysconfig/i18n', 'LANG="%s"\n' % lang)
+        else:
+            self.write_file(root, '/etc/locale.conf', 'LANG="%s"\n' % lang)
+
+    async def configure_keyboard(self, root, args):
+        """Sets the console keymap."""
+        keymap = kickstart.get_option(args, '--vckeymap')
+        if keymap is None:
+            keymap = kickstart.get_positional(args)[0]
+        if self.edition == '6':
+            self.write_file(
+                root, '/etc/sysconfig/keyboard', 'KEYTABLE="%s"\n' % keymap)
+        else:
+            self.write_file(
+                root, '/etc/vconsole.conf', 'KEYMAP="%s"\n' % keymap)
+
+    async def configure_timezone(self, root, args):
+        """Sets the system timezone."""
+        zone = kickstart.get_positional(args)[0]
+        localtime = os.path.join(root, 'etc', 'localtime')
+        if os.path.lexists(localtime):
+            os.unlink(localtime)
+        os.symlink('../usr/share/zoneinfo/%s' % zone, localtime)
+        if self.edition == '6':
+            self.write_file(root, '/etc/sysconfig/clock', 'ZONE="%s"\n' % zone)
+
+    async def configure_rootpw(  # pylint: disable=no-self-use
+            self, root, args):
+        """Sets the root password."""
+        password = kickstart.get_positional(args)[0]
+        if kickstart.get_option(args, '--iscrypted'):
+            await chroot.run(root, ['usermod', '-p', password, 'root'])
+        else:
+            await chroot.run(
+                root, ['chpasswd'],
+                data=('root:%s\n' % password).encode('utf-8'))
+        if kickstart.get_option(args, '--lock'):
+            await chroot.run(root, ['passwd', '-l', 'root'], capture=True)
+
+    async def configure_selinux(self, root, args):
+        """Sets the SELinux mode."""
+        mode = 'enforcing'
+        for option in ('--permissive', '--disabled'):
+            if kickstart.get_option(args, option):
+                mode = option[2:]
+        config = os.path.join(root, 'etc', 'selinux', 'config')
+        if os.path.exists(config):
+            await utils.subp_async([
+                'sed', '-i', 's/^SELINUX=.*/SELINUX=%s/' % mode, config])
+
+    async def label_selinux(self, root):  # pylint: disable=no-self-use
+        """Labels the files of `root` with the SELinux policy installed in
+        it, as the installer does, unless SELinux is disabled."""
+        try:
+            await customize.label_selinux(root)
+        except customize.CustomizeError as error:
+            raise BuildError(str(error))
+
+    async def configure_network(self, root, args):
+        """Writes the network configuration of the device."""
+        device = kickstart.get_option(args, '--device', 'eth0')
+        bootproto = kickstart.get_option(args, '--bootproto', 'dhcp')
+        onboot = kickstart.get_option(args, '--onboot', 'on')
+        self.write_file(root, '/etc/sysconfig/network', 'NETWORKING=yes\n')
+        self.write_file(
+            root, '/etc/sysconfig/network-scripts/ifcfg-%s' % device,
+            'DEVICE="%s"\nBOOTPROTO="%s"\nONBOOT="%s"\nTYPE="Ethernet"\n' % (
+                device, bootproto,
+                'no' if onboot in ('off', 'no') else 'yes'))
+
+    async def configure_services(self, root, args):
+        """Enables and disables services."""
+        for option, action in (('--disabled', 'off'), ('--enabled', 'on')):
+            services = kickstart.get_option(args, option, '')
+            for service in filter(None, services.split(',')):
+                if self.edition == '6':
+                    command = ['chkconfig', service, action]
+                else:
+                    command = [
+                        'systemctl',
+                        'enable' if action == 'on' else 'disable', service]
+                try:
+                    await chroot.run(root, command, capture=True)
+                except utils.ProcessExecutionError:
+                    # As in the installer, services that are not
+                    # installed are skipped.
+                    logger.warning("Service '%s' does not exist.", service)
+
+    async def configure_firewall(  # pylint: disable=no-self-use
+            self, root, args):
+        """Configures the firewall with the tool of the release."""
+        for tool in ('/usr/bin/firewall-offline-cmd', '/usr/sbin/lokkit'):
+            if os.path.exists(os.path.join(root, tool.lstrip('/'))):
+                await chroot.run(root, [tool] + args, capture=True)
+                return
+        logger.warning('No firewall configuration tool is installed.')
+
+    async def configure_bootloader(self, root, args):
+        """Writes the defaults of the bootloader curtin installs."""
+        if self.edition == '6':
+            return
+        self.write_file(root, '/etc/default/grub', DEFAULT_GRUB % {
+            'timeout': kickstart.get_option(args, '--timeout', '5'),
+            'append': kickstart.get_option(args, '--append', ''),
+            })
+        # The configuration %post edits is generated at deployment.
+        self.write_file(root, '/boot/grub2/grub.cfg', '')
+
+    async def run_post(self, root, config):  # pylint: disable=no-self-use
+        """Runs the %post scripts of the kickstart in `root`."""
+        for section, options, body in config.scripts:
+            if section != '%post':
+                continue
+            if kickstart.get_option(options, '--nochroot'):
+                logger.warning(
+                    'Skipping %post --nochroot, it expects the installer.')
+                continue
+            rcs = None
+            if not kickstart.get_option(options, '--erroronfail'):
+                rcs = range(256)
+            try:
+                await chroot.run_script(
+                    root, body, rcs=rcs,
+                    interpreter=kickstart.get_option(
+                        options, '--interpreter', '/bin/sh'))
+            except utils.ProcessExecutionError as error:
+                raise BuildError('%%post failed: %s' % error)
+
+    def read_kickstart(self, params):
+        """Returns the base kickstart parsed with the custom one."""
+        ks_file_paths = [self.base_kickstart(params)]
+        if params.custom_kickstart is not None:
+            ks_file_paths.append(params.custom_kickstart)
+        return kickstart.parse_kickstart(ks_file_paths)
+
+    async def build_image_async(self, params):
+        self.validate_params(params)
+        formats = self.get_output_formats(params)
+        # pylint: disable=attribute-defined-outside-init
+        self.edition = params.edition
+        config = self.read_kickstart(params)
+
+        # Create work space
+        with self.workdir(params) as workdir, self.place(params) as place:
+            root = os.path.join(workdir, 'rootfs')
+            os.mkdir(root)
+            repos = self.get_repos(config, params)
+
+            mounts = await utils.to_thread(chroot.mount_pseudo, root)
+            try:
+                package_cache = await self.get_package_cache(repos, params)
+                try:
+                    yum_conf = self.write_yum_conf(
+                        workdir, repos, cachedir=(
+                            None if package_cache is None
+                            else package_cache.path))
+                    await self.install_packages(root, yum_conf, config, params)
+                finally:
+                    if package_cache is not None:
+                        await utils.to_thread(package_cache.release)
+                await self.configure(root, config)
+                resolv_conf = chroot.copy_resolv_conf(root)
+                try:
+                    await self.run_post(root, config)
+                finally:
+                    chroot.restore_resolv_conf(root, resolv_conf)
+            finally:
+                await utils.to_thread(chroot.umount_pseudo, mounts)
+
+            # Allow the osystem module to install any needed files
+            # into the filesystem
+            await utils.to_thread(self.modify_mount, root)
+
+            # Run the user's customization scripts
+            await self.customize(root, params, relabel=False)
+
+            # Label every file, once none is written anymore
+            await self.label_selinux(root)
+
+            # Write every requested format from the root filesystem
+            work_paths = outputs.get_work_paths(workdir, formats)
+            manifest_path = self.manifest_path(workdir, params)
+            checksums = await self.upload_outputs(
+                outputs.write_filesystem_formats(
+                    root, work_paths,
+                    squashfs_args=self.squashfs_args(params, place),
+                    rsyncable=self.rsyncable(params),
+                    epoch=self.epoch(params),
+                    manifest_path=manifest_path,
+                    prefix=place.prefix),
+                work_paths, params)
+
+            # Place in output
+            await self.publish(
+                work_paths, formats, params, manifest_path=manifest_path,
+                checksums=checksums)
@@ -0,0 +1,108 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Builder customizing an existing Linux root tarball."""
+
+import os
+
+from mib import outputs, utils
+from mib.builders import Builder, BuildError
+
+
+class CustomizeBuilder(Builder):
+    """Runs the --customize scripts on an existing root tarball, such as
+    the output of the centos builder, without installing it again."""
+
+    name = "customize"
+    arches = ["i386", "amd64"]
+
+    def populate_parser(self, parser):  # pylint: disable=no-self-use
+        """Add parser options."""
+        parser.add_argument(
+            '--image', required=True,
+            help="Path to the root tarball to customize.")
+
+    def validate_params(self, params):  # pylint: disable=no-self-use
+        """Validates the command line parameters."""
+        if not os.path.isfile(params.image):
+            raise BuildError(
+                "Image '%s' does not exist!" % params.image)
+        if not params.customize:
+            raise BuildError(
+                "At least one --customize script is required.")
+
+    def scratch_size(self, params):
+        # The extracted root filesystem and each new image.
+        formats = self.get_output_formats(params)
+        return (3 + len(formats)) * os.path.getsize(params.image)
+
+    async def build_image_async(self, params):
+        self.validate_params(params)
+        formats = self.get_output_formats(params)
+
+        # Create work space
+        with self.workdir(params) as workdir, self.place(params) as place:
+            root = os.path.join(workdir, 'rootfs')
+            os.mkdir(root)
+            await utils.extract_tarball(
+                params.image, root, prefix=place.prefix)
+
+            # Run the user's customization scripts
+            await self.customize(root, params)
+
+            # Write every requested format from the root filesystem
+            work_paths = outputs.get_work_paths(workdir, formats)
+            manifest_path = self.manifest_path(workdir, params)
+            checksums = await self.upload_outputs(
+                outputs.write_filesystem_formats(
+                    root, work_paths,
+                    squashfs_args=self.squashfs_args(params, place),
+                    rsyncable=self.rsyncable(params),
+                    epoch=self.epoch(params),
+                    manifest_path=manifest_path,
+                    prefix=place.prefix),
+                work_paths, params)
+
+            # Place in output
+            await self.publish(
+                work_paths, formats, params, manifest_path=manifest_path,
+                checksums=checksums)
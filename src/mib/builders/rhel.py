@@ -45,7 +45,7 @@
 import os
 import shutil
 
-from mib import utils
+from mib import kickstart, utils
 from mib.builders import BuildError, VirtInstallBuilder
 
 ISOLINUX_CFG = (
@@ -69,6 +69,9 @@ class RHELBuilder(VirtInstallBuilder):
     disk_size = 5
     nic_model = "virtio"
 
+    def release(self, params):  # pylint: disable=no-self-use,unused-argument
+        return '7'
+
     def populate_parser(self, parser):
         """Add parser arguments."""
         parser.add_argument(
@@ -93,20 +96,27 @@ class RHELBuilder(VirtInstallBuilder):
                 "Custom kickstart file '%s' does not exist!" %
                 params.custom_kickstart)
 
-    def mount_iso(self, workdir, source):  # pylint: disable=no-self-use
+    def scratch_size(self, params):
+        # The copy of the ISO and the installation ISO made from it.
+        return (
+            super(RHELBuilder, self).scratch_size(params) +
+            2 * os.path.getsize(params.rhel_iso))
+
+    async def mount_iso(  # pylint: disable=no-self-use
+            self, workdir, source):
         """Mounts iso in 'iso' directory under workdir."""
         iso_dir = os.path.join(workdir, 'iso')
         os.mkdir(iso_dir)
-        utils.subp([
+        await utils.subp_async([
             'mount',
             source,
             iso_dir,
             ])
         return iso_dir
 
-    def umount_iso(self, iso_dir):  # pylint: disable=no-self-use
+    async def umount_iso(self, iso_dir):  # pylint: disable=no-self-use
         """Unmounts iso at path."""
-        utils.subp(['umount', iso_dir])
+        await utils.subp_async(['umount', iso_dir])
 
     def copy_iso(self, workdir, iso_dir):  # pylint: disable=no-self-use
         """Copies the contents of the iso_dir, into output dir."""
@@ -114,19 +124,15 @@ class RHELBuilder(VirtInstallBuilder):
         shutil.copytree(iso_dir, output)
         return output
 
-    def write_ks(self, output_dir, custom_kickstart=None):
+    def write_ks(self, output_dir, custom_kickstart=None,
+                 fast_install=False):
         """Writes the kickstarter config into the output_dir at 'ks.cfg'."""
-        base_kickstart_file = self.get_contrib_path('rhel7-amd64.ks')
-        output_file = os.path.join(output_dir, 'ks.cfg')
-        if custom_kickstart is None:
-            shutil.copyfile(base_kickstart_file, output_file)
-        else:
-            with open(output_file, 'w') as output:
-                for ks_file_path in (base_kickstart_file, custom_kickstart):
-                    output.write('#\n# From %s\n#\n\n' % ks_file_path)
-                    with open(ks_file_path, 'r') as ks_file:
-                        for line in ks_file:
-                            output.write(line)
+        ks_file_paths = [self.get_contrib_path('rhel7-amd64.ks')]
+        if custom_kickstart is not None:
+            ks_file_paths.append(custom_kickstart)
+        kickstart.compose_kickstart(
+            os.path.join(output_dir, 'ks.cfg'), ks_file_paths,
+            fast_install=fast_install)
 
     def set_timeout_zero(self, output_dir):  # pylint: disable=no-self-use
         """Sets the isolinux.cfg timeout to zero."""
@@ -134,10 +140,11 @@ class RHELBuilder(VirtInstallBuilder):
         with open(isolinux_cfg, 'w') as stream:
             stream.write(ISOLINUX_CFG + '\n')
 
-    def create_iso(self, workdir, source):  # pylint: disable=no-self-use
+    async def create_iso(  # pylint: disable=no-self-use
+            self, workdir, source):
         """Creates iso at output, containing files at source."""
         output = os.path.join(workdir, 'output.iso')
-        utils.subp([
+        await utils.subp_async([
             'mkisofs',
             '-o', output,
             '-b', 'isolinux/isolinux.bin',
@@ -147,8 +154,8 @@ class RHELBuilder(VirtInstallBuilder):
             '-boot-info-table', '-R', '-J', '-v',
             '-T', source
             ])
-        utils.subp(['chmod', '777', workdir])
-        utils.subp(['chmod', '777', output])
+        await utils.subp_async(['chmod', '777', workdir])
+        await utils.subp_async(['chmod', '777', output])
         return output
 
     def modify_mount(self, mount_path):
@@ -159,29 +166,34 @@ class RHELBuilder(VirtInstallBuilder):
         opt_path = os.path.join(mount_path, 'curtin')
         shutil.copytree(path, opt_path)
 
-    def build_image(self, params):
+    async def build_image_async(self, params):
         self.validate_params(params)
 
         # Create work space
-        with utils.tempdir() as workdir:
+        with self.workdir(params) as workdir:
             # Copy out the contents of the ISO file.
-            iso_dir = self.mount_iso(workdir, self.install_cdrom)
+            iso_dir = await self.mount_iso(workdir, self.install_cdrom)
             try:
-                output_dir = self.copy_iso(workdir, iso_dir)
+                output_dir = await utils.to_thread(
+                    self.copy_iso, workdir, iso_dir)
             finally:
-                self.umount_iso(iso_dir)
+                await self.umount_iso(iso_dir)
                 shutil.rmtree(iso_dir)
 
             # Write the kickstarter config.
-            self.write_ks(output_dir, params.custom_kickstart)
+            self.write_ks(
+                output_dir, params.custom_kickstart,
+                fast_install=params.fast_install)
 
             # Update isolinux to not have a timeout.
             self.set_timeout_zero(output_dir)
 
             # Create the final ISO for installation.
             try:
-                self.install_cdrom = self.create_iso(workdir, output_dir)
+                self.install_cdrom = await self.create_iso(
+                    workdir, output_dir)
             finally:
-                shutil.rmtree(output_dir)
+                await utils.to_thread(shutil.rmtree, output_dir)
 
-            super(RHELBuilder, self).build_image(params)
+            # Install from it, in the same work space.
+            await self.build_in_workdir(workdir, params)
@@ -49,8 +49,9 @@ import tempfile
 
 from tempita import Template
 
-from mib import net, utils
+from mib import cache, console, hardware, net, outputs, scratch, utils
 from mib.builders import Builder, BuildError
+from mib.driver import VMDriver
 
 EDITIONS = {
     'win2008r2': "Windows Server 2008 R2 SERVERSTANDARD",
@@ -63,12 +64,29 @@ EDITIONS = {
     'win2016hv': "Hyper-V Server 2016 SERVERHYPERCORE",
     }
 
+# Directory of each edition's drivers on the virtio-win ISO.
+VIRTIO_WIN_VERSIONS = {
+    'win2008r2': '2k8R2',
+    'win2008hvr2': '2k8R2',
+    'win2012': '2k12',
+    'win2012hv': '2k12',
+    'win2012r2': '2k12R2',
+    'win2012hvr2': '2k12R2',
+    'win2016': '2k16',
+    'win2016hv': '2k16',
+    }
+
+# Only these files are needed to load the drivers during setup, which
+# keeps them small enough for the floppy.
+VIRTIO_DRIVER_EXTENSIONS = ('.cat', '.inf', '.sys')
+
 
-class WindowsOSBuilder(Builder):
+class WindowsOSBuilder(Builder):  # pylint: disable=too-many-public-methods
     """Builds the Windows image using kvm-spice."""
 
     name = "windows"
     arches = ["i386", "amd64"]
+    disk_size = 16
 
     def populate_parser(self, parser):
         """Add parser options."""
@@ -95,12 +113,27 @@ class WindowsOSBuilder(Builder):
             '--windows-language',
             default='en-US',
             help="Windows installation language. Default: en-US")
+        parser.add_argument(
+            '--virtio-win-iso',
+            help=(
+                "Path to the virtio-win drivers ISO. When available the "
+                "installation uses virtio disk and network devices. "
+                "Default: %s, if present" % hardware.VIRTIO_WIN_ISO))
+        parser.add_argument(
+            '--windows-disk-bus',
+            default='virtio-blk', choices=['virtio-blk', 'virtio-scsi'],
+            help=(
+                "Bus of the installation disk when virtio drivers are "
+                "available. Default: virtio-blk"))
         parser.add_argument(
             '--cloudbase-init',
             help=(
                 "Path to the cloudbase-init installer to use. By default it "
                 "will be pulled from cloudbase.it"))
 
+    def release(self, params):  # pylint: disable=no-self-use
+        return params.windows_edition
+
     def validate_params(self, params):
         """Validates the command line parameters."""
         iso = params.windows_iso
@@ -127,6 +160,28 @@ class WindowsOSBuilder(Builder):
         if drivers is not None and not os.path.isdir(drivers):
             raise BuildError(
                 "Invalid driver path: %s" % drivers)
+        if params.customize:
+            raise BuildError(
+                "Customization scripts are only supported for Linux images.")
+        if params.manifest:
+            raise BuildError(
+                "Manifests are only supported for Linux images.")
+        virtio_iso = params.virtio_win_iso
+        if virtio_iso is not None and not os.path.exists(virtio_iso):
+            raise BuildError(
+                "Failed to access virtio-win ISO at: %s" % virtio_iso)
+
+    @property
+    def output_formats(self):
+        return ['ddtgz', 'qcow2', 'qcow2-compressed']
+
+    def scratch_size(self, params):
+        # The disk and a converted copy for each format exist side by
+        # side, next to the install ISO.
+        formats = self.get_output_formats(params)
+        return (
+            (1 + len(formats)) * self.disk_size * scratch.GIBIBYTE +
+            scratch.GIBIBYTE)
 
     def validate_license_key(self, license_key):  # pylint: disable=no-self-use
         """Validates that license key is in the correct format. It does not
@@ -142,7 +197,8 @@ class WindowsOSBuilder(Builder):
             return Template(stream.read().decode('utf-8'))
 
     def write_unattended(self, output_path, arch, edition, language,
-                         license_key=None, enable_updates=False):
+                         license_key=None, enable_updates=False,
+                         virtio_drivers=False):
         """Outputs the effective unattended.xml file that will be used by
         Windows during the installation."""
         template = self.load_unattended_template()
@@ -152,54 +208,135 @@ class WindowsOSBuilder(Builder):
             arch = 'x86'
         output = template.substitute(
             arch=arch, image_name=image_name, language=language,
-            license_key=license_key, enable_updates=enable_updates)
+            license_key=license_key, enable_updates=enable_updates,
+            virtio_drivers=virtio_drivers)
         with open(output_path, 'w') as stream:
             for line in output.splitlines():
                 stream.write("%s\r\n" % line)
 
-    def create_floppy_disk(self, output_path):  # pylint: disable=no-self-use
-        """Creates an empty floppy disk, formatted with vfat."""
-        utils.subp([
+    async def create_floppy_disk(  # pylint: disable=no-self-use
+            self, output_path, epoch=None):
+        """Creates an empty floppy disk, formatted with vfat.
+
+        With `epoch` the volume id and dates do not vary between runs.
+        """
+        await utils.subp_async([
             'dd', 'if=/dev/zero',
             'of=%s' % output_path,
             'bs=1024', 'count=1440',
             ])
-        utils.subp([
-            'mkfs.vfat',
-            output_path
-            ])
-
-    def prepare_floppy_disk(self, workdir, arch, edition, language,
-                            license_key=None, enable_updates=False):
-        """Prepares the working directory with Autounattend.vfd."""
+        args = ['mkfs.vfat']
+        if epoch is not None:
+            args.append('--invariant')
+        await utils.subp_async(
+            args + [output_path], env=utils.get_source_date_env(epoch))
+
+    async def copy_to_floppy(  # pylint: disable=no-self-use
+            self, vfd_path, source, epoch=None):
+        """Copies the files in the directory `source` to the root of the
+        floppy disk, in name order and keeping their modification
+        times."""
+        env = utils.get_source_date_env(epoch)
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            path = os.path.relpath(root, source)
+            target = '::' if path == '.' else '::/' + path
+            for name in dirs:
+                await utils.subp_async([
+                    'mmd', '-i', vfd_path, target + '/' + name,
+                    ], env=env)
+            if files:
+                await utils.subp_async([
+                    'mcopy', '-m', '-i', vfd_path,
+                    ] + [os.path.join(root, name) for name in sorted(files)] +
+                    [target + '/'], env=env)
+
+    async def prepare_floppy_disk(self, workdir, arch, edition, language,
+                                  license_key=None, enable_updates=False,
+                                  virtio_path=None, epoch=None):
+        """Prepares the working directory with Autounattend.vfd.
+
+        The virtio drivers at `virtio_path` are placed on the floppy, for
+        setup to load them before it looks for the disk. With `epoch`
+        the floppy is deterministic, its files dated at most `epoch`.
+        """
         # Create the disk
         vfd_path = os.path.join(workdir, 'Autounattend.vfd')
-        self.create_floppy_disk(vfd_path)
-
-        # Mount the disk
-        mount_path = os.path.join(workdir, 'vfd_mount')
-        os.mkdir(mount_path)
-        utils.subp([
-            'mount',
-            '-t', 'vfat',
-            '-o', 'loop',
-            vfd_path, mount_path,
-            ])
-
-        # Place the generated Autounattend.xml file
-        xml_path = os.path.join(mount_path, 'Autounattend.xml')
+        await self.create_floppy_disk(vfd_path, epoch=epoch)
+
+        # Place the generated Autounattend.xml file, and the drivers
+        floppy_path = os.path.join(workdir, 'floppy')
+        os.mkdir(floppy_path)
+        self.write_unattended(
+            os.path.join(floppy_path, 'Autounattend.xml'), arch, edition,
+            language, license_key=license_key, enable_updates=enable_updates,
+            virtio_drivers=virtio_path is not None)
+        if virtio_path is not None:
+            await utils.to_thread(
+                shutil.copytree, virtio_path,
+                os.path.join(floppy_path, 'virtio'))
+        if epoch is not None:
+            await utils.to_thread(utils.clamp_mtimes, floppy_path, epoch)
+
+        # Copy them onto the disk
         try:
-            self.write_unattended(
-                xml_path, arch, edition, language,
-                license_key=license_key, enable_updates=enable_updates)
+            await self.copy_to_floppy(vfd_path, floppy_path, epoch=epoch)
         finally:
-            utils.subp(['umount', mount_path])
-            os.rmdir(mount_path)
+            await utils.to_thread(shutil.rmtree, floppy_path)
         return vfd_path
 
-    def download_cloudbase_init(  # pylint: disable=no-self-use
-            self, workdir, arch, cloudbase_init=None):
-        """Downloads cloudbase init."""
+    async def extract_virtio_drivers(  # pylint: disable=no-self-use
+            self, workdir, iso, edition, arch, disk_bus):
+        """Copies the storage and network drivers for `edition` out of the
+        virtio-win ISO, into 'virtio' under workdir."""
+        iso_dir = os.path.join(workdir, 'virtio_iso')
+        output_path = os.path.join(workdir, 'virtio')
+        os.mkdir(iso_dir)
+        await utils.subp_async(['mount', '-o', 'loop,ro', iso, iso_dir])
+        try:
+            storage = 'vioscsi' if disk_bus == 'virtio-scsi' else 'viostor'
+            for driver in (storage, 'NetKVM'):
+                src = os.path.join(
+                    iso_dir, driver, VIRTIO_WIN_VERSIONS[edition],
+                    'x86' if arch == 'i386' else 'amd64')
+                if not os.path.isdir(src):
+                    raise BuildError(
+                        "virtio-win ISO has no %s driver for %s." % (
+                            driver, edition))
+                dest = os.path.join(output_path, driver)
+                os.makedirs(dest)
+                for filename in os.listdir(src):
+                    if filename.lower().endswith(VIRTIO_DRIVER_EXTENSIONS):
+                        shutil.copy(os.path.join(src, filename), dest)
+        finally:
+            await utils.subp_async(['umount', iso_dir])
+            os.rmdir(iso_dir)
+        return output_path
+
+    def hardware_profile(self, params):
+        """Returns the virtual hardware of the installation VM.
+
+        Virtio devices are only used when the virtio-win drivers are
+        available to inject into setup.
+        """
+        if params.hardware_profile == 'legacy':
+            return hardware.legacy_profile(
+                disk_cache='unsafe' if params.fast_install else None)
+        return hardware.select_profile(
+            self.vcpu_count(params), disk_bus=params.windows_disk_bus,
+            virtio=self.get_virtio_iso(params) is not None, libvirt=False)
+
+    def get_virtio_iso(self, params):  # pylint: disable=no-self-use
+        """Returns the path to the virtio-win ISO, if any."""
+        if params.virtio_win_iso is not None:
+            return params.virtio_win_iso
+        if os.path.exists(hardware.VIRTIO_WIN_ISO):
+            return hardware.VIRTIO_WIN_ISO
+        return None
+
+    async def download_cloudbase_init(  # pylint: disable=no-self-use
+            self, workdir, arch, cloudbase_init=None, downloads=None):
+        """Downloads cloudbase init, through the `downloads` cache."""
         output_path = os.path.join(workdir, 'cloudbase_init.msi')
         if arch == 'amd64':
             msi_file = "CloudbaseInitSetup_x64.msi"
@@ -209,56 +346,58 @@ class WindowsOSBuilder(Builder):
 
         # --cloudbase-init passed in, don't download.
         if cloudbase_init:
-            shutil.copyfile(cloudbase_init, output_path)
+            await utils.to_thread(
+                shutil.copyfile, cloudbase_init, output_path)
             return output_path
 
         # Remove me, testing only
         tmp_path = os.path.join('/tmp', msi_file)
         if os.path.exists(tmp_path):
-            shutil.copyfile(tmp_path, output_path)
+            await utils.to_thread(shutil.copyfile, tmp_path, output_path)
             return output_path
 
-        utils.subp([
-            'wget',
-            '-O', output_path,
-            download_path
-            ])
+        await cache.download(download_path, output_path, downloads)
         return output_path
 
-    def download_ps_windows_update(  # pylint: disable=no-self-use
-            self, workdir):
-        """Downloads the PSWindowsUpdate package."""
+    async def download_ps_windows_update(  # pylint: disable=no-self-use
+            self, workdir, downloads=None):
+        """Downloads the PSWindowsUpdate package, through the `downloads`
+        cache."""
         output_path = os.path.join(workdir, 'pswindowsupdate.zip')
         download_path = (
             "http://gallery.technet.microsoft.com/scriptcenter/"
             "2d191bcd-3308-4edd-9de2-88dff796b0bc/file/41459/43/"
             "PSWindowsUpdate.zip")
-        utils.subp([
-            'wget',
-            '-O', output_path,
-            download_path
-            ])
+        await cache.download(download_path, output_path, downloads)
         return output_path
 
-    def unzip_archive(self, src, dest):  # pylint: disable=no-self-use
+    async def unzip_archive(self, src, dest):  # pylint: disable=no-self-use
         """Un-zips an archive into destination."""
-        utils.subp([
+        await utils.subp_async([
             'unzip', '-q',
             src,
             '-d', dest,
             ])
 
-    def create_iso(self, output, source):  # pylint: disable=no-self-use
-        """Creates iso at output, containing files at source."""
-        utils.subp([
+    async def create_iso(  # pylint: disable=no-self-use
+            self, output, source, epoch=None):
+        """Creates iso at output, containing files at source.
+
+        With `epoch` the iso is deterministic, its files dated at most
+        `epoch`.
+        """
+        if epoch is not None:
+            await utils.to_thread(utils.clamp_mtimes, source, epoch)
+        await utils.subp_async([
             'genisoimage',
             '-o', output,
             '-V', 'SCRIPTS',
             '-J', source
-            ])
+            ], env=utils.get_source_date_env(epoch))
 
-    def build_install_iso(self, workdir, arch, with_updates=False,
-                          drivers_path=None, cloudbase_init=None):
+    async def build_install_iso(self, workdir, arch, with_updates=False,
+                                drivers_path=None, cloudbase_init=None,
+                                epoch=None, downloads=None):
         """Builds the iso that is mounted to Windows, to complete the
         installation process."""
         install_path = os.path.join(workdir, 'install')
@@ -267,66 +406,93 @@ class WindowsOSBuilder(Builder):
         # Download cloudbase-init into install/cloudbase
         cloudbase_dir = os.path.join(install_path, 'cloudbase')
         os.mkdir(cloudbase_dir)
-        self.download_cloudbase_init(
-            cloudbase_dir, arch, cloudbase_init=cloudbase_init)
+        steps = [
+            self.download_cloudbase_init(
+                cloudbase_dir, arch, cloudbase_init=cloudbase_init,
+                downloads=downloads),
+            ]
 
         # Copy contrib scripts into install/scripts
         contrib_path = self.get_contrib_path('scripts')
         scripts_path = os.path.join(install_path, 'scripts')
-        shutil.copytree(contrib_path, scripts_path)
+        steps.append(
+            utils.to_thread(shutil.copytree, contrib_path, scripts_path))
 
         # Copy the drivers if provided
         if drivers_path is not None:
-            shutil.copytree(
+            steps.append(utils.to_thread(
+                shutil.copytree,
                 drivers_path,
-                os.path.join(install_path, 'infs'))
+                os.path.join(install_path, 'infs')))
 
         # Place PSWindowsUpdate modules if using with_updates
         if with_updates:
-            zip_path = self.download_ps_windows_update(workdir)
-            self.unzip_archive(zip_path, install_path)
+            async def install_ps_windows_update():
+                zip_path = await self.download_ps_windows_update(
+                    workdir, downloads=downloads)
+                await self.unzip_archive(zip_path, install_path)
+            steps.append(install_ps_windows_update())
+
+        # Fetch and copy everything at the same time
+        await utils.gather(*steps)
 
         # Create the iso
         output_iso = os.path.join(workdir, 'install.iso')
-        self.create_iso(output_iso, install_path)
-        shutil.rmtree(install_path)
+        await self.create_iso(output_iso, install_path, epoch=epoch)
+        await utils.to_thread(shutil.rmtree, install_path)
         return output_iso
 
-    def create_disk_image(  # pylint: disable=no-self-use
+    async def create_disk_image(  # pylint: disable=no-self-use
             self, output_path, size):
         """Creates the disk image that Windows will install to."""
-        utils.subp([
+        await utils.subp_async([
             'qemu-img', 'create',
             '-f', 'raw',
             output_path, size
             ])
 
-    def spawn_vm(  # pylint: disable=no-self-use
-            self, ram, vcpus, cdrom, floppy, install_iso, disk,
-            tap=None):
-        """Spawns the qemu vm for Windows to install."""
-        args = [
+    async def spawn_vm(  # pylint: disable=no-self-use,too-many-locals
+            self, driver, name, workdir, ram, vcpus, cdrom, floppy,
+            install_iso, disk, profile, tap=None, prefix=None):
+        """Spawns the qemu vm for Windows to install, returning the domain
+        followed by `driver`.
+
+        The VNC and QMP sockets are placed in `workdir`, so concurrent
+        builds never share them. The vm runs under `prefix`, such as a
+        numactl call, when given.
+        """
+        args = list(prefix or []) + [
             'kvm-spice',
+            '-name', name,
             '-m', '%s' % ram, '-smp', vcpus,
+            '-serial', 'file:%s' % os.path.join(workdir, 'console.log'),
             '-cdrom', cdrom,
-            '-drive', 'file=%s,index=0,format=raw,if=ide,media=disk' % disk,
+            ]
+        args.extend(profile.qemu_disk_args(disk))
+        args.extend([
             '-drive', 'file=%s,index=1,format=raw,if=floppy' % floppy,
             '-drive', 'file=%s,index=3,format=raw,if=ide,media=cdrom' % install_iso,
-            ]
+            ])
         if tap is not None:
             mac = net.get_random_qemu_mac()
+            nic_model = profile.nic_model
+            if nic_model == 'virtio':
+                nic_model = 'virtio-net-pci'
             args.extend([
-                '-device', 'rtl8139,netdev=net00,mac=%s' % mac,
+                '-device', '%s,netdev=net00,mac=%s' % (nic_model, mac),
                 '-netdev',
                 'type=tap,id=net00,script=no,downscript=no,ifname=%s' % tap,
                 ])
         args.extend([
             '-boot', 'd', '-vga', 'std',
             '-k', 'en-us',
-            # Debug *Remove*
-            '-vnc', 'localhost:1',
             ])
-        utils.subp(args)
+        args.extend(profile.qemu_args())
+        if not profile.headless:
+            args.extend([
+                '-vnc', 'unix:%s' % os.path.join(workdir, 'vnc.sock')])
+        qmp_path = os.path.join(workdir, 'qmp.sock')
+        return await driver.start_qemu(name, args, qmp_path)
 
     def mount_partition(  # pylint: disable=no-self-use
             self, workdir, disk_path, partition):
@@ -337,12 +503,16 @@ class WindowsOSBuilder(Builder):
         return mount_path
 
     def umount_partition(  # pylint: disable=no-self-use
-            self, disk_path, target, partition):
-        """Un-mounts the target, marks ntfs as clean, and removes loopback."""
+            self, disk_path, target, partition, durability='output'):
+        """Un-mounts the target, marks ntfs as clean, and removes loopback.
+
+        The partition is flushed with the 'full' `durability`.
+        """
         utils.subp(['umount', target])
         devs = utils.kpartx_list(disk_path)
         utils.subp(['ntfsfix', '-d', devs[partition]])
-        utils.fs_sync()
+        if durability == 'full':
+            utils.sync_file(devs[partition])
         utils.kpartx_del(disk_path)
         os.rmdir(target)
 
@@ -401,97 +571,118 @@ class WindowsOSBuilder(Builder):
             with open(config, 'w') as stream:
                 stream.write(data)
 
-    def qemu_convert(  # pylint: disable=no-self-use
-            self, disk_path, output_path):
-        """Converts the disk path to output path."""
-        utils.subp([
-            'qemu-img', 'convert',
-            '-O', 'raw',
-            disk_path, output_path,
-            ])
-
-    def create_tarball(  # pylint: disable=no-self-use
-            self, disk_path, output_path):
-        """Creates tarball of the disk."""
-        disk_dir = os.path.dirname(os.path.abspath(disk_path))
-        disk_filename = os.path.basename(disk_path)
-        utils.subp([
-            'tar', 'Szcf',
-            output_path,
-            '-C', disk_dir,
-            disk_filename,
-            ])
-
-    def build_image(self, params):
+    async def build_image_async(  # pylint: disable=too-many-locals
+            self, params):
         self.validate_params(params)
+        formats = self.get_output_formats(params)
 
         # Create work space
-        with utils.tempdir() as workdir:
-
-            # Build the install.iso
-            install_iso = self.build_install_iso(
-                workdir, params.arch,
-                with_updates=params.windows_updates,
-                drivers_path=params.windows_drivers,
-                cloudbase_init=params.cloudbase_init)
-
-            # Create the floppy with the Autounattend.xml
-            floppy_path = self.prepare_floppy_disk(
-                workdir, params.arch,
-                params.windows_edition, params.windows_language,
-                license_key=params.windows_license_key,
-                enable_updates=params.windows_updates)
-
-            # Create the disk image
+        with self.workdir(params) as workdir, self.place(params) as place:
+
+            profile = self.hardware_profile(params)
+
+            async def prepare_floppy_disk():
+                virtio_path = None
+                if profile.virtio:
+                    virtio_path = await self.extract_virtio_drivers(
+                        workdir, self.get_virtio_iso(params),
+                        params.windows_edition, params.arch,
+                        profile.disk_bus)
+                return await self.prepare_floppy_disk(
+                    workdir, params.arch,
+                    params.windows_edition, params.windows_language,
+                    license_key=params.windows_license_key,
+                    enable_updates=params.windows_updates,
+                    virtio_path=virtio_path, epoch=self.epoch(params))
+
+            # Build the install.iso, the floppy with the Autounattend.xml
+            # and the disk image at the same time
             disk_path = os.path.join(workdir, 'output.img')
-            self.create_disk_image(disk_path, '16G')
+            install_iso, floppy_path, _ = await utils.gather(
+                self.build_install_iso(
+                    workdir, params.arch,
+                    with_updates=params.windows_updates,
+                    drivers_path=params.windows_drivers,
+                    cloudbase_init=params.cloudbase_init,
+                    epoch=self.epoch(params),
+                    downloads=self.get_cache('downloads', params)),
+                prepare_floppy_disk(),
+                self.create_disk_image(disk_path, '%dG' % self.disk_size))
 
             # Create tap device, if installing Windows updates
             # as the VM needs access to microsoft.com
             tap_name = None
             if params.windows_updates:
-                tap_name = net.create_tap(params.interface)
+                tap_name = await utils.to_thread(
+                    net.create_tap, params.interface, params.build_id)
 
+            driver = VMDriver()
             try:
-                # Start the Windows installation
-                self.spawn_vm(
-                    params.ram, params.vcpus, params.windows_iso,
-                    floppy_path, install_iso,
-                    disk_path, tap=tap_name)
+                # Start the Windows installation and wait for it to
+                # power off the VM
+                vm_name = 'img-build-windows-%s-%s-%s' % (
+                    params.windows_edition, params.arch, params.build_id)
+                domain = await self.spawn_vm(
+                    driver, vm_name, workdir, params.ram, params.vcpus,
+                    params.windows_iso, floppy_path, install_iso,
+                    disk_path, profile, tap=tap_name, prefix=place.prefix)
+
+                # Windows setup reports no milestones on the serial
+                # console, it is only captured
+                await self.wait_for_install(
+                    driver, domain, os.path.join(workdir, 'console.log'),
+                    disk_path, params,
+                    parser=console.ProgressParser(patterns=[]))
             finally:
+                await driver.close()
+
                 # Destroy the tap
                 if tap_name is not None:
-                    net.delete_tap(tap_name)
+                    await utils.to_thread(net.delete_tap, tap_name)
 
             # Installation has finished, mount the disk
-            mount_path = self.mount_partition(workdir, disk_path, 1)
+            await hardware.flush_install_disk(
+                profile, disk_path, params.durability)
+            mount_path = await utils.to_thread(
+                self.mount_partition, workdir, disk_path, 1)
 
             try:
                 # Check that installation went as expected
                 error_filename = 'windows-%s-%s-error.log' % (
                     params.windows_edition, params.arch)
                 save_error_path = os.path.join(
-                    tempfile.mkdtemp(prefix="mib-windows"), error_filename)
-                self.check_success(mount_path, save_error_path)
+                    tempfile.mkdtemp(
+                        prefix="mib-windows-%s-" % params.build_id),
+                    error_filename)
+                await utils.to_thread(
+                    self.check_success, mount_path, save_error_path)
 
                 # Install the curtin scripts into the root
-                self.install_curtin(mount_path)
+                await utils.to_thread(self.install_curtin, mount_path)
 
                 # Remove serial output from cloudbase-init.conf
-                self.remove_serial_log(mount_path)
+                await utils.to_thread(self.remove_serial_log, mount_path)
+
+                # Clear the free space, for it to package as sparse
+                await self.compact(disk_path, mount_path, params)
 
             finally:
                 # Unmount and clean
-                self.umount_partition(disk_path, mount_path, 1)
-
-            # Convert to raw, to save on some sparse space
-            clean_disk_path = os.path.join(workdir, 'clean-output.img')
-            self.qemu_convert(disk_path, clean_disk_path)
+                await utils.to_thread(
+                    self.umount_partition, disk_path, mount_path, 1,
+                    durability=params.durability)
+
+            # Shrink the system partition and the disk to the minimum
+            await self.shrink(disk_path, 1, params)
+
+            # Write every requested format from the disk image
+            work_paths = outputs.get_work_paths(workdir, formats)
+            checksums = await self.upload_outputs(outputs.write_block_formats(
+                disk_path, work_paths, workdir,
+                rsyncable=self.rsyncable(params), epoch=self.epoch(params),
+                prefix=place.prefix), work_paths, params)
             os.unlink(disk_path)
 
-            # Create the tarball of raw image
-            tarball_path = os.path.join(workdir, 'output.ddtgz')
-            self.create_tarball(clean_disk_path, tarball_path)
-
-            # Move to output
-            shutil.move(tarball_path, params.output)
+            # Place in output
+            await self.publish(
+                work_paths, formats, params, checksums=checksums)
@@ -0,0 +1,441 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Size-bounded caches of the builders.
+
+Every cache of the builders, such as the downloads or the packages,
+registers with one cache manager rooted in the cache directory. Each
+cache and the manager as a whole have byte budgets, enforced by evicting
+the least recently used entries.
+
+Entries in use are pinned: their users hold a shared lock of the entry,
+and eviction only removes the entries it can lock exclusively. Entries
+are populated under an exclusive lock, in a temporary path renamed into
+place, so concurrent builds never see a partial entry.
+
+Layout of a cache::
+
+    <cache dir>/<cache>/<key>          the entry, a file or a directory
+    <cache dir>/<cache>/.<key>.lock    its size, dated by its last use
+
+The manager can be backed by a remote store shared by several hosts,
+such as `mib.objectstore.ObjectStore`: a missing file entry is read
+through from it before being created, and written back to it once
+created. Failures of the remote store only cost the local cache a miss.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import http.client
+import logging
+import os
+import re
+import shutil
+from contextlib import contextmanager
+
+from mib import objectstore, utils
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = '/var/cache/maas-image-builder'
+
+# Caches registered by the builders.
+CACHES = ('downloads', 'packages')
+
+# Budget of all the caches together, in MiB.
+DEFAULT_SIZE = 20 * 1024
+
+MEBIBYTE = 1024 * 1024
+
+
+class CacheError(Exception):
+    """Error class for cache errors."""
+
+
+def get_manager(args, remote=None):
+    """Returns the cache manager configured by the command line `args`,
+    backed by the `remote` store."""
+    return CacheManager(
+        args.cache_dir, size=args.cache_size * MEBIBYTE, budgets={
+            name: budget * MEBIBYTE for name, budget in args.cache_budget},
+        remote=remote)
+
+
+def get_size(path):
+    """Returns the size of the file or directory at `path`."""
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+
+def remove_path(path):
+    """Removes the file or directory at `path`, if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def lock_entry(lock_path, operation):
+    """Opens and locks the lock file of an entry, checking that it was not
+    removed by an eviction meanwhile. Returns the locked file, or None
+    when a non-blocking lock is held by another user."""
+    while True:
+        stream = open(lock_path, 'a+')
+        try:
+            fcntl.flock(stream, operation)
+            if os.fstat(stream.fileno()).st_ino == os.stat(
+                    lock_path).st_ino:
+                return stream
+        except BlockingIOError:
+            stream.close()
+            return None
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            stream.close()
+            raise
+        stream.close()
+
+
+def record_use(stream, size=None):
+    """Dates the last use of an entry, with its locked file `stream`, and
+    records its `size`."""
+    if size is not None:
+        stream.seek(0)
+        stream.truncate()
+        stream.write('%d\n' % size)
+        stream.flush()
+    os.utime(stream.fileno())
+
+
+class Entry:
+    """Entry of a cache, pinned against eviction until released."""
+
+    def __init__(self, path, stream, exclusive=False):
+        self.path = path
+        self.stream = stream
+        self.exclusive = exclusive
+
+    def release(self):
+        """Unpins the entry. An exclusive user may have changed it, its
+        size is recorded again."""
+        if self.stream is None:
+            return
+        try:
+            record_use(
+                self.stream,
+                get_size(self.path) if self.exclusive else None)
+        finally:
+            self.stream.close()
+            self.stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class Cache:
+    """Cache of entries named by their key, under the budget of the
+    manager."""
+
+    def __init__(self, manager, name, budget=None):
+        self.manager = manager
+        self.name = name
+        self.budget = budget
+        self.path = os.path.join(manager.path, name)
+
+    def get_path(self, key):
+        """Returns the path of the entry `key`."""
+        if not re.match(r'^[\w+-][\w.+-]*$', key):
+            raise CacheError("Invalid cache key '%s'." % key)
+        return os.path.join(self.path, key)
+
+    def get_lock_path(self, key):
+        """Returns the path of the lock file of the entry `key`."""
+        return os.path.join(self.path, '.%s.lock' % key)
+
+    def entries(self):
+        """Returns the entries of the cache, as a list of (key, size, last
+        use)."""
+        entries = []
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if not (name.startswith('.') and name.endswith('.lock')):
+                continue
+            lock_path = os.path.join(self.path, name)
+            try:
+                with open(lock_path, 'r') as stream:
+                    size = int(stream.read() or 0)
+                last_use = os.stat(lock_path).st_mtime
+            except (FileNotFoundError, ValueError):
+                continue
+            entries.append((name[1:-len('.lock')], size, last_use))
+        return entries
+
+    async def fetch(self, key, create, exclusive=False):
+        """Returns the pinned entry `key`, first calling the coroutine
+        function `create` with a temporary path to populate when it is
+        missing.
+
+        An exclusive entry is pinned for a user that may change it, when
+        no other build uses it, None is returned otherwise.
+        """
+        path = self.get_path(key)
+        lock_path = self.get_lock_path(key)
+        await utils.to_thread(os.makedirs, self.path, exist_ok=True)
+        while True:
+            if exclusive:
+                stream = await utils.to_thread(
+                    lock_entry, lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if stream is None:
+                    return None
+            else:
+                stream = await utils.to_thread(
+                    lock_entry, lock_path, fcntl.LOCK_SH)
+                if os.path.exists(path):
+                    record_use(stream)
+                    return Entry(path, stream)
+                stream.close()
+                stream = await utils.to_thread(
+                    lock_entry, lock_path, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(path):
+                    await self.populate(
+                        path, stream, create, shared=not exclusive)
+                    await utils.to_thread(self.manager.collect)
+            except BaseException:
+                stream.close()
+                raise
+            if exclusive:
+                record_use(stream)
+                return Entry(path, stream, exclusive=True)
+            # Pinned again with a shared lock, once populated.
+            stream.close()
+
+    async def populate(self, path, stream, create, shared=True):
+        """Populates the entry at `path`, while its lock file `stream` is
+        held exclusively. A `shared` entry is read through from, and
+        written back to, the remote store."""
+        key = os.path.basename(path)
+        remote = self.manager.remote if shared else None
+        tmp_path = os.path.join(self.path, '.%s.tmp' % key)
+        await utils.to_thread(remove_path, tmp_path)
+        try:
+            found = remote is not None and await utils.to_thread(
+                self.read_through, key, tmp_path)
+            if not found:
+                await create(tmp_path)
+            size = await utils.to_thread(get_size, tmp_path)
+            os.rename(tmp_path, path)
+        except BaseException:
+            await asyncio.shield(utils.to_thread(remove_path, tmp_path))
+            raise
+        record_use(stream, size)
+        logger.info(
+            'Cached %s/%s, %d bytes%s.', self.name, key, size,
+            ' from the remote store' if found else '')
+        if remote is not None and not found and os.path.isfile(path):
+            await utils.to_thread(self.write_back, key, path)
+
+    def read_through(self, key, path):
+        """Downloads the entry `key` from the remote store to `path`.
+        Returns whether it was found."""
+        try:
+            return self.manager.remote.get(self.name, key, path)
+        except (objectstore.ObjectStoreError, OSError,
+                http.client.HTTPException) as error:
+            logger.warning(
+                'Reading %s/%s from the remote store failed: %s',
+                self.name, key, error)
+            remove_path(path)
+            return False
+
+    def write_back(self, key, path):
+        """Uploads the entry `key` at `path` to the remote store."""
+        try:
+            self.manager.remote.put(self.name, key, path)
+        except (objectstore.ObjectStoreError, OSError,
+                http.client.HTTPException) as error:
+            logger.warning(
+                'Writing %s/%s to the remote store failed: %s',
+                self.name, key, error)
+
+    def evict(self, key):
+        """Removes the entry `key`, unless it is pinned. Returns whether
+        it was removed."""
+        lock_path = self.get_lock_path(key)
+        stream = lock_entry(lock_path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if stream is None:
+            return False
+        try:
+            remove_path(self.get_path(key))
+            os.unlink(lock_path)
+        finally:
+            stream.close()
+        return True
+
+
+class CacheManager:
+    """Manager of the caches in the cache directory at `path`.
+
+    :param size: budget of all the caches together, in bytes
+    :param budgets: dict of the budget of each cache, in bytes
+    :param remote: remote store shared with other hosts
+    """
+
+    def __init__(self, path=CACHE_DIR, size=None, budgets=None,
+                 remote=None):
+        self.path = path
+        self.size = size
+        self.budgets = budgets or {}
+        self.remote = remote
+        self.caches = {}
+
+    def register(self, name, budget=None):
+        """Returns the cache `name`, within its configured budget or
+        `budget`."""
+        if name not in self.caches:
+            self.caches[name] = Cache(
+                self, name, self.budgets.get(name, budget))
+        return self.caches[name]
+
+    def get_caches(self):
+        """Returns the registered caches and those found in the cache
+        directory."""
+        names = set(self.caches)
+        if os.path.isdir(self.path):
+            names.update(
+                name for name in os.listdir(self.path)
+                if os.path.isdir(os.path.join(self.path, name)))
+        return [self.register(name) for name in sorted(names)]
+
+    @contextmanager
+    def lock(self):
+        """Context manager: serializes the collections of the caches."""
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '.lock'), 'a') as stream:
+            fcntl.flock(stream, fcntl.LOCK_EX)
+            yield
+
+    def stats(self):
+        """Returns the entry count, size and budget of each cache, as a
+        list of (name, count, size, budget)."""
+        return [
+            (cache.name, len(entries),
+             sum(size for _, size, _ in entries), cache.budget)
+            for cache, entries in (
+                (cache, cache.entries()) for cache in self.get_caches())]
+
+    def evict(self, entries, budget):
+        """Evicts the least recently used of `entries`, a list of (cache,
+        key, size, last use), down to `budget` bytes, skipping the pinned
+        ones. Returns the number of bytes freed."""
+        entries.sort(key=lambda entry: entry[3])
+        total = sum(entry[2] for entry in entries)
+        freed = 0
+        for entry in list(entries):
+            if total <= budget:
+                break
+            cache, key, size, _ = entry
+            if cache.evict(key):
+                logger.info('Evicted %s/%s, %d bytes.', cache.name, key, size)
+                entries.remove(entry)
+                total -= size
+                freed += size
+        return freed
+
+    def collect(self):
+        """Evicts entries until every cache, and all of them together, are
+        within their budgets. Returns the number of bytes freed."""
+        freed = 0
+        with self.lock():
+            remaining = []
+            for cache in self.get_caches():
+                entries = [
+                    (cache, key, size, last_use)
+                    for key, size, last_use in cache.entries()]
+                if cache.budget is not None:
+                    freed += self.evict(entries, cache.budget)
+                remaining.extend(entries)
+            if self.size is not None:
+                freed += self.evict(remaining, self.size)
+        return freed
+
+    def purge(self, name=None):
+        """Evicts every entry not in use, of the cache `name` or of all
+        the caches. Returns the number of bytes freed."""
+        freed = 0
+        with self.lock():
+            for cache in self.get_caches():
+                if name is None or cache.name == name:
+                    freed += self.evict([
+                        (cache, key, size, last_use)
+                        for key, size, last_use in cache.entries()], -1)
+        return freed
+
+
+async def download(url, output_path, cache=None):
+    """Downloads `url` to `output_path`, through the downloads `cache`
+    when given."""
+    if cache is None:
+        await utils.subp_async(['wget', '-O', output_path, url])
+        return
+
+    async def create(path):
+        await utils.subp_async(['wget', '-O', path, url])
+
+    key = '%s-%s' % (
+        hashlib.sha256(url.encode('utf-8')).hexdigest()[:16],
+        os.path.basename(url))
+    with await cache.fetch(key, create) as entry:
+        await utils.to_thread(shutil.copyfile, entry.path, output_path)
@@ -0,0 +1,148 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Running commands inside a Linux root filesystem on the host."""
+
+import os
+import shutil
+import tempfile
+
+from mib import utils
+
+# Pseudo filesystems mounted into the root, as (type, source, target).
+PSEUDO_FILESYSTEMS = [
+    ('proc', 'proc', 'proc'),
+    ('sysfs', 'sysfs', 'sys'),
+    (None, '/dev', 'dev'),
+    ('devpts', 'devpts', 'dev/pts'),
+    ]
+
+
+def mount_pseudo(root):
+    """Mounts the pseudo filesystems into `root`, returning the mount
+    points for `umount_pseudo`."""
+    mounts = []
+    try:
+        for fs_type, source, target in PSEUDO_FILESYSTEMS:
+            path = os.path.join(root, target)
+            os.makedirs(path, exist_ok=True)
+            if fs_type is None:
+                utils.subp(['mount', '--bind', source, path])
+            else:
+                utils.subp(['mount', '-t', fs_type, source, path])
+            mounts.append(path)
+    except Exception:
+        umount_pseudo(mounts)
+        raise
+    return mounts
+
+
+def umount_pseudo(mounts):
+    """Unmounts the pseudo filesystems mounted by `mount_pseudo`."""
+    for path in reversed(mounts):
+        utils.subp(['umount', '--lazy', path])
+
+
+def copy_resolv_conf(root):
+    """Gives `root` the name resolution of the host, returning the
+    original resolv.conf for `restore_resolv_conf`, if any."""
+    path = os.path.join(root, 'etc', 'resolv.conf')
+    backup = None
+    if os.path.lexists(path):
+        backup = path + '.mib'
+        os.rename(path, backup)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    shutil.copyfile('/etc/resolv.conf', path)
+    return backup
+
+
+def restore_resolv_conf(root, backup):
+    """Restores the resolv.conf of `root` replaced by
+    `copy_resolv_conf`."""
+    path = os.path.join(root, 'etc', 'resolv.conf')
+    os.unlink(path)
+    if backup is not None:
+        os.rename(backup, path)
+
+
+def get_runner(runner='auto'):
+    """Returns the runner for commands in a root filesystem: 'nspawn' or
+    'chroot'. 'auto' prefers systemd-nspawn, when installed."""
+    if runner == 'auto':
+        return 'nspawn' if shutil.which('systemd-nspawn') else 'chroot'
+    return runner
+
+
+async def run(root, args, runner='chroot', **kwargs):
+    """Runs `args` inside `root`, taking the keyword arguments of
+    `utils.subp_async`.
+
+    With the 'chroot' runner the pseudo filesystems must be mounted into
+    `root` by the caller, systemd-nspawn sets up its own.
+    """
+    if runner == 'nspawn':
+        prefix = [
+            'systemd-nspawn', '--quiet', '--register=no',
+            '--directory=%s' % root,
+            ]
+    else:
+        prefix = ['chroot', root]
+    return await utils.subp_async(prefix + list(args), **kwargs)
+
+
+async def run_script(root, script, interpreter='/bin/sh', runner='chroot',
+                     **kwargs):
+    """Runs the `script` text inside `root`, with `interpreter` or, when
+    None, the interpreter of its '#!' line."""
+    tmp_dir = os.path.join(root, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    descriptor, path = tempfile.mkstemp(prefix='mib-script-', dir=tmp_dir)
+    try:
+        with os.fdopen(descriptor, 'w') as stream:
+            stream.write(script)
+        os.chmod(path, 0o755)
+        args = ['/tmp/%s' % os.path.basename(path)]
+        if interpreter is not None:
+            args.insert(0, interpreter)
+        return await run(root, args, runner=runner, **kwargs)
+    finally:
+        os.unlink(path)
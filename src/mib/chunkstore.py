@@ -0,0 +1,265 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Content-defined chunk store of the built images.
+
+Successive builds of an image differ in a small part of their bytes.
+The store splits each image into chunks whose boundaries depend on the
+content around them, so an insertion or deletion only changes the
+chunks it touches, and keeps every chunk once by its sha256. An index
+lists the chunks of each stored image, in order, to stream it back.
+
+Layout of the store::
+
+    chunks/<2 hex>/<sha256>
+    indexes/<image name>/<version>.json
+
+Boundaries are found where a marker byte pair is followed by a byte
+with its low bits clear. The marker is searched with bytes.find, which
+keeps chunking at memory speed; on compressed images, where every byte
+value is equally likely, chunks average `AVERAGE_CHUNK` bytes. Images
+written for the store are compressed with `gzip --rsyncable`, so the
+unchanged parts of an image compress to the same bytes.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MEBIBYTE = 1024 * 1024
+
+MARKER = b'\x4d\x42'
+MARKER_MASK = 0x0f
+AVERAGE_CHUNK = 65536 * (MARKER_MASK + 1)
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 8 * MEBIBYTE
+READ_SIZE = 8 * MEBIBYTE
+
+
+class ChunkStoreError(Exception):
+    """Error class for chunk store errors."""
+
+
+@contextmanager
+def lock(store, exclusive=False):
+    """Context manager: holds the lock of `store`. Adding images shares
+    it, removing them, which deletes chunks, holds it alone."""
+    os.makedirs(store, exist_ok=True)
+    with open(os.path.join(store, '.lock'), 'a') as stream:
+        fcntl.flock(stream, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def find_boundary(data, start, final=False):
+    """Returns the end of the chunk starting at `start` in `data`, or
+    None when more data is needed to find it."""
+    size = len(data)
+    pos = data.find(MARKER, start + MIN_CHUNK - len(MARKER) - 1)
+    while pos != -1:
+        end = pos + len(MARKER) + 1
+        if end - start > MAX_CHUNK:
+            break
+        if end > size:
+            return size if final else None
+        if not data[end - 1] & MARKER_MASK:
+            return end
+        pos = data.find(MARKER, pos + 1)
+    if size - start >= MAX_CHUNK:
+        return start + MAX_CHUNK
+    return size if final and size > start else None
+
+
+def iter_chunks(stream):
+    """Yields the content-defined chunks of the file object `stream`."""
+    data = b''
+    while True:
+        block = stream.read(READ_SIZE)
+        data += block
+        start = 0
+        while True:
+            end = find_boundary(data, start, final=not block)
+            if end is None:
+                break
+            yield data[start:end]
+            start = end
+        data = data[start:]
+        if not block:
+            return
+
+
+def get_chunk_path(store, digest):
+    """Returns the path of the chunk with `digest` in `store`."""
+    return os.path.join(store, 'chunks', digest[:2], digest)
+
+
+def get_index_path(store, name, version):
+    """Returns the path of the index of `name` at `version`."""
+    return os.path.join(store, 'indexes', name, version + '.json')
+
+
+def write_atomic(path, data):
+    """Writes `data` to `path`, as a whole or not at all."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(descriptor, 'wb') as stream:
+            stream.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def add(store, path, name=None, version=None):
+    """Stores the image at `path` and returns the path of its index.
+
+    :param name: image name, defaults to the file name of `path`
+    :param version: version of the image, defaults to the current UTC
+        time
+    """
+    name = name or os.path.basename(path)
+    version = version or time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    with lock(store):
+        digest = hashlib.sha256()
+        chunks = []
+        stored = 0
+        with open(path, 'rb') as stream:
+            for chunk in iter_chunks(stream):
+                digest.update(chunk)
+                chunk_digest = hashlib.sha256(chunk).hexdigest()
+                chunk_path = get_chunk_path(store, chunk_digest)
+                if not os.path.exists(chunk_path):
+                    write_atomic(chunk_path, chunk)
+                    stored += len(chunk)
+                chunks.append([chunk_digest, len(chunk)])
+        size = sum(chunk_size for _, chunk_size in chunks)
+        index_path = get_index_path(store, name, version)
+        write_atomic(index_path, json.dumps({
+            'name': name,
+            'version': version,
+            'size': size,
+            'sha256': digest.hexdigest(),
+            'chunks': chunks,
+            }, indent=1).encode('utf-8'))
+    logger.info(
+        'Stored %s version %s in %s: %d chunks, %d of %d bytes new.',
+        name, version, store, len(chunks), stored, size)
+    return index_path
+
+
+def read_index(store, name, version):
+    """Returns the index of `name` at `version`."""
+    try:
+        with open(get_index_path(store, name, version), 'r') as stream:
+            return json.load(stream)
+    except FileNotFoundError:
+        raise ChunkStoreError(
+            "No version %s of %s in %s." % (version, name, store))
+
+
+def list_images(store):
+    """Returns the stored images, as a dict of their sorted versions."""
+    images = {}
+    indexes_path = os.path.join(store, 'indexes')
+    if not os.path.isdir(indexes_path):
+        return images
+    for name in sorted(os.listdir(indexes_path)):
+        images[name] = sorted(
+            filename[:-len('.json')]
+            for filename in os.listdir(os.path.join(indexes_path, name))
+            if filename.endswith('.json'))
+    return images
+
+
+def restore(store, name, version, stream):
+    """Writes the image `name` at `version` to the file object
+    `stream`, verifying every chunk."""
+    index = read_index(store, name, version)
+    digest = hashlib.sha256()
+    for chunk_digest, _ in index['chunks']:
+        with open(get_chunk_path(store, chunk_digest), 'rb') as chunk_file:
+            chunk = chunk_file.read()
+        if hashlib.sha256(chunk).hexdigest() != chunk_digest:
+            raise ChunkStoreError("Chunk %s is corrupt." % chunk_digest)
+        digest.update(chunk)
+        stream.write(chunk)
+    if digest.hexdigest() != index['sha256']:
+        raise ChunkStoreError(
+            "Restored %s version %s does not match its index." % (
+                name, version))
+
+
+def remove(store, name, version):
+    """Removes the image `name` at `version`, and the chunks no other
+    image uses. Returns the number of bytes freed."""
+    with lock(store, exclusive=True):
+        return _remove(store, name, version)
+
+
+def _remove(store, name, version):
+    """Removes the image, with the lock of the store held."""
+    index = read_index(store, name, version)
+    os.unlink(get_index_path(store, name, version))
+    used = set()
+    for other_name, versions in list_images(store).items():
+        for other_version in versions:
+            other = read_index(store, other_name, other_version)
+            used.update(chunk_digest for chunk_digest, _ in other['chunks'])
+    freed = 0
+    for chunk_digest, chunk_size in index['chunks']:
+        if chunk_digest in used:
+            continue
+        used.add(chunk_digest)
+        try:
+            os.unlink(get_chunk_path(store, chunk_digest))
+        except FileNotFoundError:
+            continue
+        freed += chunk_size
+    return freed
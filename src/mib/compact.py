@@ -0,0 +1,124 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Compaction of the installed filesystem before packaging.
+
+Files deleted during the installation leave their data behind in the
+free space of the disk, where it compresses badly and defeats sparse
+handling of the disk image. The free space is discarded, punching holes
+in the disk image, or when discard does not reach the image it is
+overwritten with zeroes, which the conversion and tar make sparse.
+"""
+
+import logging
+import os
+
+from mib import utils
+
+logger = logging.getLogger(__name__)
+
+MEBIBYTE = 1024 * 1024
+
+ZERO_FILE = '.mib-zero-fill'
+
+
+def allocated_size(path):
+    """Returns the bytes allocated on the host to the file at `path`."""
+    return os.stat(path).st_blocks * 512
+
+
+async def trim(mount_path):
+    """Discards the free space of the filesystem at `mount_path`.
+
+    Returns False when the filesystem or device does not support it.
+    """
+    try:
+        out, _ = await utils.subp_async(
+            ['fstrim', '-v', mount_path], capture=True)
+    except utils.ProcessExecutionError:
+        return False
+    logger.info('%s', out.strip())
+    return True
+
+
+async def zero_fill(mount_path, durability='output'):
+    """Overwrites the free space of the filesystem at `mount_path` with
+    zeroes, returning the number of bytes written.
+
+    The filesystem is flushed with the 'full' `durability`.
+    """
+    path = os.path.join(mount_path, ZERO_FILE)
+    try:
+        # dd stops with an error once the filesystem is full.
+        await utils.subp_async([
+            'dd', 'if=/dev/zero', 'of=%s' % path, 'bs=4M',
+            ], rcs=[0, 1], capture=True)
+        size = os.path.getsize(path)
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+    if durability == 'full':
+        await utils.to_thread(utils.sync_filesystem, mount_path)
+    return size
+
+
+async def compact(disk_path, mount_path, durability='output'):
+    """Compacts the filesystem at `mount_path`, stored in the disk image
+    at `disk_path`.
+
+    :param durability: flush the zero fill with 'full'
+    """
+    name = os.path.basename(disk_path)
+    before = allocated_size(disk_path)
+    if await trim(mount_path):
+        after = allocated_size(disk_path)
+        if after < before:
+            logger.info(
+                'Compaction by discard reduced %s from %d MiB to %d MiB '
+                'allocated.', name, before // MEBIBYTE, after // MEBIBYTE)
+            return
+    # Discard is unsupported or did not reach the disk image, the zeroes
+    # are only made sparse when the image is packaged.
+    written = await zero_fill(mount_path, durability)
+    logger.info(
+        'Compaction zero filled %d MiB of free space in %s.',
+        written // MEBIBYTE, name)
@@ -0,0 +1,239 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Capture and parsing of the installer serial console."""
+
+import asyncio
+import json
+import logging
+import re
+import time
+from collections import OrderedDict, deque, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Escape sequences written by the installers text interface.
+ANSI_ESCAPE_REGEX = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+
+# Milestones printed by anaconda and the kernel on the serial console,
+# in the order the installation reaches them.
+INSTALL_PATTERNS = [
+    ('boot', re.compile(r'Starting installer|anaconda .* started')),
+    ('storage', re.compile(
+        r'Creating \S+ on /dev/|Generating updated storage configuration')),
+    ('download', re.compile(
+        r'Downloading (?:(?P<total>\d+) RPMs|packages)'
+        r'(?:.*\((?P<percent>\d+)%\))?')),
+    ('install', re.compile(
+        r'Installing (?P<package>\S+) \((?P<current>\d+)/(?P<total>\d+)\)')),
+    ('configure', re.compile(
+        r'Performing post-installation setup tasks|'
+        r'Configuring installed system')),
+    ('post', re.compile(r'Running post-installation scripts')),
+    ('complete', re.compile(r'Installation complete')),
+    ('poweroff', re.compile(r'reboot: Power down|Power down\.|System halted')),
+    ]
+
+# Stage in which every line of output is reported, as the kickstart
+# %post sections log their own progress to the console.
+VERBOSE_STAGE = 'post'
+
+ProgressEvent = namedtuple(
+    'ProgressEvent', ['timestamp', 'stage', 'message', 'current', 'total'])
+
+
+class ProgressParser:
+    """Turns installer console output into `ProgressEvent`s, keeping
+    track of how long each stage of the installation took."""
+
+    def __init__(self, patterns=None):
+        if patterns is None:
+            patterns = INSTALL_PATTERNS
+        self.patterns = patterns
+        self.stage = None
+        self.stage_started = None
+        self.durations = OrderedDict()
+
+    def feed(self, line, timestamp=None):
+        """Parses a single line of console output.
+
+        :returns: `ProgressEvent` or None when the line is no milestone.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        line = ANSI_ESCAPE_REGEX.sub('', line).strip()
+        if not line:
+            return None
+        for stage, regex in self.patterns:
+            match = regex.search(line)
+            if match is None:
+                continue
+            groups = match.groupdict()
+            current = groups.get('current')
+            total = groups.get('total')
+            if groups.get('percent') is not None:
+                current, total = groups['percent'], 100
+            self.enter_stage(stage, timestamp)
+            return ProgressEvent(
+                timestamp, stage, line,
+                int(current) if current is not None else None,
+                int(total) if total is not None else None)
+        if self.stage == VERBOSE_STAGE:
+            return ProgressEvent(timestamp, self.stage, line, None, None)
+        return None
+
+    def enter_stage(self, stage, timestamp):
+        """Records the move into `stage` at `timestamp`."""
+        if stage == self.stage:
+            return
+        self.finish(timestamp)
+        self.stage = stage
+        self.stage_started = timestamp
+
+    def finish(self, timestamp=None):
+        """Closes the current stage, adding it to the durations."""
+        if self.stage is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        self.durations[self.stage] = (
+            self.durations.get(self.stage, 0) +
+            timestamp - self.stage_started)
+        self.stage = None
+        self.stage_started = None
+
+
+class ConsoleFollower:  # pylint: disable=too-many-instance-attributes
+    """Follows the serial console log while the VM writes it.
+
+    New output is parsed into progress events, which are handed to the
+    registered callbacks and optionally recorded as JSON lines in
+    `progress_path`. The tail of the console is kept in memory.
+    """
+
+    def __init__(self, path, parser=None, progress_path=None,
+                 interval=1, tail_lines=100):
+        self.path = path
+        self.parser = parser if parser is not None else ProgressParser()
+        self.progress_path = progress_path
+        self.interval = interval
+        self.callbacks = []
+        self.lines = deque(maxlen=tail_lines)
+        self.last_activity = time.time()
+        self.stream = None
+        self.progress = None
+        self.buffer = b''
+
+    def add_callback(self, callback):
+        """Calls `callback(event)` for every progress event."""
+        self.callbacks.append(callback)
+
+    def tail(self):
+        """Returns the last lines of console output."""
+        return list(self.lines)
+
+    def read(self):
+        """Reads and parses the output written since the last call."""
+        if self.stream is None:
+            try:
+                self.stream = open(self.path, 'rb')
+            except FileNotFoundError:
+                return
+        data = self.stream.read()
+        if not data:
+            return
+        now = time.time()
+        self.last_activity = now
+        self.buffer += data.replace(b'\r', b'\n')
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            line = line.decode('utf-8', 'replace')
+            if line.strip():
+                self.lines.append(line)
+            event = self.parser.feed(line, now)
+            if event is not None:
+                self.handle_event(event)
+
+    def handle_event(self, event):
+        """Records `event` and hands it to the callbacks."""
+        if self.progress_path is not None:
+            if self.progress is None:
+                self.progress = open(self.progress_path, 'w')
+            self.progress.write(json.dumps(event._asdict()) + '\n')
+            self.progress.flush()
+        for callback in self.callbacks:
+            callback(event)
+
+    async def follow(self):
+        """Reads the console every `interval` seconds until cancelled."""
+        while True:
+            self.read()
+            await asyncio.sleep(self.interval)
+
+    def close(self):
+        """Reads any remaining output and closes the stage timings."""
+        self.read()
+        self.parser.finish()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if self.progress is not None:
+            self.progress.close()
+            self.progress = None
+
+
+def log_progress(event):
+    """Callback that logs the milestones of the installation."""
+    if event.current is not None and event.total is not None:
+        logger.info(
+            '[%s %d/%d] %s', event.stage, event.current, event.total,
+            event.message)
+    else:
+        logger.info('[%s] %s', event.stage, event.message)
+
+
+def log_durations(parser):
+    """Logs how long each stage of the installation took."""
+    if parser.durations:
+        logger.info('Installation stage durations: %s', ', '.join(
+            '%s %ds' % (stage, duration)
+            for stage, duration in parser.durations.items()))
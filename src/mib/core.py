@@ -49,14 +49,28 @@ import traceback
 
 from stevedore.extension import ExtensionManager
 
-from mib.parser import load_parser
+from mib import cache, chunkstore, manifest, objectstore, utils
+from mib.parser import (
+    load_cache_parser,
+    load_manifest_parser,
+    load_parser,
+    load_store_parser
+)
 
-# Enable basic logging to console.
-logging.basicConfig()
+# Enable basic logging to console, including the build progress.
+logging.basicConfig(level=logging.INFO)
 
 
 def execute():
     """Main execution of the application."""
+    # The cache commands take none of the build options.
+    if sys.argv[1:2] == ['cache']:
+        execute_cache(sys.argv[2:])
+
+    # Nor do the manifest commands, which need no privileges.
+    if sys.argv[1:2] == ['manifest']:
+        execute_manifest(sys.argv[2:])
+
     # Check that have root privledges
     if os.geteuid() != 0:
         print('Error: must run with root privileges.')
@@ -81,6 +95,33 @@ def execute():
             dirpath))
         sys.exit(1)
 
+    # The simplestreams entries refer to the outputs inside the tree.
+    if args.simplestreams is not None:
+        args.simplestreams = os.path.abspath(args.simplestreams)
+        if not args.output.startswith(args.simplestreams + os.sep):
+            print('Error: the output must be inside the simplestreams '
+                  'tree: %s' % args.simplestreams)
+            sys.exit(1)
+
+    # The remote cache is checked before building.
+    if args.cache_remote is not None and not args.no_cache:
+        try:
+            objectstore.ObjectStore(
+                args.cache_remote, region=args.cache_remote_region)
+        except objectstore.ObjectStoreError as error:
+            print('Error: %s' % error)
+            sys.exit(1)
+
+    # Deterministic outputs are dated with the source date epoch.
+    if args.deterministic and args.source_date_epoch is None:
+        print('Error: --deterministic requires --source-date-epoch or '
+              'SOURCE_DATE_EPOCH to be set.')
+        sys.exit(1)
+
+    # Every resource of the build is namespaced under its id.
+    if args.build_id is None:
+        args.build_id = utils.new_build_id()
+
     # Build the image.
     builder = builders[args.builder]
     try:
@@ -92,3 +133,71 @@ def execute():
         sys.exit(1)
 
     sys.exit(0)
+
+
+def execute_cache(argv=None):
+    """Main execution of the cache commands."""
+    args = load_cache_parser().parse_args(argv)
+    manager = cache.get_manager(args)
+    try:
+        if args.command == 'stats':
+            stats = manager.stats()
+            for name, count, size, budget in stats:
+                print('%s: %d entries, %d MiB of %s' % (
+                    name, count, size // cache.MEBIBYTE,
+                    'unbounded' if budget is None else
+                    '%d MiB' % (budget // cache.MEBIBYTE)))
+            print('total: %d MiB of %d MiB' % (
+                sum(size for _, _, size, _ in stats) // cache.MEBIBYTE,
+                manager.size // cache.MEBIBYTE))
+        elif args.command == 'gc':
+            print('Freed %d bytes.' % manager.collect())
+        elif args.command == 'purge':
+            print('Freed %d bytes.' % manager.purge(args.cache))
+    except (cache.CacheError, OSError) as error:
+        print('Error: %s' % error, file=sys.stderr)
+        sys.exit(1)
+    sys.exit(0)
+
+
+def execute_manifest(argv=None):
+    """Main execution of the manifest commands."""
+    args = load_manifest_parser().parse_args(argv)
+    try:
+        if args.command == 'diff':
+            old = manifest.read_manifest(args.old)
+            new = manifest.read_manifest(args.new)
+            for line in manifest.format_diff(old, new):
+                print(line)
+    except (OSError, ValueError) as error:
+        print('Error: %s' % error, file=sys.stderr)
+        sys.exit(1)
+    sys.exit(0)
+
+
+def execute_store():
+    """Main execution of the chunk store commands."""
+    args = load_store_parser().parse_args()
+    try:
+        if args.command == 'add':
+            chunkstore.add(
+                args.store, args.path, name=args.name, version=args.version)
+        elif args.command == 'list':
+            for name, versions in chunkstore.list_images(args.store).items():
+                for version in versions:
+                    print('%s %s' % (name, version))
+        elif args.command == 'restore':
+            if args.output == '-':
+                chunkstore.restore(
+                    args.store, args.name, args.version, sys.stdout.buffer)
+            else:
+                with open(args.output, 'wb') as stream:
+                    chunkstore.restore(
+                        args.store, args.name, args.version, stream)
+        elif args.command == 'remove':
+            freed = chunkstore.remove(args.store, args.name, args.version)
+            print('Freed %d bytes.' % freed)
+    except (chunkstore.ChunkStoreError, OSError) as error:
+        print('Error: %s' % error, file=sys.stderr)
+        sys.exit(1)
+    sys.exit(0)
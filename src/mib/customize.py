@@ -0,0 +1,127 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Customization of Linux root filesystems with user scripts.
+
+Scripts run inside the root filesystem of the image, under
+systemd-nspawn or in a chroot, so they can install packages, rebuild
+the initramfs or edit the configuration as on the installed system.
+The files they write are then labelled with the SELinux policy of the
+image, as the installer labels its files.
+"""
+
+import logging
+import os
+
+from mib import chroot, utils
+
+logger = logging.getLogger(__name__)
+
+
+class CustomizeError(Exception):
+    """Exception raised when the root filesystem cannot be customized."""
+
+
+def read_selinux_config(root):
+    """Returns the settings of the SELinux configuration of `root`."""
+    settings = {}
+    config = os.path.join(root, 'etc', 'selinux', 'config')
+    if os.path.exists(config):
+        with open(config, 'r') as stream:
+            for line in stream:
+                key, sep, value = line.strip().partition('=')
+                if sep and not key.startswith('#'):
+                    settings[key] = value
+    return settings
+
+
+async def label_selinux(root):
+    """Labels the files of `root` with the SELinux policy installed in
+    it, unless SELinux is disabled.
+
+    Labelling at build time spares the image a relabel on first boot.
+    """
+    settings = read_selinux_config(root)
+    if settings.get('SELINUX', 'disabled') == 'disabled':
+        return
+    file_contexts = os.path.join(
+        root, 'etc', 'selinux', settings.get('SELINUXTYPE', 'targeted'),
+        'contexts', 'files', 'file_contexts')
+    if not os.path.exists(file_contexts):
+        raise CustomizeError(
+            "SELinux is enabled but no policy is installed: %s." % (
+                file_contexts))
+    await utils.subp_async(['setfiles', '-r', root, file_contexts, root])
+
+
+async def customize(root, scripts, runner='auto', relabel=True):
+    """Runs each of `scripts` inside the root filesystem at `root`, in
+    order.
+
+    :param runner: 'nspawn', 'chroot' or 'auto'
+    :param relabel: label the files with SELinux afterwards
+    :raises ProcessExecutionError: when a script fails
+    :raises CustomizeError: when the files cannot be labelled
+    """
+    runner = chroot.get_runner(runner)
+    mounts = []
+    if runner == 'chroot':
+        mounts = await utils.to_thread(chroot.mount_pseudo, root)
+    try:
+        resolv_conf = chroot.copy_resolv_conf(root)
+        try:
+            for path in scripts:
+                logger.info(
+                    'Running customization script %s with %s.', path, runner)
+                with open(path, 'r') as stream:
+                    script = stream.read()
+                interpreter = None
+                if not script.startswith('#!'):
+                    interpreter = '/bin/sh'
+                await chroot.run_script(
+                    root, script, interpreter=interpreter, runner=runner)
+        finally:
+            chroot.restore_resolv_conf(root, resolv_conf)
+    finally:
+        await utils.to_thread(chroot.umount_pseudo, mounts)
+    if relabel:
+        await label_selinux(root)
@@ -0,0 +1,380 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Event-driven lifecycle management of build virtual machines.
+
+Virtual machines are started without blocking and then followed through
+their event streams: QMP for qemu processes spawned directly, and
+`virsh event` for domains created through libvirt. A `VMDriver` reads
+every stream from the asyncio event loop, so any number of virtual
+machines can be followed from one process without a thread per machine.
+"""
+
+import asyncio
+import os
+import re
+import subprocess
+import time
+from abc import ABCMeta, abstractmethod
+
+from mib import utils
+from mib.qmp import QMPClient
+
+# Lifecycle events reported for a domain.
+SHUTDOWN = 'shutdown'
+REBOOT = 'reboot'
+CRASHED = 'crashed'
+DESTROYED = 'destroyed'
+
+# Events after which the domain is no longer running.
+FINAL_EVENTS = (SHUTDOWN, CRASHED, DESTROYED)
+
+VIRSH_EVENT_REGEX = re.compile(
+    r"^event '(?P<event>[\w-]+)' for domain '?(?P<domain>[^':]+)'?:?"
+    r"\s*(?P<detail>.*)$")
+
+
+class VMError(Exception):
+    """Exception raised when a virtual machine fails."""
+
+
+class Domain(metaclass=ABCMeta):
+    """Virtual machine followed by the `VMDriver`."""
+
+    def __init__(self, name):
+        self.name = name
+        self.events = []
+        self.result = None
+        self.callbacks = []
+
+    @property
+    def finished(self):
+        """True once the virtual machine is no longer running."""
+        return self.result is not None
+
+    def add_callback(self, callback):
+        """Calls `callback(domain, event)` for every lifecycle event."""
+        self.callbacks.append(callback)
+
+    def emit(self, event):
+        """Records the lifecycle `event` for this domain."""
+        if self.finished:
+            return
+        self.events.append((time.time(), event))
+        if event in FINAL_EVENTS:
+            self.result = event
+        for callback in self.callbacks:
+            callback(self, event)
+
+    @abstractmethod
+    async def destroy(self):
+        """Forcibly stops the virtual machine."""
+
+
+class QemuDomain(Domain):
+    """Domain for a qemu process spawned directly, followed through QMP."""
+
+    def __init__(self, name, args, qmp_path):
+        super().__init__(name)
+        self.args = list(args) + [
+            '-qmp', 'unix:%s,server,nowait' % qmp_path]
+        self.qmp = QMPClient(qmp_path)
+        self.process = None
+
+    async def start(self):
+        """Spawns qemu and connects to its QMP socket."""
+        try:
+            self.process = subprocess.Popen(
+                self.args, stdin=subprocess.DEVNULL)
+        except OSError as exc:
+            raise utils.ProcessExecutionError(cmd=self.args, reason=exc)
+        try:
+            await self.qmp.connect()
+        except BaseException:
+            self.qmp.close()
+            self.process.kill()
+            await utils.to_thread(self.process.wait)
+            raise
+
+    def fileno(self):
+        """Returns the file descriptor of the QMP socket."""
+        return self.qmp.fileno()
+
+    def handle_readable(self):
+        """Dispatches the pending QMP events.
+
+        :returns: False once qemu has closed the QMP connection.
+        """
+        events = self.qmp.read_events()
+        if events is None:
+            return False
+        for message in events:
+            name = message['event']
+            data = message.get('data', {})
+            if name == 'SHUTDOWN':
+                if data.get('reason') == 'guest-panic':
+                    self.emit(CRASHED)
+                elif not data.get('guest', True):
+                    self.emit(DESTROYED)
+                else:
+                    self.emit(SHUTDOWN)
+            elif name == 'RESET':
+                self.emit(REBOOT)
+            elif name == 'GUEST_PANICKED':
+                self.emit(CRASHED)
+        return True
+
+    async def close(self):
+        """Closes QMP and reaps the qemu process."""
+        self.qmp.close()
+        if self.process is not None:
+            if self.result in (CRASHED, DESTROYED) and (
+                    self.process.poll() is None):
+                # A panicked guest may be left paused, qemu would not
+                # exit by itself.
+                self.process.kill()
+            return_code = await utils.to_thread(self.process.wait)
+            self.emit(SHUTDOWN if return_code == 0 else CRASHED)
+
+    async def destroy(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            await utils.to_thread(self.process.wait)
+        self.emit(DESTROYED)
+
+
+class LibvirtDomain(Domain):
+    """Domain managed by libvirt, followed through `LibvirtEvents`."""
+
+    async def destroy(self):
+        try:
+            await utils.subp_async(['virsh', 'destroy', self.name])
+        except utils.ProcessExecutionError:
+            # Domain is already stopped.
+            pass
+        self.emit(DESTROYED)
+
+
+class LibvirtEvents:
+    """Single `virsh event` stream shared by the libvirt domains of a
+    `VMDriver`."""
+
+    def __init__(self):
+        self.domains = {}
+        self.buffer = b''
+        self.process = None
+
+    def start(self):
+        """Spawns `virsh event` to follow all the domains."""
+        args = ['stdbuf', '-oL', 'virsh', 'event', '--all', '--loop']
+        try:
+            self.process = subprocess.Popen(
+                args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        except OSError as exc:
+            raise utils.ProcessExecutionError(cmd=args, reason=exc)
+        os.set_blocking(self.process.stdout.fileno(), False)
+
+    def fileno(self):
+        """Returns the file descriptor of the event stream."""
+        return self.process.stdout.fileno()
+
+    def handle_readable(self):
+        """Dispatches the pending events to their domains.
+
+        :returns: False once `virsh event` has exited.
+        """
+        try:
+            data = os.read(self.fileno(), 4096)
+        except BlockingIOError:
+            return True
+        if not data:
+            return False
+        self.buffer += data
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            self.handle_line(line.decode('utf-8', 'replace').strip())
+        return True
+
+    def handle_line(self, line):
+        """Dispatches a single line of `virsh event` output."""
+        match = VIRSH_EVENT_REGEX.match(line)
+        if match is None:
+            return
+        domain = self.domains.get(match.group('domain'))
+        if domain is None:
+            return
+        event = match.group('event')
+        detail = match.group('detail')
+        if event == 'reboot':
+            domain.emit(REBOOT)
+        elif event == 'lifecycle':
+            if detail.startswith('Crashed') or detail in (
+                    'Stopped Crashed', 'Stopped Failed'):
+                domain.emit(CRASHED)
+            elif detail == 'Stopped Destroyed':
+                domain.emit(DESTROYED)
+            elif detail.startswith('Stopped'):
+                domain.emit(SHUTDOWN)
+
+    async def close(self):
+        """Stops following events."""
+        if self.process is not None:
+            process, self.process = self.process, None
+            process.terminate()
+            await utils.to_thread(process.wait)
+            process.stdout.close()
+        for domain in self.domains.values():
+            if not domain.finished:
+                domain.emit(CRASHED)
+
+
+class VMDriver:
+    """Starts virtual machines and dispatches their lifecycle events.
+
+    Event streams are read from the asyncio event loop, without a thread
+    per virtual machine. Each build has its own driver, and so its own
+    `virsh event` stream.
+    """
+
+    def __init__(self, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.domains = []
+        self.libvirt = None
+        self.closing = []
+
+    def add_source(self, source):
+        """Dispatches events from `source` whenever it becomes readable."""
+        self.loop.add_reader(source.fileno(), self.dispatch, source)
+
+    def remove_source(self, source):
+        """Stops reading from `source`."""
+        self.loop.remove_reader(source.fileno())
+
+    def dispatch(self, source):
+        """Reads the pending events from `source`."""
+        if not source.handle_readable():
+            self.remove_source(source)
+            # Closing reaps the process, without blocking the loop.
+            self.closing.append(asyncio.ensure_future(source.close()))
+            if source is self.libvirt:
+                self.libvirt = None
+
+    async def start_qemu(self, name, args, qmp_path):
+        """Spawns qemu with `args`, following it over QMP at `qmp_path`."""
+        domain = QemuDomain(name, args, qmp_path)
+        await domain.start()
+        self.add_source(domain)
+        # Events read along with the capabilities reply are already
+        # buffered, the socket would not become readable for them.
+        self.loop.call_soon(self.dispatch, domain)
+        self.domains.append(domain)
+        return domain
+
+    def watch_libvirt(self, name):
+        """Follows the libvirt domain `name`.
+
+        Must be called before the domain is started, so that no event
+        can be missed.
+        """
+        if self.libvirt is None:
+            self.libvirt = LibvirtEvents()
+            self.libvirt.start()
+            self.add_source(self.libvirt)
+        domain = LibvirtDomain(name)
+        self.libvirt.domains[name] = domain
+        self.domains.append(domain)
+        return domain
+
+    async def wait(self, domain, timeout=None):
+        """Waits for `domain` to shut down, then stops following it.
+
+        Cancelling the wait destroys the domain.
+
+        :param timeout: seconds to wait before raising `VMError`.
+        :raises VMError: when the domain did not shut down cleanly.
+        """
+        try:
+            if not domain.finished:
+                finished = self.loop.create_future()
+
+                def on_event(domain, _):
+                    if domain.finished and not finished.done():
+                        finished.set_result(domain.result)
+
+                domain.add_callback(on_event)
+                try:
+                    await asyncio.wait_for(finished, timeout)
+                except asyncio.TimeoutError:
+                    raise VMError('Timed out waiting for %s.' % domain.name)
+        finally:
+            await self.release(domain)
+        if domain.result != SHUTDOWN:
+            raise VMError(
+                'Virtual machine %s did not shut down cleanly: %s.' % (
+                    domain.name, domain.result))
+
+    async def release(self, domain):
+        """Stops following `domain`, destroying it if still running."""
+        if not domain.finished:
+            await domain.destroy()
+        if isinstance(domain, QemuDomain):
+            if domain.qmp.sock is not None:
+                self.remove_source(domain)
+            await domain.close()
+        elif self.libvirt is not None:
+            self.libvirt.domains.pop(domain.name, None)
+        if domain in self.domains:
+            self.domains.remove(domain)
+
+    async def close(self):
+        """Releases every domain and stops following events."""
+        for domain in list(self.domains):
+            await self.release(domain)
+        if self.libvirt is not None:
+            self.remove_source(self.libvirt)
+            await self.libvirt.close()
+            self.libvirt = None
+        closing, self.closing = self.closing, []
+        if closing:
+            await asyncio.wait(closing)
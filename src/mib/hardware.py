@@ -0,0 +1,218 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Virtual hardware profiles for the installation VMs."""
+
+import os
+import platform
+import re
+from functools import lru_cache
+
+from mib import utils
+
+# Default location of the virtio-win drivers ISO.
+VIRTIO_WIN_ISO = '/usr/share/virtio-win/virtio-win.iso'
+
+
+def parse_version(output):
+    """Returns the first version number in `output` as a tuple."""
+    match = re.search(r'(\d+)\.(\d+)', output or '')
+    if match is None:
+        return (0, 0)
+    return (int(match.group(1)), int(match.group(2)))
+
+
+@lru_cache()
+def get_tool_version(tool):
+    """Returns the version of `tool`, from `tool --version`."""
+    try:
+        out, _ = utils.subp([tool, '--version'], capture=True)
+    except utils.ProcessExecutionError:
+        return (0, 0)
+    return parse_version(out)
+
+
+def has_kvm():
+    """Returns True when the host can run accelerated VMs."""
+    return os.path.exists('/dev/kvm')
+
+
+def supports_io_uring(libvirt=True):
+    """Returns True when both the kernel and qemu, and libvirt when used,
+    support io_uring for disk I/O."""
+    if parse_version(platform.release()) < (5, 1):
+        return False
+    if get_tool_version('qemu-img') < (5, 0):
+        return False
+    if libvirt and get_tool_version('virsh') < (6, 3):
+        return False
+    return True
+
+
+class HardwareProfile:
+    """Virtual hardware used by an installation VM.
+
+    :param disk_bus: 'virtio-blk', 'virtio-scsi' or 'ide'
+    :param disk_cache: qemu cache mode for the install disk
+    :param disk_io: qemu aio mode for the install disk
+    :param queues: number of virtio disk queues
+    :param cpu_mode: 'host-passthrough' or None for the default model
+    :param nic_model: model of the network card
+    :param headless: run without any display
+    """
+
+    def __init__(self, disk_bus='ide', disk_cache=None, disk_io=None,
+                 queues=None, cpu_mode=None, nic_model='rtl8139',
+                 headless=False):
+        self.disk_bus = disk_bus
+        self.disk_cache = disk_cache
+        self.disk_io = disk_io
+        self.queues = queues
+        self.cpu_mode = cpu_mode
+        self.nic_model = nic_model
+        self.headless = headless
+
+    @property
+    def virtio(self):
+        """True when the guest needs virtio drivers."""
+        return self.disk_bus.startswith('virtio')
+
+    def virt_install_disk(self, path, disk_format='raw'):
+        """Returns the virt-install --disk value for the install disk."""
+        options = ['path=%s' % path, 'format=%s' % disk_format]
+        if self.disk_bus == 'virtio-scsi':
+            options.append('bus=scsi')
+        elif self.disk_bus == 'virtio-blk':
+            options.append('bus=virtio')
+        if self.disk_cache is not None:
+            options.append('cache=%s' % self.disk_cache)
+        if self.disk_io is not None:
+            options.append('io=%s' % self.disk_io)
+        if (self.queues is not None and
+                get_tool_version('virt-install') >= (2, 2)):
+            options.append('driver.queues=%d' % self.queues)
+        return ','.join(options)
+
+    def virt_install_args(self):
+        """Returns the extra virt-install arguments for this profile."""
+        args = []
+        if self.disk_bus == 'virtio-scsi':
+            controller = 'type=scsi,model=virtio-scsi'
+            if self.queues is not None:
+                controller += ',driver.queues=%d' % self.queues
+            args.extend(['--controller', controller])
+        if self.cpu_mode is not None:
+            args.extend(['--cpu', self.cpu_mode])
+        return args
+
+    def qemu_disk_args(self, path, disk_format='raw'):
+        """Returns the qemu arguments attaching the install disk."""
+        drive = 'file=%s,format=%s' % (path, disk_format)
+        if self.disk_cache is not None:
+            drive += ',cache=%s' % self.disk_cache
+        if self.disk_io is not None:
+            drive += ',aio=%s' % self.disk_io
+        if self.disk_bus == 'ide':
+            return ['-drive', '%s,index=0,if=ide,media=disk' % drive]
+        args = ['-drive', '%s,if=none,id=disk0' % drive]
+        if self.disk_bus == 'virtio-scsi':
+            controller = 'virtio-scsi-pci,id=scsi0'
+            if self.queues is not None:
+                controller += ',num_queues=%d' % self.queues
+            args.extend([
+                '-device', controller,
+                '-device', 'scsi-hd,drive=disk0,bus=scsi0.0',
+                ])
+        else:
+            device = 'virtio-blk-pci,drive=disk0'
+            if self.queues is not None:
+                device += ',num-queues=%d' % self.queues
+            args.extend(['-device', device])
+        return args
+
+    def qemu_args(self):
+        """Returns the qemu arguments for the cpu and display."""
+        args = []
+        if self.cpu_mode == 'host-passthrough':
+            args.extend(['-cpu', 'host'])
+        if self.headless:
+            args.extend(['-display', 'none'])
+        return args
+
+
+def select_profile(vcpus, disk_bus='virtio-blk', virtio=True,
+                   libvirt=True):
+    """Returns the fastest profile the host supports.
+
+    :param vcpus: number of vcpus, used for the disk queues
+    :param disk_bus: virtio bus to use for the install disk
+    :param virtio: False when the guest has no virtio drivers
+    :param libvirt: True when the VM is started through libvirt
+    """
+    if not virtio:
+        disk_bus = 'ide'
+    return HardwareProfile(
+        disk_bus=disk_bus,
+        # The install disk is thrown away when the build fails, so guest
+        # flushes do not need to reach the host storage.
+        disk_cache='unsafe',
+        disk_io='io_uring' if supports_io_uring(libvirt) else None,
+        queues=vcpus if virtio and vcpus > 1 else None,
+        cpu_mode='host-passthrough' if has_kvm() else None,
+        nic_model='virtio' if virtio else 'rtl8139',
+        headless=True)
+
+
+def legacy_profile(disk_cache=None):
+    """Returns the profile using only emulated hardware."""
+    return HardwareProfile(disk_cache=disk_cache)
+
+
+async def flush_install_disk(profile, disk_path, durability='output'):
+    """Flushes the writes to the install disk at `disk_path` that the VM
+    left in the host page cache, with the 'full' `durability`.
+
+    The host reads the disk through the same page cache, the flush only
+    makes the scratch disk survive a crash of the host.
+    """
+    if profile.disk_cache == 'unsafe' and durability == 'full':
+        await utils.to_thread(utils.sync_file, disk_path)
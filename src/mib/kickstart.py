@@ -0,0 +1,192 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Kickstart composition for the anaconda based builders."""
+
+import re
+import shlex
+
+# Mount options of '/' while the installer writes to it. Barriers and
+# frequent journal commits only protect against a host crash, after which
+# the install disk is thrown away anyway.
+FAST_INSTALL_FSOPTIONS = 'nobarrier,commit=300'
+
+# Leave inode table and journal initialisation to the kernel, instead of
+# writing them out at mkfs time. Only the files end up in the image, so
+# the filesystem is never initialised at all.
+FAST_INSTALL_MKFSOPTIONS = '-E lazy_itable_init=1,lazy_journal_init=1'
+
+# Restores the default mount options of '/' in the installed system.
+FAST_INSTALL_POST = (
+    "\n"
+    "%%post --log=/dev/ttyS0\n"
+    "sed -i 's/%s/defaults/' /etc/fstab\n"
+    "%%end\n" % FAST_INSTALL_FSOPTIONS)
+
+ROOT_PART_REGEX = re.compile(r'^part\s+/\s')
+
+
+def fast_install_part(line, mkfs_options=True):
+    """Adds the fast install options to a 'part /' line."""
+    line = line.rstrip('\n')
+    line += ' --fsoptions="%s"' % FAST_INSTALL_FSOPTIONS
+    if mkfs_options:
+        line += ' --mkfsoptions="%s"' % FAST_INSTALL_MKFSOPTIONS
+    return line + '\n'
+
+
+def compose_kickstart(output_path, paths, fast_install=False,
+                      mkfs_options=True):
+    """Writes the kickstart at `output_path`, concatenating the kickstart
+    files at `paths`.
+
+    With `fast_install` the root partition is created and mounted for
+    speed over durability. `mkfs_options` is False for installers that
+    do not support --mkfsoptions.
+    """
+    with open(output_path, 'w') as output:
+        for ks_file_path in paths:
+            if len(paths) > 1:
+                output.write('#\n# From %s\n#\n\n' % ks_file_path)
+            with open(ks_file_path, 'r') as ks_file:
+                for line in ks_file:
+                    if fast_install and ROOT_PART_REGEX.match(line):
+                        line = fast_install_part(line, mkfs_options)
+                    output.write(line)
+        if fast_install:
+            output.write(FAST_INSTALL_POST)
+
+
+# Options of the commands read by the builders that take no value.
+FLAG_OPTIONS = {
+    '--enabled', '--disabled', '--enforcing', '--permissive', '--isUtc',
+    '--iscrypted', '--plaintext', '--lock', '--onboot', '--nochroot',
+    '--erroronfail', '--nobase', '--utc',
+    }
+
+
+class Kickstart:
+    """Parsed kickstart: its commands, package selection and scripts.
+
+    :ivar commands: list of (command, arguments) in file order
+    :ivar packages: packages and @groups to install
+    :ivar excludes: packages excluded with '-'
+    :ivar scripts: list of (section, options, body), such as '%post'
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.packages = []
+        self.excludes = []
+        self.scripts = []
+
+    def get_commands(self, name):
+        """Returns the arguments of every `name` command."""
+        return [args for command, args in self.commands if command == name]
+
+    def get_command(self, name):
+        """Returns the arguments of the last `name` command, or None."""
+        commands = self.get_commands(name)
+        return commands[-1] if commands else None
+
+
+def get_option(args, name, default=None):
+    """Returns the value of option `name` in a kickstart command's `args`,
+    True for a flag, or `default` when it is not given."""
+    for index, arg in enumerate(args):
+        if arg == name:
+            if name in FLAG_OPTIONS:
+                return True
+            if index + 1 < len(args) and not args[index + 1].startswith('-'):
+                return args[index + 1]
+            return True
+        if arg.startswith(name + '='):
+            return arg[len(name) + 1:]
+    return default
+
+
+def get_positional(args):
+    """Returns the arguments of a kickstart command that are not options
+    or their values."""
+    positional = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg.startswith('-'):
+            # Options without '=' may take the next argument as value.
+            skip = '=' not in arg and arg not in FLAG_OPTIONS
+        else:
+            positional.append(arg)
+    return positional
+
+
+def parse_kickstart(paths):
+    """Parses the concatenation of the kickstart files at `paths`."""
+    kickstart = Kickstart()
+    section = None
+    for ks_file_path in paths:
+        with open(ks_file_path, 'r') as ks_file:
+            for line in ks_file:
+                stripped = line.strip()
+                if section is not None:
+                    if stripped == '%end':
+                        if section[0] != '%packages':
+                            kickstart.scripts.append(
+                                (section[0], section[1], ''.join(section[2])))
+                        section = None
+                    elif section[0] != '%packages':
+                        section[2].append(line)
+                    elif stripped and not stripped.startswith('#'):
+                        if stripped.startswith('-'):
+                            kickstart.excludes.append(stripped[1:])
+                        else:
+                            kickstart.packages.append(stripped)
+                elif not stripped or stripped.startswith('#'):
+                    continue
+                elif stripped.startswith('%'):
+                    tokens = shlex.split(stripped)
+                    section = (tokens[0], tokens[1:], [])
+                else:
+                    tokens = shlex.split(stripped)
+                    kickstart.commands.append((tokens[0], tokens[1:]))
+    return kickstart
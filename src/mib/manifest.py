@@ -0,0 +1,208 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Per-file manifests of the built images.
+
+The manifest lists every path of an image with its type, mode, owner,
+size, the sha256 of its content and its SELinux label, one JSON object
+per line in archive order, gzipped. It is written by the tar writer as
+it streams the files, or from the directory being packaged, so two
+builds can be compared, or searched for a file, without extracting
+them.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import stat
+import tarfile
+
+EXTENSION = '.manifest.gz'
+
+SELINUX_XATTR = 'security.selinux'
+
+TAR_TYPES = {
+    tarfile.REGTYPE: 'file',
+    tarfile.LNKTYPE: 'hardlink',
+    tarfile.DIRTYPE: 'directory',
+    tarfile.SYMTYPE: 'symlink',
+    tarfile.CHRTYPE: 'char',
+    tarfile.BLKTYPE: 'block',
+    tarfile.FIFOTYPE: 'fifo',
+    }
+
+# Read files being hashed in chunks of this size.
+CHUNK_SIZE = 1024 * 1024
+
+
+def iter_hashed(chunks, digest):
+    """Yields `chunks`, updating `digest` with each."""
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+class Manifest:
+    """Writes a manifest to the file at `path`."""
+
+    def __init__(self, path):
+        # No time stamp in the header, for deterministic builds.
+        self.fileobj = open(path, 'wb')
+        self.gzip = gzip.GzipFile(
+            filename='', mode='wb', fileobj=self.fileobj, mtime=0)
+        self.stream = io.TextIOWrapper(self.gzip, encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Finishes the manifest."""
+        self.stream.close()
+        self.fileobj.close()
+
+    def add(self, info, sha256=None):
+        """Adds the file described by the TarInfo `info`, with the
+        sha256 of its content for regular files."""
+        entry = {
+            'path': info.name,
+            'type': TAR_TYPES[info.type],
+            'mode': '%04o' % stat.S_IMODE(info.mode),
+            'uid': info.uid,
+            'gid': info.gid,
+            }
+        if info.type == tarfile.REGTYPE:
+            entry['size'] = info.size
+            entry['sha256'] = sha256
+        elif info.type in (tarfile.LNKTYPE, tarfile.SYMTYPE):
+            entry['link'] = info.linkname
+        elif info.type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+            entry['device'] = '%d:%d' % (info.devmajor, info.devminor)
+        label = info.pax_headers.get('SCHILY.xattr.' + SELINUX_XATTR)
+        if label is not None:
+            entry['selinux'] = label.rstrip('\0')
+        self.stream.write(
+            json.dumps(entry, separators=(',', ':'), sort_keys=True) + '\n')
+
+
+def get_selinux_xattrs(path):
+    """Returns the pax headers of the SELinux label of the file at
+    `path`."""
+    try:
+        label = os.getxattr(path, SELINUX_XATTR, follow_symlinks=False)
+    except OSError:
+        return {}
+    return {'SCHILY.xattr.' + SELINUX_XATTR: label.decode(
+        'utf-8', 'surrogateescape')}
+
+
+def hash_file(path):
+    """Returns the sha256 of the file at `path`."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def walk(path, arcname='.'):
+    """Yields (path, arcname) of every file in the directory at `path`,
+    in the order tar archives them with --sort=name."""
+    yield path, arcname
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in sorted(os.listdir(path)):
+            yield from walk(
+                os.path.join(path, name), os.path.join(arcname, name))
+
+
+def write_directory_manifest(root, path):
+    """Writes the manifest of the directory at `root` to `path`."""
+    with open(os.devnull, 'wb') as devnull, Manifest(path) as manifest:
+        # Only used to describe the files, as it does for tar.add.
+        tar = tarfile.TarFile(fileobj=devnull, mode='w')
+        for name, arcname in walk(root):
+            info = tar.gettarinfo(name, arcname)
+            if info is None:
+                # Sockets, as tar ignores them.
+                continue
+            info.pax_headers = get_selinux_xattrs(name)
+            sha256 = None
+            if info.type == tarfile.REGTYPE:
+                sha256 = hash_file(name)
+            manifest.add(info, sha256)
+
+
+def read_manifest(path):
+    """Returns the entries of the manifest at `path`, by path."""
+    with gzip.open(path, 'rt', encoding='utf-8') as stream:
+        entries = (json.loads(line) for line in stream)
+        return {entry['path']: entry for entry in entries}
+
+
+def diff(old, new):
+    """Returns the paths added, removed and changed between the entries
+    of two manifests."""
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    changed = sorted(
+        path for path in set(old) & set(new) if old[path] != new[path])
+    return added, removed, changed
+
+
+def format_diff(old, new):
+    """Yields a line for each path added (+), removed (-) or changed (M)
+    between the entries of two manifests, in path order. Changed paths
+    list the fields that differ."""
+    added, removed, changed = diff(old, new)
+    lines = [(path, '+ %s' % path) for path in added]
+    lines.extend((path, '- %s' % path) for path in removed)
+    for path in changed:
+        fields = sorted(
+            name for name in set(old[path]) | set(new[path])
+            if old[path].get(name) != new[path].get(name))
+        lines.append((path, 'M %s (%s)' % (path, ', '.join(fields))))
+    for _, line in sorted(lines):
+        yield line
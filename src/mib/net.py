@@ -78,9 +78,16 @@ def get_random_qemu_mac():
     return ':'.join(map(lambda x: "%02x" % x, mac))
 
 
-def create_tap(bridge):
-    """Creates the tap device on bridge."""
-    tap_name = get_avaliable_tap_name()
+def create_tap(bridge, build_id=None):
+    """Creates the tap device on bridge.
+
+    The tap is named after `build_id` when given, otherwise the next
+    available name is used.
+    """
+    if build_id is not None:
+        tap_name = '%s%s' % (TAP_PREFIX, build_id)
+    else:
+        tap_name = get_avaliable_tap_name()
     owner = utils.get_sudo_user()
 
     # Create the tap device
@@ -0,0 +1,232 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Shared cache of the builders in an S3-compatible object store.
+
+The object store backs the local caches of every build host: an entry
+missing locally is read through from the store, and an entry populated
+locally is written back to it. An entry built on one host is then
+reused by all the others, while the hot entries are served from their
+local caches.
+
+Requests are signed with AWS Signature Version 4, using the path-style
+URLs every S3-compatible store accepts. Objects are named
+`<prefix>/<cache>/<key>` and carry their sha256, which is verified
+when they are read.
+"""
+
+import datetime
+import hashlib
+import hmac
+import http.client
+import logging
+import os
+from urllib.parse import quote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+DEFAULT_REGION = 'us-east-1'
+READ_SIZE = 1024 * 1024
+
+# Metadata header of the sha256 of an object.
+SHA256_HEADER = 'x-amz-meta-sha256'
+
+
+class ObjectStoreError(Exception):
+    """Error class for object store errors."""
+
+
+def hmac_sha256(key, message):
+    """Returns the HMAC-SHA256 of `message` with `key`."""
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+def get_signing_key(secret_key, date, region, service='s3'):
+    """Returns the Signature Version 4 key of `date`, a YYYYMMDD string."""
+    key = hmac_sha256(('AWS4' + secret_key).encode('utf-8'), date)
+    key = hmac_sha256(key, region)
+    key = hmac_sha256(key, service)
+    return hmac_sha256(key, 'aws4_request')
+
+
+def get_authorization(method, path, query, headers, payload_hash,
+                      access_key, secret_key, region, amz_date):
+    """Returns the Signature Version 4 Authorization header of a request,
+    signing every one of its `headers`, a dict of lower case names."""
+    signed_headers = ';'.join(sorted(headers))
+    canonical_request = '\n'.join([
+        method,
+        quote(path, safe='/~'),
+        '&'.join(
+            '%s=%s' % (quote(name, safe='~'), quote(value, safe='~'))
+            for name, value in sorted(query)),
+        ''.join(
+            '%s:%s\n' % (name, ' '.join(str(headers[name]).split()))
+            for name in sorted(headers)),
+        signed_headers,
+        payload_hash,
+        ])
+    scope = '%s/%s/s3/aws4_request' % (amz_date[:8], region)
+    string_to_sign = '\n'.join([
+        ALGORITHM,
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+        ])
+    signature = hmac.new(
+        get_signing_key(secret_key, amz_date[:8], region),
+        string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    return '%s Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (
+        ALGORITHM, access_key, scope, signed_headers, signature)
+
+
+def get_file_sha256(path):
+    """Returns the sha256 of the file at `path`."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for data in iter(lambda: stream.read(READ_SIZE), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class ObjectStore:
+    """Objects under the `url` of a bucket, and an optional prefix, of an
+    S3-compatible object store.
+
+    The credentials default to $AWS_ACCESS_KEY_ID and
+    $AWS_SECRET_ACCESS_KEY.
+    """
+
+    def __init__(self, url, access_key=None, secret_key=None,
+                 region=DEFAULT_REGION, timeout=60):
+        self.url = urlsplit(url.rstrip('/'))
+        if self.url.scheme not in ('http', 'https') or not self.url.path:
+            raise ObjectStoreError(
+                "Invalid object store URL '%s', expected "
+                "http(s)://HOST/BUCKET[/PREFIX]." % url)
+        self.access_key = access_key or os.environ.get('AWS_ACCESS_KEY_ID')
+        self.secret_key = secret_key or os.environ.get(
+            'AWS_SECRET_ACCESS_KEY')
+        if not self.access_key or not self.secret_key:
+            raise ObjectStoreError(
+                "No object store credentials, set AWS_ACCESS_KEY_ID and "
+                "AWS_SECRET_ACCESS_KEY.")
+        self.region = region
+        self.timeout = timeout
+
+    def get_path(self, name, key):
+        """Returns the path of the object of the entry `key` of the cache
+        `name`."""
+        return '%s/%s/%s' % (self.url.path, name, key)
+
+    def request(self, method, path, headers=None, body=None,
+                payload_hash=None):
+        """Sends a signed request for the object at `path`, and returns
+        the connection and the response, left unread."""
+        if payload_hash is None:
+            payload_hash = hashlib.sha256(b'').hexdigest()
+        amz_date = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        headers = dict(headers or {}, **{
+            'host': self.url.netloc,
+            'x-amz-content-sha256': payload_hash,
+            'x-amz-date': amz_date,
+            })
+        headers['authorization'] = get_authorization(
+            method, path, [], headers, payload_hash,
+            self.access_key, self.secret_key, self.region, amz_date)
+        connection_class = (
+            http.client.HTTPSConnection if self.url.scheme == 'https'
+            else http.client.HTTPConnection)
+        connection = connection_class(self.url.netloc, timeout=self.timeout)
+        try:
+            connection.request(
+                method, quote(path, safe='/~'), body=body, headers=headers)
+            return connection, connection.getresponse()
+        except BaseException:
+            connection.close()
+            raise
+
+    def get(self, name, key, path):
+        """Downloads the entry `key` of the cache `name` to `path`.
+        Returns whether the store has it."""
+        connection, response = self.request('GET', self.get_path(name, key))
+        try:
+            if response.status == 404:
+                return False
+            if response.status != 200:
+                raise ObjectStoreError(
+                    "Reading %s/%s failed: %d %s" % (
+                        name, key, response.status, response.reason))
+            digest = hashlib.sha256()
+            with open(path, 'wb') as stream:
+                for data in iter(lambda: response.read(READ_SIZE), b''):
+                    digest.update(data)
+                    stream.write(data)
+            expected = response.getheader(SHA256_HEADER)
+            if expected is not None and expected != digest.hexdigest():
+                os.unlink(path)
+                raise ObjectStoreError(
+                    "Checksum mismatch of %s/%s." % (name, key))
+        finally:
+            connection.close()
+        return True
+
+    def put(self, name, key, path):
+        """Uploads the file at `path` as the entry `key` of the cache
+        `name`."""
+        sha256 = get_file_sha256(path)
+        with open(path, 'rb') as stream:
+            connection, response = self.request(
+                'PUT', self.get_path(name, key), headers={
+                    'content-length': os.fstat(stream.fileno()).st_size,
+                    'content-type': 'application/octet-stream',
+                    SHA256_HEADER: sha256,
+                    }, body=stream, payload_hash=sha256)
+        try:
+            response.read()
+            if response.status >= 300:
+                raise ObjectStoreError(
+                    "Writing %s/%s failed: %d %s" % (
+                        name, key, response.status, response.reason))
+        finally:
+            connection.close()
@@ -0,0 +1,307 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Output formats of the built images.
+
+Every format requested for a build is produced from the one installed
+disk, at the same time:
+
+- filesystem formats (root-tgz, squashfs) are produced from one tar
+  stream of the filesystem, or from its mount point;
+- block formats (ddtgz, qcow2, qcow2-compressed) are produced from the
+  disk image, their concurrent reads of it served by one pass through
+  the page cache.
+"""
+
+import contextlib
+import hashlib
+import os
+import shutil
+import subprocess
+
+from mib import ext4, manifest, utils
+
+# Extension appended to the output path of each format, when several
+# formats are produced.
+FORMATS = {
+    'root-tgz': '.tar.gz',
+    'squashfs': '.squashfs',
+    'ddtgz': '.ddtgz',
+    'qcow2': '.qcow2',
+    'qcow2-compressed': '.compressed.qcow2',
+    }
+
+FILESYSTEM_FORMATS = ('root-tgz', 'squashfs')
+BLOCK_FORMATS = ('ddtgz', 'qcow2', 'qcow2-compressed')
+
+# Formats written front to back, that can be read while written.
+SEQUENTIAL_FORMATS = ('root-tgz', 'ddtgz')
+
+# Size of the reads when checksumming an output.
+CHECKSUM_READ_SIZE = 1024 * 1024
+
+# Block compressors of the squashfs format, zstd decompresses fastest
+# while xz makes the smallest images.
+SQUASHFS_COMPRESSORS = ('zstd', 'xz', 'gzip')
+
+
+def parse_formats(value):
+    """Parses a comma separated list of output formats."""
+    formats = [name.strip() for name in value.split(',') if name.strip()]
+    for name in formats:
+        if name not in FORMATS:
+            raise ValueError(
+                "Unknown output format '%s', expected one of: %s." % (
+                    name, ', '.join(sorted(FORMATS))))
+    return formats
+
+
+def get_output_paths(output, formats):
+    """Returns the final path of each format: `output` itself for a
+    single format, otherwise `output` with the format's extension."""
+    if len(formats) == 1:
+        return {formats[0]: output}
+    return {name: output + FORMATS[name] for name in formats}
+
+
+def get_work_paths(workdir, formats):
+    """Returns the path in `workdir` each format is written to."""
+    return {name: os.path.join(workdir, 'output' + FORMATS[name])
+            for name in formats}
+
+
+def get_squashfs_args(compression='zstd', processors=None, epoch=None):
+    """Returns the mksquashfs and sqfstar arguments compressing with
+    `compression` on `processors` threads, or every available core.
+
+    :param epoch: creation time of deterministic images
+    """
+    args = ['-comp', compression]
+    if compression == 'xz':
+        # Every built architecture is x86, its filter shrinks binaries.
+        args.extend(['-Xbcj', 'x86'])
+    if processors:
+        args.extend(['-processors', str(processors)])
+    if epoch is not None:
+        args.extend(['-mkfs-time', str(epoch)])
+    return args
+
+
+def has_sqfstar():
+    """Returns True when squashfs-tools can read a tar stream."""
+    return shutil.which('sqfstar') is not None
+
+
+async def create_squashfs(output, path, squashfs_args=None, epoch=None,
+                          prefix=None):
+    """Creates a squashfs image of the directory at path.
+
+    :param epoch: make the image deterministic, mksquashfs cannot clamp
+        modification times so every file gets this one
+    """
+    args = list(squashfs_args or [])
+    if epoch is not None:
+        args.extend(['-all-time', str(epoch)])
+    await utils.subp_async(list(prefix or []) + [
+        'mksquashfs', path, output, '-noappend', '-no-progress',
+        ] + args, capture=True)
+
+
+async def write_filesystem_formats(root, paths, squashfs_args=None,
+                                   rsyncable=False, epoch=None,
+                                   manifest_path=None, prefix=None):
+    """Writes the filesystem formats in `paths` from the directory at
+    `root`.
+
+    :param squashfs_args: compression arguments, from
+        `get_squashfs_args`
+    :param rsyncable: compress the tarball with `gzip --rsyncable`
+    :param epoch: make the formats deterministic, with modification
+        times clamped to this time
+    :param manifest_path: also write the manifest of the files there
+    """
+    tasks = []
+    if manifest_path is not None:
+        tasks.append(utils.to_thread(
+            manifest.write_directory_manifest, root, manifest_path))
+    if 'root-tgz' in paths:
+        tasks.append(utils.create_tarball(
+            paths['root-tgz'], root, rsyncable=rsyncable, epoch=epoch,
+            prefix=prefix))
+    if 'squashfs' in paths:
+        tasks.append(create_squashfs(
+            paths['squashfs'], root, squashfs_args=squashfs_args,
+            epoch=epoch, prefix=prefix))
+    await utils.gather(*tasks)
+
+
+class TeeWriter:
+    """File object writing to several file objects."""
+
+    def __init__(self, streams):
+        self.streams = streams
+
+    def write(self, data):
+        """Writes `data` to every stream."""
+        for stream in self.streams:
+            stream.write(data)
+        return len(data)
+
+    def close(self):
+        """Closes every stream."""
+        for stream in self.streams:
+            stream.close()
+
+
+def stream_filesystem_formats(  # pylint: disable=too-many-locals
+        disk_path, paths, extra_path=None, squashfs_args=None,
+        rsyncable=False, epoch=None, manifest_path=None, prefix=None):
+    """Writes the filesystem formats in `paths` from a single tar stream
+    of the ext4 filesystem in the disk image, and the manifest of its
+    files to `manifest_path`."""
+    commands = []
+    if 'root-tgz' in paths:
+        commands.append((
+            utils.get_gzip_args(
+                rsyncable, deterministic=epoch is not None) + ['-c'],
+            paths['root-tgz']))
+    if 'squashfs' in paths:
+        commands.append((
+            ['sqfstar', '-no-progress'] + list(squashfs_args or []) +
+            [paths['squashfs']], None))
+    processes = []
+    try:
+        for args, stdout in commands:
+            stream = open(stdout, 'wb') if stdout else subprocess.DEVNULL
+            try:
+                processes.append(subprocess.Popen(
+                    list(prefix or []) + args,
+                    stdin=subprocess.PIPE, stdout=stream))
+            finally:
+                if stdout:
+                    stream.close()
+        tee = TeeWriter([process.stdin for process in processes])
+        with contextlib.ExitStack() as stack:
+            filesystem = stack.enter_context(
+                ext4.Ext4Filesystem(disk_path, partition=0))
+            files = None
+            if manifest_path is not None:
+                files = stack.enter_context(
+                    manifest.Manifest(manifest_path))
+            ext4.write_tar(
+                filesystem, tee, extra_path=extra_path, mtime=epoch,
+                manifest=files)
+    finally:
+        for process in processes:
+            process.stdin.close()
+        returncodes = [process.wait() for process in processes]
+    for (args, _), returncode in zip(commands, returncodes):
+        if returncode != 0:
+            raise utils.ProcessExecutionError(
+                cmd=args, exit_code=returncode)
+
+
+async def create_ddtgz(output, disk_path, workdir, rsyncable=False,
+                       epoch=None, prefix=None):
+    """Creates a ddtgz, a gzipped tarball of the raw disk image."""
+    # Converting makes the zeroed free space sparse.
+    clean_disk_path = os.path.join(workdir, 'clean-output.img')
+    await utils.subp_async(list(prefix or []) + [
+        'qemu-img', 'convert', '-O', 'raw', disk_path, clean_disk_path,
+        ])
+    try:
+        args = ['tar', 'Scf', output] + utils.get_tar_compress_args(
+            rsyncable, deterministic=epoch is not None)
+        if epoch is not None:
+            args.extend(utils.get_tar_deterministic_args(epoch))
+        await utils.subp_async(
+            list(prefix or []) + args +
+            ['-C', workdir, os.path.basename(clean_disk_path)])
+    finally:
+        os.unlink(clean_disk_path)
+
+
+async def create_qcow2(output, disk_path, compressed=False, prefix=None):
+    """Creates a qcow2 image of the raw disk image."""
+    args = ['qemu-img', 'convert', '-O', 'qcow2']
+    if compressed:
+        args.append('-c')
+    await utils.subp_async(
+        list(prefix or []) + args + [disk_path, output])
+
+
+async def write_block_formats(disk_path, paths, workdir, rsyncable=False,
+                              epoch=None, prefix=None):
+    """Writes the block formats in `paths` from the disk image.
+
+    :param rsyncable: compress the ddtgz with `gzip --rsyncable`
+    :param epoch: make the ddtgz deterministic, dated this time
+    """
+    tasks = []
+    if 'ddtgz' in paths:
+        tasks.append(create_ddtgz(
+            paths['ddtgz'], disk_path, workdir, rsyncable=rsyncable,
+            epoch=epoch, prefix=prefix))
+    if 'qcow2' in paths:
+        tasks.append(create_qcow2(paths['qcow2'], disk_path, prefix=prefix))
+    if 'qcow2-compressed' in paths:
+        tasks.append(create_qcow2(
+            paths['qcow2-compressed'], disk_path, compressed=True,
+            prefix=prefix))
+    await utils.gather(*tasks)
+
+
+def get_checksum(path):
+    """Returns the size and the sha256 of the output at `path`."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as stream:
+        for data in iter(lambda: stream.read(CHECKSUM_READ_SIZE), b''):
+            digest.update(data)
+            size += len(data)
+    return size, digest.hexdigest()
+
+
+def move_outputs(work_paths, output_paths):
+    """Moves each format from the work directory to its output path."""
+    for name, path in work_paths.items():
+        shutil.move(path, output_paths[name])
@@ -42,7 +42,108 @@
 
 """Parameter parser for maas-image-builder."""
 
-from argparse import ArgumentParser
+import os
+import re
+from argparse import ArgumentParser, ArgumentTypeError
+
+from mib import cache, objectstore, outputs, scratch, simplestreams
+
+
+def build_id(value):
+    """Validates a build identifier."""
+    if not re.match(r'^[a-z0-9]{1,8}$', value):
+        raise ArgumentTypeError(
+            "Invalid build id '%s', expected up to 8 lowercase letters or "
+            "digits." % value)
+    return value
+
+
+def workdir(value):
+    """Validates a scratch location."""
+    if value != scratch.TMPFS and not os.path.isdir(value):
+        raise ArgumentTypeError(
+            "Invalid work directory '%s', no such directory." % value)
+    return value
+
+
+def script(value):
+    """Validates a customization script."""
+    if not os.path.isfile(value):
+        raise ArgumentTypeError(
+            "Invalid customization script '%s', no such file." % value)
+    return os.path.abspath(value)
+
+
+def output_formats(value):
+    """Parses a comma separated list of output formats."""
+    try:
+        return outputs.parse_formats(value)
+    except ValueError as error:
+        raise ArgumentTypeError(str(error))
+
+
+def upload_target(value):
+    """Parses a FORMAT=URL upload target."""
+    name, _, url = value.partition('=')
+    if name not in outputs.FORMATS or not url:
+        raise ArgumentTypeError(
+            "Invalid upload '%s', expected FORMAT=URL with one of the "
+            "formats: %s." % (value, ', '.join(sorted(outputs.FORMATS))))
+    return name, url
+
+
+def source_date_epoch(value):
+    """Parses a time in seconds since the epoch."""
+    try:
+        return int(value)
+    except ValueError:
+        raise ArgumentTypeError(
+            "Invalid source date epoch '%s', expected seconds since the "
+            "epoch." % value)
+
+
+def cache_budget(value):
+    """Parses a CACHE=MiB cache budget."""
+    name, _, size = value.partition('=')
+    try:
+        return name, int(size)
+    except ValueError:
+        raise ArgumentTypeError(
+            "Invalid cache budget '%s', expected CACHE=MiB." % value)
+
+
+def phase_timeout(value):
+    """Parses a STAGE=SECONDS phase timeout."""
+    stage, _, seconds = value.partition('=')
+    try:
+        return stage, int(seconds)
+    except ValueError:
+        raise ArgumentTypeError(
+            "Invalid phase timeout '%s', expected STAGE=SECONDS." % value)
+
+
+def add_cache_arguments(parser):
+    """Adds the options of the builder caches to `parser`."""
+    parser.add_argument(
+        '--cache-dir',
+        default=cache.CACHE_DIR, metavar='PATH',
+        help=(
+            "Directory of the caches of downloads and packages shared "
+            "by the builds. Default: %s" % cache.CACHE_DIR))
+    parser.add_argument(
+        '--cache-size',
+        default=cache.DEFAULT_SIZE, type=int, metavar='MiB',
+        help=(
+            "Budget of all the caches together, the least recently used "
+            "entries are evicted beyond it. Default: %d" % (
+                cache.DEFAULT_SIZE)))
+    parser.add_argument(
+        '--cache-budget',
+        action='append', default=[], type=cache_budget,
+        metavar='CACHE=MiB',
+        help=(
+            "Budget of one of the caches, can be given more than once: "
+            "%s." % ', '.join(cache.CACHES)))
 
 
 def load_parser(builders):
@@ -64,7 +165,214 @@ def load_parser(builders):
         help="Architecture to build. Default: amd64")
     parser.add_argument(
         '-o', '--output', required=True,
-        help="Output file for built image.")
+        help=(
+            "Output file for built image. With several output formats, "
+            "each is written to this path plus the format's extension."))
+    parser.add_argument(
+        '--output-format',
+        action='append', default=[], type=output_formats,
+        metavar='FORMAT[,FORMAT...]',
+        help=(
+            "Image formats to write from the one build, can be given more "
+            "than once: %s. Default: the builder's usual format, "
+            "root-tgz for Linux and ddtgz for Windows." % (
+                ', '.join(outputs.FORMATS))))
+    parser.add_argument(
+        '--upload',
+        action='append', default=[], type=upload_target,
+        metavar='FORMAT=URL',
+        help=(
+            "Upload an output format to URL while it is being written, "
+            "in resumable chunks, can be given more than once. root-tgz "
+            "and ddtgz are streamed as they are compressed, the other "
+            "formats once written."))
+    parser.add_argument(
+        '--upload-api-key',
+        default=None, metavar='KEY',
+        help="MAAS API key authenticating the uploads.")
+    parser.add_argument(
+        '--upload-rate',
+        default=None, type=float, metavar='MIB_PER_SECOND',
+        help="Bound the throughput of each upload. Default: unbounded")
+    parser.add_argument(
+        '--manifest',
+        action='store_true', default=False,
+        help=(
+            "Write a manifest of every file in the image, with its type, "
+            "mode, owner, size, sha256 and SELinux label, to the output "
+            "path plus '.manifest.gz', while the image is packaged."))
+    parser.add_argument(
+        '--deterministic',
+        action='store_true', default=False,
+        help=(
+            "Write the same bytes for the same content: files are "
+            "archived in name order with modification times clamped to "
+            "the source date epoch, and compression headers carry no "
+            "time stamps."))
+    parser.add_argument(
+        '--source-date-epoch',
+        default=os.environ.get('SOURCE_DATE_EPOCH'),
+        type=source_date_epoch, metavar='SECONDS',
+        help=(
+            "Time of the deterministic outputs, in seconds since the "
+            "epoch. Default: $SOURCE_DATE_EPOCH"))
+    parser.add_argument(
+        '--block-index',
+        action='store_true', default=False,
+        help=(
+            "Write a zsync-style block index next to every output, for "
+            "mirrors to download only the blocks that changed since the "
+            "previous version. Compressed formats are made rsyncable "
+            "for it."))
+    parser.add_argument(
+        '--chunk-store',
+        default=None, metavar='PATH',
+        help=(
+            "Also store every output in the content-defined chunk store "
+            "at PATH, where versions of an image share their unchanged "
+            "chunks. Compressed formats are made rsyncable for it."))
+    parser.add_argument(
+        '--durability',
+        default='output', choices=['none', 'output', 'full'],
+        help=(
+            "What is flushed to persistent storage, only ever the files "
+            "and filesystems of the build. 'output' flushes the "
+            "published outputs before the build completes, 'full' also "
+            "the scratch disk images between steps, 'none' leaves it to "
+            "the kernel. Default: output"))
+    parser.add_argument(
+        '--simplestreams',
+        default=None, metavar='PATH',
+        help=(
+            "Add the outputs as a new version of their product to the "
+            "simplestreams tree at PATH, which must contain the output. "
+            "Only the products file of the product and the index are "
+            "rewritten."))
+    parser.add_argument(
+        '--simplestreams-prefix',
+        default=simplestreams.DEFAULT_CONTENT_PREFIX, metavar='PREFIX',
+        help=(
+            "Prefix of the simplestreams product ids. "
+            "Default: %s" % simplestreams.DEFAULT_CONTENT_PREFIX))
+    parser.add_argument(
+        '--squashfs-compression',
+        default='zstd', choices=outputs.SQUASHFS_COMPRESSORS,
+        help=(
+            "Block compression of the squashfs output format. zstd "
+            "decompresses fastest at deployment, xz makes the smallest "
+            "image. Default: zstd"))
+    parser.add_argument(
+        '--workdir',
+        action='append', default=[], type=workdir, metavar='PATH',
+        help=(
+            "Scratch location for the build's work directory, can be "
+            "given more than once to spread builds across devices. "
+            "'%s' places it in memory when the host has enough. "
+            "Default: %s" % (scratch.TMPFS, scratch.DEFAULT_LOCATION)))
+    parser.add_argument(
+        '--hardware-profile',
+        default='auto', choices=['auto', 'legacy'],
+        help=(
+            "Virtual hardware of the installation VM. 'auto' uses the "
+            "fastest disk, cpu and display settings the host supports, "
+            "'legacy' only emulated hardware. Default: auto"))
+    parser.add_argument(
+        '--fast-install',
+        action='store_true', default=False,
+        help=(
+            "Trade the durability of the installation disk for speed: "
+            "guest flushes are ignored and the installer formats and "
+            "mounts '/' without barriers or eager initialisation."))
+    parser.add_argument(
+        '--customize',
+        action='append', default=[], type=script, metavar='SCRIPT',
+        help=(
+            "Script to run inside the Linux root filesystem of the image "
+            "before packaging, can be given more than once."))
+    parser.add_argument(
+        '--customize-runner',
+        default='auto', choices=['auto', 'nspawn', 'chroot'],
+        help=(
+            "Run the customization scripts under systemd-nspawn or in a "
+            "chroot. 'auto' uses systemd-nspawn when installed. "
+            "Default: auto"))
+    parser.add_argument(
+        '--packaging',
+        default='auto', choices=['auto', 'mount'],
+        help=(
+            "How the installed filesystem is read for the root tarball. "
+            "'auto' reads ext2/3/4 straight out of the disk image, "
+            "unless customization needs it mounted. 'mount' always "
+            "mounts it with loop devices. Default: auto"))
+    parser.add_argument(
+        '--compact',
+        default='auto', choices=['auto', 'off'],
+        help=(
+            "Discard, or zero, the free space of the installed filesystem "
+            "before packaging, so it compresses and stays sparse. "
+            "Default: auto"))
+    parser.add_argument(
+        '--auto-size',
+        action='store_true', default=False,
+        help=(
+            "Shrink the filesystem, its partition and the disk image to "
+            "their minimal size after the installation. The deployed "
+            "system grows them back to the size of its disk."))
+    parser.add_argument(
+        '--size-headroom',
+        default=0, type=int, metavar='MiB',
+        help="Free space left on the filesystem with --auto-size.")
+    parser.add_argument(
+        '--numa-placement',
+        default='auto', choices=['auto', 'off'],
+        help=(
+            "Pin the installation VM and the image compression to the "
+            "cores of one NUMA node, on hosts with more than one node. "
+            "Default: auto"))
+    parser.add_argument(
+        '--build-id',
+        default=None, type=build_id,
+        help=(
+            "Unique identifier used to name the resources of this build. "
+            "Default: randomly generated"))
+    parser.add_argument(
+        '--stall-timeout',
+        default=1800, type=int,
+        help=(
+            "Destroy the installation VM after this many seconds without "
+            "console output or disk writes. Default: 1800"))
+    parser.add_argument(
+        '--install-timeout',
+        default=None, type=int,
+        help="Destroy the installation VM after this many seconds.")
+    parser.add_argument(
+        '--phase-timeout',
+        action='append', default=[], type=phase_timeout,
+        metavar='STAGE=SECONDS',
+        help=(
+            "Destroy the installation VM when an installer stage, such as "
+            "download, install or post, runs longer than SECONDS."))
+
+    parser.add_argument(
+        '--no-cache',
+        action='store_true', default=False,
+        help="Neither use nor fill the caches of downloads and packages.")
+    add_cache_arguments(parser)
+    parser.add_argument(
+        '--cache-remote',
+        default=None, metavar='URL',
+        help=(
+            "Share the caches through the S3-compatible object store "
+            "bucket at URL, http(s)://HOST/BUCKET[/PREFIX]: entries "
+            "missing locally are read from it, and entries created "
+            "locally written to it. The credentials are read from "
+            "$AWS_ACCESS_KEY_ID and $AWS_SECRET_ACCESS_KEY."))
+    parser.add_argument(
+        '--cache-remote-region',
+        default=objectstore.DEFAULT_REGION, metavar='REGION',
+        help=(
+            "Region of the object store of --cache-remote. "
+            "Default: %s" % objectstore.DEFAULT_REGION))
 
     # Add sub-commands from the builders.
     subparser = parser.add_subparsers(dest="builder")
@@ -72,3 +380,73 @@ def load_parser(builders):
         builder_parser = subparser.add_parser(builder.name)
         builder.populate_parser(builder_parser)
     return parser
+
+
+def load_cache_parser():
+    """Load command line parser of the cache commands."""
+    parser = ArgumentParser(
+        prog='maas-image-builder cache',
+        description="Manage the caches of the builders.")
+    add_cache_arguments(parser)
+    subparser = parser.add_subparsers(dest="command")
+    subparser.required = True
+    subparser.add_parser(
+        'stats', help="Show the entries, size and budget of each cache.")
+    subparser.add_parser(
+        'gc', help="Evict entries until the caches are within budget.")
+    purge_parser = subparser.add_parser(
+        'purge', help="Evict every entry not in use.")
+    purge_parser.add_argument(
+        'cache', nargs='?', default=None,
+        help="Only purge this cache. Default: all the caches")
+    return parser
+
+
+def load_manifest_parser():
+    """Load command line parser of the manifest commands."""
+    parser = ArgumentParser(
+        prog='maas-image-builder manifest',
+        description="Compare the manifests written with --manifest.")
+    subparser = parser.add_subparsers(dest="command")
+    subparser.required = True
+    diff_parser = subparser.add_parser(
+        'diff', help=(
+            "List the paths added (+), removed (-) and changed (M) "
+            "between two images."))
+    diff_parser.add_argument('old', help="Manifest of the old image.")
+    diff_parser.add_argument('new', help="Manifest of the new image.")
+    return parser
+
+
+def load_store_parser():
+    """Load command line parser of the chunk store."""
+    parser = ArgumentParser(
+        description="Content-defined chunk store of built images.")
+    parser.add_argument(
+        'store', help="Path to the chunk store.")
+    subparser = parser.add_subparsers(dest="command")
+    subparser.required = True
+
+    add_parser = subparser.add_parser(
+        'add', help="Store a version of an image.")
+    add_parser.add_argument('path', help="Image to store.")
+    add_parser.add_argument(
+        '--name', help="Name of the image. Default: its file name")
+    add_parser.add_argument(
+        '--version', help="Version of the image. Default: the UTC time")
+
+    subparser.add_parser('list', help="List the stored images.")
+
+    restore_parser = subparser.add_parser(
+        'restore', help="Write a version of an image back out.")
+    restore_parser.add_argument('name', help="Name of the image.")
+    restore_parser.add_argument('version', help="Version of the image.")
+    restore_parser.add_argument(
+        '-o', '--output', default='-',
+        help="File to write the image to. Default: stdout")
+
+    remove_parser = subparser.add_parser(
+        'remove', help="Remove a version of an image and its chunks.")
+    remove_parser.add_argument('name', help="Name of the image.")
+    remove_parser.add_argument('version', help="Version of the image.")
+    return parser
@@ -0,0 +1,219 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""NUMA placement of build VMs and their post-processing.
+
+Every build is assigned a NUMA node and a set of cores on it. The VM is
+pinned to those cores with its memory bound to the node, and the tar and
+compression steps that follow the installation run on the same cores.
+Assignments are recorded in a shared state directory, so concurrent
+builds on the host are spread across the nodes.
+"""
+
+import fcntl
+import glob
+import json
+import logging
+import os
+import re
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+NODE_PATH = '/sys/devices/system/node'
+STATE_DIR = '/run/maas-image-builder/placement'
+
+Node = namedtuple('Node', ['index', 'cpus', 'free_memory'])
+
+
+def parse_cpulist(value):
+    """Parses a kernel cpulist such as '0-3,8,10-11'."""
+    cpus = []
+    for part in value.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """Formats `cpus` as a kernel cpulist."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(
+        '%d' % first if first == last else '%d-%d' % (first, last)
+        for first, last in ranges)
+
+
+def get_nodes(path=NODE_PATH):
+    """Returns the NUMA nodes of the host that have cpus, with their free
+    memory in MiB."""
+    nodes = []
+    for node_path in glob.glob(os.path.join(path, 'node[0-9]*')):
+        index = int(re.search(r'(\d+)$', node_path).group(1))
+        with open(os.path.join(node_path, 'cpulist'), 'r') as stream:
+            cpus = parse_cpulist(stream.read())
+        free_memory = 0
+        with open(os.path.join(node_path, 'meminfo'), 'r') as stream:
+            for line in stream:
+                if 'MemFree:' in line:
+                    free_memory = int(line.split()[-2]) // 1024
+        if cpus:
+            nodes.append(Node(index, cpus, free_memory))
+    return sorted(nodes)
+
+
+class Placement:
+    """NUMA node and cores assigned to a build."""
+
+    def __init__(self, node=None, cpus=None):
+        self.node = node
+        self.cpus = cpus or []
+
+    @property
+    def cpulist(self):
+        """Assigned cores as a cpulist, or None without placement."""
+        if not self.cpus:
+            return None
+        return format_cpulist(self.cpus)
+
+    @property
+    def prefix(self):
+        """Arguments that run a command on the assigned cores, with its
+        memory bound to the assigned node."""
+        if self.node is None:
+            return []
+        return [
+            'numactl',
+            '--physcpubind=%s' % self.cpulist,
+            '--membind=%d' % self.node,
+            ]
+
+
+def read_assignments(state_dir):
+    """Returns the placements of the builds still running.
+
+    Each build holds a lock on its state file, so files left behind by
+    builds that died can be detected and removed. Builds remove their
+    own file when they finish, files can vanish while being read.
+    """
+    assignments = []
+    for path in glob.glob(os.path.join(state_dir, '*.json')):
+        try:
+            stream = open(path, 'r')
+        except FileNotFoundError:
+            continue
+        with stream:
+            try:
+                fcntl.flock(stream, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                assignments.append(json.load(stream))
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+    return assignments
+
+
+def choose_placement(nodes, usage, reserved, vcpus, ram):
+    """Returns the placement of a build on the least loaded of `nodes`,
+    given the builds on each cpu in `usage` and the memory `reserved`
+    on each node."""
+
+    def free_memory(node):
+        return node.free_memory - reserved[node.index]
+
+    candidates = [
+        node for node in nodes if free_memory(node) >= ram] or nodes
+    node = min(candidates, key=lambda node: (
+        sum(usage[cpu] for cpu in node.cpus) / len(node.cpus),
+        -free_memory(node)))
+    cpus = sorted(node.cpus, key=lambda cpu: (usage[cpu], cpu))[:vcpus]
+    return Placement(node.index, sorted(cpus))
+
+
+@contextmanager
+def allocate(build_id, vcpus, ram, state_dir=STATE_DIR, nodes=None):
+    """Context manager: placement of a build on the host.
+
+    Picks the node with the least loaded cores that still has `ram` MiB
+    free, and the `vcpus` least used cores on it. Hosts with a single
+    NUMA node get no placement, the scheduler does best there.
+    """
+    if nodes is None:
+        nodes = get_nodes()
+    if len(nodes) < 2:
+        yield Placement()
+        return
+    os.makedirs(state_dir, exist_ok=True)
+    state_path = os.path.join(state_dir, '%s.json' % build_id)
+    with open(os.path.join(state_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        usage = Counter()
+        reserved = Counter()
+        for assignment in read_assignments(state_dir):
+            usage.update(assignment['cpus'])
+            reserved[assignment['node']] += assignment['ram']
+        placement = choose_placement(nodes, usage, reserved, vcpus, ram)
+        state = open(state_path, 'w')
+        fcntl.flock(state, fcntl.LOCK_EX)
+        json.dump({
+            'node': placement.node,
+            'cpus': placement.cpus,
+            'ram': ram,
+            }, state)
+        state.flush()
+    logger.info(
+        'Placing build %s on NUMA node %d, cpus %s.',
+        build_id, placement.node, placement.cpulist)
+    try:
+        yield placement
+    finally:
+        os.unlink(state_path)
+        state.close()
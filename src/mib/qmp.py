@@ -0,0 +1,170 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Client for the QEMU Machine Protocol (QMP)."""
+
+import asyncio
+import json
+import socket
+import time
+
+
+class QMPError(Exception):
+    """Exception raised when the QMP conversation fails."""
+
+
+class QMPClient:
+    """Client for a QMP unix socket.
+
+    The socket is in non-blocking mode, the conversation is driven from
+    the event loop, and once connected the client can be registered
+    with a selector and polled for events with `read_events` whenever
+    it becomes readable.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.buffer = b''
+        self.pending = []
+
+    async def connect(self, timeout=30):
+        """Connects to the socket and negotiates the capabilities.
+
+        QEMU creates the socket shortly after it is spawned, so the
+        connection is retried until `timeout` seconds have passed.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = time.time() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.time() > deadline:
+                    raise QMPError(
+                        'Timed out connecting to QMP socket %s.' % self.path)
+                await asyncio.sleep(0.2)
+            else:
+                break
+        self.sock = sock
+        greeting = await self._read_message()
+        if 'QMP' not in greeting:
+            self.close()
+            raise QMPError('Invalid QMP greeting: %r' % greeting)
+        await self.execute('qmp_capabilities')
+
+    def fileno(self):
+        """Returns the file descriptor of the socket."""
+        return self.sock.fileno()
+
+    def close(self):
+        """Closes the socket."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    async def execute(self, command, arguments=None):
+        """Executes `command` and returns its result.
+
+        Events received while waiting for the reply are kept and handed
+        out on the next call to `read_events`.
+        """
+        loop = asyncio.get_event_loop()
+        message = {'execute': command}
+        if arguments:
+            message['arguments'] = arguments
+        await loop.sock_sendall(
+            self.sock, json.dumps(message).encode('utf-8') + b'\n')
+        while True:
+            reply = await self._read_message()
+            if 'event' in reply:
+                self.pending.append(reply)
+            elif 'error' in reply:
+                raise QMPError(
+                    'QMP command %s failed: %s' % (
+                        command, reply['error'].get('desc')))
+            elif 'return' in reply:
+                return reply['return']
+
+    def read_events(self):
+        """Reads all the available events from the socket.
+
+        :returns: list of event messages, or None once QEMU has closed
+            the connection.
+        """
+        events, self.pending = self.pending, []
+        closed = False
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                data = b''
+            if not data:
+                closed = True
+                break
+            self.buffer += data
+        while b'\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\n', 1)
+            if not line.strip():
+                continue
+            message = json.loads(line.decode('utf-8'))
+            if 'event' in message:
+                events.append(message)
+        if closed and not events:
+            return None
+        return events
+
+    async def _read_message(self):
+        """Waits until a complete message has been read."""
+        loop = asyncio.get_event_loop()
+        while b'\n' not in self.buffer:
+            data = await loop.sock_recv(self.sock, 4096)
+            if not data:
+                raise QMPError('QMP connection closed unexpectedly.')
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
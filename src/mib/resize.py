@@ -0,0 +1,170 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Shrinking of installed disk images to their minimal size.
+
+The filesystem on the last partition of the disk is shrunk to its
+minimum plus a headroom, the partition is resized to match and the disk
+image is truncated after it. The deployed system grows the partition
+back to the size of its disk: curtin's grow-root on Linux and
+cloudbase-init's volume extension on Windows.
+"""
+
+import json
+import logging
+import os
+import re
+
+from mib import utils
+
+logger = logging.getLogger(__name__)
+
+SECTOR_SIZE = 512
+
+# Partitions are sized in whole MiB, keeping them aligned.
+ALIGNMENT = 1024 * 1024
+
+
+def align(size):
+    """Rounds `size` up to the partition alignment."""
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+async def get_partitions(disk_path):
+    """Returns the partitions of the disk image, as reported by sfdisk."""
+    out, _ = await utils.subp_async(
+        ['sfdisk', '--json', disk_path], capture=True)
+    return json.loads(out)['partitiontable']['partitions']
+
+
+async def shrink_ext(device, headroom):
+    """Shrinks the ext filesystem on `device` to its minimum plus
+    `headroom` bytes, returning its new size."""
+    await utils.subp_async(
+        ['e2fsck', '-f', '-y', device], rcs=[0, 1], capture=True)
+    out, _ = await utils.subp_async(['dumpe2fs', '-h', device], capture=True)
+    block_size = int(re.search(r'^Block size:\s+(\d+)', out, re.M).group(1))
+    out, _ = await utils.subp_async(['resize2fs', '-P', device], capture=True)
+    blocks = int(re.search(r'minimum size of the filesystem: (\d+)', out)
+                 .group(1))
+    blocks += -(-headroom // block_size)
+    await utils.subp_async(['resize2fs', device, '%d' % blocks], capture=True)
+    return blocks * block_size
+
+
+async def shrink_ntfs(device, headroom):
+    """Shrinks the NTFS filesystem on `device` to its minimum plus
+    `headroom` bytes, returning its new size."""
+    out, _ = await utils.subp_async([
+        'ntfsresize', '--info', '--force', '--no-progress-bar', device,
+        ], capture=True)
+    match = re.search(r'resize at (\d+) bytes', out)
+    if match is None:
+        logger.warning('ntfsresize reported no minimal size for %s.', device)
+        return None
+    size = align(int(match.group(1)) + headroom)
+    await utils.subp_async([
+        'ntfsresize', '--force', '--no-progress-bar',
+        '--size', '%d' % size, device,
+        ], data=b'y\n', capture=True)
+    # Do not let Windows check the disk on first boot.
+    await utils.subp_async(['ntfsfix', '-d', device], capture=True)
+    return size
+
+
+SHRINKERS = {
+    'ext2': shrink_ext,
+    'ext3': shrink_ext,
+    'ext4': shrink_ext,
+    'ntfs': shrink_ntfs,
+    }
+
+
+async def shrink_disk(disk_path, partition, headroom=0):
+    """Shrinks the filesystem on `partition` of the disk image, its last
+    partition, and the disk image after it.
+
+    :param partition: index of the partition, as for `utils.mount_loop`
+    :param headroom: bytes left free on the filesystem
+    :returns: the new size of the disk image, or None when it was kept
+    """
+    partitions = await get_partitions(disk_path)
+    entry = partitions[partition]
+    if entry['start'] < max(part['start'] for part in partitions):
+        logger.warning(
+            'Not shrinking %s, partition %d is not the last one.',
+            disk_path, partition + 1)
+        return None
+    out, _ = await utils.subp_async([
+        'losetup', '--find', '--show',
+        '--offset', '%d' % (entry['start'] * SECTOR_SIZE),
+        '--sizelimit', '%d' % (entry['size'] * SECTOR_SIZE),
+        disk_path,
+        ], capture=True)
+    device = out.strip()
+    try:
+        out, _ = await utils.subp_async(
+            ['blkid', '-o', 'value', '-s', 'TYPE', device], capture=True)
+        shrinker = SHRINKERS.get(out.strip())
+        if shrinker is None:
+            logger.warning(
+                'Not shrinking %s, unsupported filesystem %s.',
+                disk_path, out.strip())
+            return None
+        fs_size = await shrinker(device, headroom)
+    finally:
+        await utils.subp_async(['losetup', '--detach', device])
+    if fs_size is None:
+        return None
+
+    sectors = align(fs_size) // SECTOR_SIZE
+    await utils.subp_async(
+        ['sfdisk', '--no-reread', '-N', '%d' % (partition + 1), disk_path],
+        data=(',%d\n' % sectors).encode('ascii'), capture=True)
+    size = (entry['start'] + sectors) * SECTOR_SIZE
+    old_size = os.path.getsize(disk_path)
+    os.truncate(disk_path, size)
+    logger.info(
+        'Shrunk %s from %d MiB to %d MiB.',
+        os.path.basename(disk_path), old_size // ALIGNMENT,
+        size // ALIGNMENT)
+    return size
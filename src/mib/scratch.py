@@ -0,0 +1,213 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Scratch space of the builds.
+
+A build's work directory holds its install disk, ISOs, floppy and the
+packaged image. It is placed on one of the scratch locations given with
+--workdir: a tmpfs when the host has the memory for it, otherwise the
+directory on the device with the fewest builds running and room for the
+builder's estimate. Reservations are recorded in a shared state
+directory, so concurrent builds are spread across the devices.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
+
+from mib import utils
+from mib.placement import read_assignments
+
+logger = logging.getLogger(__name__)
+
+STATE_DIR = '/run/maas-image-builder/scratch'
+DEFAULT_LOCATION = '/var/lib/libvirt/images'
+
+# Location name selecting a tmpfs of the size of the estimate.
+TMPFS = 'tmpfs'
+
+# Memory in MiB left to the host when sizing a tmpfs.
+TMPFS_MEMORY_MARGIN = 1024
+
+MEBIBYTE = 1024 * 1024
+GIBIBYTE = 1024 * MEBIBYTE
+
+
+class ScratchError(Exception):
+    """Error class for scratch space errors."""
+
+
+def get_free_space(path):
+    """Returns the bytes available to the builder at `path`."""
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def get_available_memory(path='/proc/meminfo'):
+    """Returns the memory available for new allocations, in MiB."""
+    with open(path, 'r') as stream:
+        for line in stream:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) // 1024
+    return 0
+
+
+@contextmanager
+def tmpfs_dir(prefix, location, size):
+    """Context manager: temporary directory backed by a tmpfs of `size`
+    bytes.
+
+    The mount point is created in `location`, where the VMs are allowed
+    to access their disks.
+    """
+    path = tempfile.mkdtemp(prefix=prefix, dir=location)
+    try:
+        utils.subp([
+            'mount', '-t', 'tmpfs',
+            '-o', 'size=%d,mode=0700' % size,
+            'tmpfs', path,
+            ])
+        try:
+            yield path
+        finally:
+            utils.subp(['umount', path])
+    finally:
+        os.rmdir(path)
+
+
+def select_location(locations, required, ram, reservations):
+    """Returns the location in `locations` to place a build needing
+    `required` bytes of scratch space, while its VM uses `ram` MiB."""
+    directories = [
+        location for location in locations if location != TMPFS]
+    if TMPFS in locations:
+        tmpfs_reserved = sum(
+            reservation['size'] for reservation in reservations
+            if reservation['location'] == TMPFS) // MEBIBYTE
+        available = (
+            get_available_memory() - tmpfs_reserved - ram -
+            TMPFS_MEMORY_MARGIN)
+        if available * MEBIBYTE >= required:
+            return TMPFS
+    if not directories:
+        directories = [DEFAULT_LOCATION]
+
+    # Builds on paths of the same device share its bandwidth.
+    builds = Counter()
+    reserved = Counter()
+    for reservation in reservations:
+        if reservation['location'] != TMPFS:
+            builds[reservation['device']] += 1
+            reserved[reservation['device']] += reservation['size']
+
+    def device(location):
+        return os.stat(location).st_dev
+
+    def free_space(location):
+        return get_free_space(location) - reserved[device(location)]
+
+    candidates = [
+        location for location in directories
+        if free_space(location) >= required]
+    if not candidates:
+        logger.warning(
+            'No scratch location has the estimated %d MiB free.',
+            required // MEBIBYTE)
+        candidates = directories
+    return min(candidates, key=lambda location: (
+        builds[device(location)], -free_space(location)))
+
+
+@contextmanager
+def allocate(build_id, required, locations=None, ram=0,
+             state_dir=STATE_DIR):
+    """Context manager: work directory of a build, yielding its path.
+
+    :param required: estimated peak scratch usage of the build, in bytes
+    :param locations: scratch directories, and `TMPFS`
+    :param ram: memory of the build VM, in MiB
+    :raises ScratchError: when the build id already has a work directory
+    """
+    if not locations:
+        locations = [DEFAULT_LOCATION]
+    os.makedirs(state_dir, exist_ok=True)
+    state_path = os.path.join(state_dir, '%s.json' % build_id)
+    with open(os.path.join(state_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        reservations = read_assignments(state_dir)
+        # The state files of the builds that died have been removed.
+        if os.path.exists(state_path):
+            raise ScratchError(
+                "Build %s already has a work directory." % build_id)
+        location = select_location(locations, required, ram, reservations)
+        state = open(state_path, 'w')
+        fcntl.flock(state, fcntl.LOCK_EX)
+        json.dump({
+            'location': location,
+            'device': None if location == TMPFS else os.stat(location).st_dev,
+            'size': required,
+            }, state)
+        state.flush()
+    logger.info(
+        'Placing work directory of build %s on %s, estimated %d MiB.',
+        build_id, location, required // MEBIBYTE)
+    prefix = 'img-builder-%s-' % build_id
+    try:
+        if location == TMPFS:
+            tmpfs_location = [
+                location for location in locations if location != TMPFS]
+            with tmpfs_dir(
+                    prefix, (tmpfs_location or [DEFAULT_LOCATION])[0],
+                    required) as path:
+                yield path
+        else:
+            with utils.tempdir(
+                    prefix=prefix.encode('utf-8'),
+                    location=location.encode('utf-8')) as path:
+                yield path
+    finally:
+        os.unlink(state_path)
+        state.close()
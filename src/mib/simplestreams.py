@@ -0,0 +1,167 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Incremental updates of a simplestreams tree of the built images.
+
+Each product, an os, release and architecture, has its own products
+file, listed in the index of the tree. Publishing a version only
+rewrites the products file of its product and the index, never
+scanning the images, so its cost does not grow with the catalogue. It
+does grow with the versions of the product, as its products file is
+read and rewritten whole; versions no longer served should be pruned.
+Files are replaced atomically, under a lock of the tree, so readers and
+concurrent builds always see a complete tree.
+
+Layout of the tree::
+
+    streams/v1/index.json
+    streams/v1/<content id>.json
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+INDEX_PATH = os.path.join('streams', 'v1', 'index.json')
+DATATYPE = 'image-downloads'
+
+DEFAULT_CONTENT_PREFIX = 'com.ubuntu.maas:custom'
+
+
+class SimplestreamsError(Exception):
+    """Error class for simplestreams tree errors."""
+
+
+def get_timestamp():
+    """Returns the current time, as simplestreams formats it."""
+    return time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime())
+
+
+def get_product_id(prefix, os_name, release, arch):
+    """Returns the id of a product, without the release when there is
+    none."""
+    return ':'.join(
+        part for part in (prefix, os_name, release, arch) if part)
+
+
+@contextmanager
+def lock(tree):
+    """Context manager: holds the lock of the simplestreams `tree`."""
+    with open(os.path.join(tree, '.lock'), 'a') as stream:
+        fcntl.flock(stream, fcntl.LOCK_EX)
+        yield
+
+
+def read_json(path, default):
+    """Returns the JSON document at `path`, or `default` when there is
+    none."""
+    try:
+        with open(path, 'r') as stream:
+            return json.load(stream)
+    except FileNotFoundError:
+        return default
+
+
+def write_json(path, data):
+    """Writes the JSON document `data` to `path` atomically."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    descriptor, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(descriptor, 'w') as stream:
+            json.dump(data, stream, indent=1, sort_keys=True)
+            stream.write('\n')
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def add_version(tree, product_id, version, items, attributes=None):
+    """Adds `version` of the product to the simplestreams `tree`.
+
+    :param items: dict of item name to a dict with its `path`, relative
+        to `tree`, `size` and `sha256`
+    :param attributes: product attributes, such as os, release and arch
+    """
+    updated = get_timestamp()
+    products_path = os.path.join('streams', 'v1', product_id + '.json')
+    with lock(tree):
+        products = read_json(os.path.join(tree, products_path), {
+            'content_id': product_id,
+            'datatype': DATATYPE,
+            'format': 'products:1.0',
+            'products': {},
+            })
+        product = products['products'].setdefault(product_id, {})
+        product.update(attributes or {})
+        versions = product.setdefault('versions', {})
+        if version in versions:
+            raise SimplestreamsError(
+                "Version %s of %s is already published." % (
+                    version, product_id))
+        versions[version] = {
+            'items': {
+                name: dict(item, ftype=name)
+                for name, item in items.items()
+                },
+            }
+        products['updated'] = updated
+        write_json(os.path.join(tree, products_path), products)
+
+        index = read_json(os.path.join(tree, INDEX_PATH), {
+            'format': 'index:1.0',
+            'index': {},
+            })
+        index['index'][product_id] = {
+            'datatype': DATATYPE,
+            'format': 'products:1.0',
+            'path': products_path,
+            'products': [product_id],
+            'updated': updated,
+            }
+        index['updated'] = updated
+        write_json(os.path.join(tree, INDEX_PATH), index)
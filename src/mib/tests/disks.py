@@ -0,0 +1,82 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Small disk images for the tests, made with mkfs.ext4."""
+
+import shutil
+import struct
+import subprocess
+
+SECTOR_SIZE = 512
+
+# The partition starts 1 MiB in, as partitioning tools align it.
+PARTITION_START = 2048
+
+
+def has_mkfs_ext4():
+    """Returns True when e2fsprogs can populate a filesystem."""
+    return shutil.which('mkfs.ext4') is not None
+
+
+def make_ext4_image(path, root, size=16 * 1024 * 1024, options=()):
+    """Creates the disk image `path` of `size` bytes, holding one ext4
+    partition populated with the files at `root`.
+
+    :param options: extra `mkfs.ext4 -O` features, such as inline_data
+    """
+    sectors = size // SECTOR_SIZE
+    mbr = bytearray(SECTOR_SIZE)
+    struct.pack_into(
+        '<B3sB3sII', mbr, 446, 0, b'\0\0\0', 0x83, b'\0\0\0',
+        PARTITION_START, sectors - PARTITION_START)
+    mbr[510:512] = b'\x55\xaa'
+    with open(path, 'wb') as stream:
+        stream.write(mbr)
+        stream.truncate(size)
+    args = [
+        'mkfs.ext4', '-q', '-F', '-d', root,
+        '-E', 'offset=%d' % (PARTITION_START * SECTOR_SIZE),
+        ]
+    if options:
+        args.extend(['-O', ','.join(options)])
+    subprocess.check_call(
+        args + [path, '%dk' % ((sectors - PARTITION_START) // 2)])
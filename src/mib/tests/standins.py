@@ -0,0 +1,387 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Local stand-ins of the remote endpoints and the virtualization tools
+the builder talks to.
+
+The remote endpoints are HTTP servers on a free port of the loopback
+interface, running in a thread, that implement their protocol against
+in-memory state and can be told to fail requests. qemu and virsh are
+stood in for by small scripts playing a planned sequence of events.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from mib import objectstore
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """HTTP server serving a stand-in from a thread, as a context
+    manager."""
+
+    daemon_threads = True
+
+    def __init__(self, handler_class):
+        super(StandInServer, self).__init__(('127.0.0.1', 0), handler_class)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.thread = None
+
+    @property
+    def url(self):
+        """Returns the base URL of the server."""
+        return 'http://%s:%d' % self.server_address
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.thread.join()
+        self.server_close()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Request handler of a stand-in, recording each request."""
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def read_body(self):
+        """Returns the body of the request."""
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def reply(self, status, headers=None, body=b''):
+        """Sends the response."""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+class UploadHandler(StandInHandler):
+    """Resumable upload endpoint, as `mib.upload` describes it.
+
+    The server is an `UploadServer`, holding the received data of each
+    path and the failures to inject.
+    """
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        """Reports the offset of an upload."""
+        with self.server.lock:
+            self.server.requests.append(('HEAD', None))
+            data = self.server.uploads.get(self.path)
+        if data is None:
+            self.reply(404)
+        else:
+            self.reply(200, {'Upload-Offset': str(len(data))})
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """Stores a chunk of an upload, or fails as told."""
+        body = self.read_body()
+        content_range = self.headers['Content-Range']
+        with self.server.lock:
+            self.server.requests.append(('PUT', content_range))
+            failure = None
+            if self.server.failures:
+                failure = self.server.failures.pop(0)
+            if failure == 'reject':
+                # Failed before storing the chunk.
+                self.reply(503)
+                return
+            span, _, total = content_range[len('bytes '):].partition('/')
+            data = self.server.uploads.setdefault(self.path, bytearray())
+            if span != '*':
+                start = int(span.split('-')[0])
+                if start != len(data):
+                    self.reply(409)
+                    return
+                data += body
+            if total != '*':
+                if int(total) != len(data) or (
+                        self.headers['X-Upload-SHA256'] !=
+                        hashlib.sha256(data).hexdigest()):
+                    self.reply(400)
+                    return
+                self.server.complete.add(self.path)
+            if failure == 'lose-reply':
+                # Stored the chunk, but the client never learns it.
+                self.reply(500)
+                return
+        self.reply(200)
+
+
+class UploadServer(StandInServer):
+    """Stand-in of the upload endpoint.
+
+    :ivar failures: failures injected in the next PUT requests, in
+        order: 'reject' fails before storing the chunk, 'lose-reply'
+        after storing it, None lets the request succeed
+    """
+
+    def __init__(self):
+        super(UploadServer, self).__init__(UploadHandler)
+        self.uploads = {}
+        self.complete = set()
+        self.failures = []
+
+
+class ObjectStoreHandler(StandInHandler):
+    """S3-compatible object store, verifying the Signature Version 4 of
+    every request with the credentials of the `ObjectStoreServer`."""
+
+    def check_signature(self, payload_hash):
+        """Replies 403 and returns False unless the request is signed."""
+        authorization = self.headers.get('Authorization', '')
+        match = re.search(r'SignedHeaders=([^,]+)', authorization)
+        if match is None:
+            self.reply(403)
+            return False
+        headers = {
+            name: self.headers[name]
+            for name in match.group(1).split(';')}
+        expected = objectstore.get_authorization(
+            self.command, self.path, [], headers, payload_hash,
+            self.server.access_key, self.server.secret_key,
+            self.server.region, self.headers['x-amz-date'])
+        if authorization != expected:
+            self.reply(403)
+            return False
+        return True
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serves a stored object."""
+        with self.server.lock:
+            self.server.requests.append(('GET', self.path))
+        if not self.check_signature(self.headers['x-amz-content-sha256']):
+            return
+        with self.server.lock:
+            stored = self.server.objects.get(self.path)
+        if stored is None:
+            self.reply(404)
+            return
+        data, sha256 = stored
+        self.reply(200, {objectstore.SHA256_HEADER: sha256}, data)
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        """Stores an object."""
+        body = self.read_body()
+        with self.server.lock:
+            self.server.requests.append(('PUT', self.path))
+        payload_hash = self.headers['x-amz-content-sha256']
+        if payload_hash != hashlib.sha256(body).hexdigest():
+            self.reply(400)
+            return
+        if not self.check_signature(payload_hash):
+            return
+        with self.server.lock:
+            self.server.objects[self.path] = (
+                body, self.headers[objectstore.SHA256_HEADER])
+        self.reply(200)
+
+
+class ObjectStoreServer(StandInServer):
+    """Stand-in of an S3-compatible object store, holding its objects by
+    path, /BUCKET/KEY, as (data, sha256 metadata)."""
+
+    def __init__(self, access_key='access', secret_key='secret',
+                 region=objectstore.DEFAULT_REGION):
+        super(ObjectStoreServer, self).__init__(ObjectStoreHandler)
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.objects = {}
+
+
+class FileHandler(StandInHandler):
+    """Static files, read whole or by a single byte range."""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serves a file, or the byte range of it requested."""
+        range_header = self.headers.get('Range')
+        with self.server.lock:
+            self.server.requests.append(('GET', range_header))
+            data = self.server.files.get(self.path)
+        if data is None:
+            self.reply(404)
+            return
+        if range_header is None:
+            self.reply(200, body=data)
+            return
+        first, _, last = range_header[len('bytes='):].partition('-')
+        first, last = int(first), min(int(last), len(data) - 1)
+        self.reply(206, {
+            'Content-Range': 'bytes %d-%d/%d' % (first, last, len(data)),
+            }, data[first:last + 1])
+
+
+class FileServer(StandInServer):
+    """Stand-in of a mirror serving `files`, their data by path."""
+
+    def __init__(self, files=None):
+        super(FileServer, self).__init__(FileHandler)
+        self.files = dict(files or {})
+
+
+# Fake qemu, run with its JSON plan as first argument followed by the
+# arguments `QemuDomain` adds. It serves QMP on the -qmp socket, sends
+# the planned events once the capabilities are negotiated, then exits
+# with the planned code, or hangs until it is killed.
+QEMU_SCRIPT = """
+import json
+import socket
+import sys
+import time
+
+plan = json.loads(sys.argv[1])
+path = sys.argv[sys.argv.index('-qmp') + 1].split(',')[0][len('unix:'):]
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(path)
+server.listen(1)
+conn, _ = server.accept()
+reader = conn.makefile('rb')
+
+
+def send(message):
+    conn.sendall(json.dumps(message).encode('utf-8') + b'\\n')
+
+
+send({'QMP': {'version': {}, 'capabilities': []}})
+reader.readline()
+send({'return': {}})
+for event in plan['events']:
+    send(dict(event, timestamp={'seconds': 0, 'microseconds': 0}))
+if plan['hang']:
+    time.sleep(3600)
+conn.close()
+sys.exit(plan['exit_code'])
+"""
+
+
+def get_qemu_args(events=(), exit_code=0, hang=False):
+    """Returns the command line of a fake qemu, to start with
+    `VMDriver.start_qemu`.
+
+    :param events: (name, data) of the QMP events to send
+    :param exit_code: exit code once the events are sent
+    :param hang: keep running after the events, until killed
+    """
+    plan = {
+        'events': [
+            {'event': name, 'data': data} for name, data in events],
+        'exit_code': exit_code,
+        'hang': hang,
+        }
+    return [sys.executable, '-c', QEMU_SCRIPT, json.dumps(plan)]
+
+
+# Fake virsh, recording its command lines in commands.log next to it.
+# `virsh event` prints events.txt and then keeps running, or exits when
+# there is no hang file.
+VIRSH_SCRIPT = """
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(here, 'commands.log'), 'a') as stream:
+    stream.write(' '.join(sys.argv[1:]) + '\\n')
+if sys.argv[1] == 'event':
+    with open(os.path.join(here, 'events.txt')) as stream:
+        sys.stdout.write(stream.read())
+    sys.stdout.flush()
+    if os.path.exists(os.path.join(here, 'hang')):
+        time.sleep(3600)
+"""
+
+
+class FakeVirsh:
+    """Stand-in of virsh, put first on the PATH while used as a context
+    manager.
+
+    `virsh event` prints the lines `events` and keeps running until it
+    is terminated, or exits straight away without `hang`. Every command
+    succeeds, its arguments are in `commands` once the context exits.
+    """
+
+    def __init__(self, events=(), hang=True):
+        self.events = list(events)
+        self.hang = hang
+        self.commands = []
+        self.path = None
+        self.saved_path = None
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp()
+        script_path = os.path.join(self.path, 'virsh')
+        with open(script_path, 'w') as stream:
+            stream.write('#!%s\n%s' % (sys.executable, VIRSH_SCRIPT))
+        os.chmod(script_path, 0o755)
+        with open(os.path.join(self.path, 'events.txt'), 'w') as stream:
+            stream.writelines(line + '\n' for line in self.events)
+        if self.hang:
+            open(os.path.join(self.path, 'hang'), 'w').close()
+        self.saved_path = os.environ.get('PATH', '')
+        os.environ['PATH'] = self.path + os.pathsep + self.saved_path
+        return self
+
+    def __exit__(self, *exc_info):
+        os.environ['PATH'] = self.saved_path
+        log_path = os.path.join(self.path, 'commands.log')
+        if os.path.exists(log_path):
+            with open(log_path) as stream:
+                self.commands = [line.split() for line in stream]
+        shutil.rmtree(self.path)
@@ -0,0 +1,193 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Tests of the block index sidecars and of rebuilding an image from
+them."""
+
+import hashlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from mib import blockindex
+from mib.tests.standins import FileServer
+
+BLOCK_SIZE = 2048
+
+
+class BlockIndexTestCase(unittest.TestCase):
+    """Writes images and their indexes in a temporary directory."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.random = random.Random(42)
+
+    def random_bytes(self, size):
+        """Returns `size` reproducible random bytes."""
+        return bytes(self.random.getrandbits(8) for _ in range(size))
+
+    def write_image(self, name, data):
+        """Writes the image `name`, returning its path."""
+        path = os.path.join(self.workdir, name)
+        with open(path, 'wb') as stream:
+            stream.write(data)
+        return path
+
+
+class TestIndex(BlockIndexTestCase):
+    """Writing and reading back the sidecar."""
+
+    def test_round_trip(self):
+        """The header and the checksums of every block read back."""
+        data = self.random_bytes(5 * BLOCK_SIZE + 100)
+        path = self.write_image('image', data)
+        index_path = blockindex.write_index(path, block_size=BLOCK_SIZE)
+        self.assertEqual(path + blockindex.EXTENSION, index_path)
+        header, checksums = blockindex.read_index(index_path)
+        self.assertEqual(header, blockindex.read_header(index_path))
+        self.assertEqual('image', header['Filename'])
+        self.assertEqual(str(len(data)), header['Length'])
+        self.assertEqual(str(BLOCK_SIZE), header['Blocksize'])
+        self.assertEqual(
+            hashlib.sha256(data).hexdigest(), header['SHA-256'])
+        self.assertEqual(6, len(checksums))
+        last = data[5 * BLOCK_SIZE:] + b'\0' * (BLOCK_SIZE - 100)
+        self.assertEqual(
+            (zlib.adler32(last), hashlib.md5(last).digest()), checksums[-1])
+
+    def test_not_an_index(self):
+        """Other files are rejected."""
+        path = self.write_image('image', b'data\n\nmore')
+        with self.assertRaises(blockindex.BlockIndexError):
+            blockindex.read_index(path)
+        with self.assertRaises(blockindex.BlockIndexError):
+            blockindex.read_header(path)
+
+    def test_truncated(self):
+        """Indexes cut short are rejected."""
+        path = self.write_image('image', self.random_bytes(BLOCK_SIZE))
+        index_path = blockindex.write_index(path, block_size=BLOCK_SIZE)
+        with open(index_path, 'r+b') as stream:
+            stream.truncate(os.path.getsize(index_path) - 1)
+        with self.assertRaises(blockindex.BlockIndexError):
+            blockindex.read_index(index_path)
+
+    def test_roll_adler32(self):
+        """The rolled checksum is the adler32 of the shifted block."""
+        data = self.random_bytes(3 * BLOCK_SIZE)
+        checksum = zlib.adler32(data[:BLOCK_SIZE])
+        for offset in range(2 * BLOCK_SIZE):
+            checksum = blockindex.roll_adler32(
+                checksum, data[offset], data[offset + BLOCK_SIZE],
+                BLOCK_SIZE)
+            self.assertEqual(
+                zlib.adler32(data[offset + 1:offset + 1 + BLOCK_SIZE]),
+                checksum)
+
+
+class TestPatch(BlockIndexTestCase):
+    """Rebuilding a new image from the previous version."""
+
+    def setUp(self):
+        super(TestPatch, self).setUp()
+        self.old = self.random_bytes(40 * BLOCK_SIZE)
+        # Bytes inserted and removed shift the blocks that follow.
+        self.new = (
+            self.old[:10 * BLOCK_SIZE] + self.random_bytes(700) +
+            self.old[10 * BLOCK_SIZE:25 * BLOCK_SIZE] +
+            self.old[25 * BLOCK_SIZE + 300:] + self.random_bytes(50))
+        self.old_path = self.write_image('old', self.old)
+        self.index_path = blockindex.write_index(
+            self.write_image('new', self.new), block_size=BLOCK_SIZE)
+
+    def read_range(self, offset, length):
+        """Reads the new image, as a mirror would."""
+        return self.new[offset:offset + length]
+
+    def test_find_blocks(self):
+        """Unchanged blocks are found where they moved to."""
+        header, checksums = blockindex.read_index(self.index_path)
+        found = blockindex.find_blocks(header, checksums, self.old_path)
+        self.assertEqual(0, found[0])
+        self.assertEqual(11 * BLOCK_SIZE - 700, found[11])
+        self.assertGreaterEqual(len(found), 35)
+
+    def test_patch(self):
+        """The new image is rebuilt, only the changes are read."""
+        stream = io.BytesIO()
+        fetched = blockindex.patch(
+            self.index_path, self.old_path, self.read_range, stream)
+        self.assertEqual(self.new, stream.getvalue())
+        self.assertLess(fetched, 6 * BLOCK_SIZE)
+
+    def test_patch_without_old_version(self):
+        """Without a previous version everything is read."""
+        stream = io.BytesIO()
+        fetched = blockindex.patch(
+            self.index_path, self.write_image('empty', b''),
+            self.read_range, stream)
+        self.assertEqual(self.new, stream.getvalue())
+        self.assertEqual(len(self.new), fetched)
+
+    def test_patch_mismatch(self):
+        """Bytes not matching the index fail the rebuild."""
+        with self.assertRaises(blockindex.BlockIndexError):
+            blockindex.patch(
+                self.index_path, self.old_path,
+                lambda offset, length: b'\0' * length, io.BytesIO())
+
+    def test_patch_over_http(self):
+        """The changes are read with range requests."""
+        stream = io.BytesIO()
+        with FileServer({'/new': self.new}) as server:
+            blockindex.patch(
+                self.index_path, self.old_path,
+                blockindex.http_range_reader(server.url + '/new'), stream)
+        self.assertEqual(self.new, stream.getvalue())
+        self.assertTrue(server.requests)
+        self.assertTrue(all(
+            value.startswith('bytes=') for _, value in server.requests))
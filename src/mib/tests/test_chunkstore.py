@@ -0,0 +1,224 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Tests of the content-defined chunk store."""
+
+import hashlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from mib import chunkstore
+
+
+def random_bytes(seed, size):
+    """Returns `size` random bytes, the same for the same `seed`."""
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def get_chunks(data):
+    """Returns the chunks of `data`."""
+    return list(chunkstore.iter_chunks(io.BytesIO(data)))
+
+
+class TestChunking(unittest.TestCase):
+    """Boundaries depend on the content only."""
+
+    def setUp(self):
+        self.data = random_bytes(1, 24 * chunkstore.MEBIBYTE)
+        self.chunks = get_chunks(self.data)
+
+    def test_chunks(self):
+        """Chunks cover the data and respect the size bounds."""
+        self.assertEqual(self.data, b''.join(self.chunks))
+        self.assertGreater(len(self.chunks), 4)
+        for chunk in self.chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), chunkstore.MIN_CHUNK)
+            self.assertLessEqual(len(chunk), chunkstore.MAX_CHUNK)
+
+    def test_read_size(self):
+        """Boundaries do not depend on how the stream is read."""
+        with mock.patch.object(chunkstore, 'READ_SIZE', 100003):
+            self.assertEqual(self.chunks, get_chunks(self.data))
+
+    def test_without_markers(self):
+        """Data without markers is cut at the maximum chunk size."""
+        chunks = get_chunks(b'\0' * (2 * chunkstore.MAX_CHUNK + 10))
+        self.assertEqual(
+            [chunkstore.MAX_CHUNK, chunkstore.MAX_CHUNK, 10],
+            [len(chunk) for chunk in chunks])
+
+    def test_empty(self):
+        """Empty data has no chunks."""
+        self.assertEqual([], get_chunks(b''))
+
+    def assert_most_shared(self, data):
+        """Asserts that all chunks of `data` but two are shared with
+        the chunks of `self.data`."""
+        chunks = get_chunks(data)
+        self.assertEqual(data, b''.join(chunks))
+        shared = set(chunks) & set(self.chunks)
+        self.assertGreaterEqual(len(shared), len(self.chunks) - 2)
+        self.assertLessEqual(len(chunks) - len(shared), 2)
+
+    def test_insertion(self):
+        """An insertion only changes the chunks around it."""
+        middle = len(self.data) // 2
+        self.assert_most_shared(
+            self.data[:middle] + random_bytes(2, 1000) + self.data[middle:])
+
+    def test_deletion(self):
+        """A deletion only changes the chunks around it."""
+        middle = len(self.data) // 2
+        self.assert_most_shared(self.data[:middle] + self.data[middle + 1000:])
+
+
+class TestStore(unittest.TestCase):
+    """Adding, restoring and removing images."""
+
+    def setUp(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        self.store = os.path.join(workdir, 'store')
+        self.images = os.path.join(workdir, 'images')
+        os.mkdir(self.images)
+        self.data = random_bytes(1, 12 * chunkstore.MEBIBYTE)
+
+    def write_image(self, name, data):
+        """Writes the image `name`, returning its path."""
+        path = os.path.join(self.images, name)
+        with open(path, 'wb') as stream:
+            stream.write(data)
+        return path
+
+    def get_stored_size(self):
+        """Returns the bytes of all chunks in the store."""
+        return sum(
+            os.path.getsize(os.path.join(directory, filename))
+            for directory, _, filenames in os.walk(
+                os.path.join(self.store, 'chunks'))
+            for filename in filenames)
+
+    def restore(self, name, version):
+        """Returns the bytes of the restored image."""
+        stream = io.BytesIO()
+        chunkstore.restore(self.store, name, version, stream)
+        return stream.getvalue()
+
+    def test_round_trip(self):
+        """A stored image is restored as it was."""
+        index_path = chunkstore.add(
+            self.store, self.write_image('root.tar.gz', self.data),
+            version='1')
+        index = chunkstore.read_index(self.store, 'root.tar.gz', '1')
+        self.assertEqual(
+            chunkstore.get_index_path(self.store, 'root.tar.gz', '1'),
+            index_path)
+        self.assertEqual(len(self.data), index['size'])
+        self.assertEqual(hashlib.sha256(self.data).hexdigest(),
+                         index['sha256'])
+        self.assertEqual(self.data, self.restore('root.tar.gz', '1'))
+        self.assertEqual({'root.tar.gz': ['1']},
+                         chunkstore.list_images(self.store))
+
+    def test_dedup_versions(self):
+        """A new version only stores the chunks that changed."""
+        chunkstore.add(self.store, self.write_image('root', self.data),
+                       version='1')
+        first = self.get_stored_size()
+        new = self.data[:100] + b'inserted' + self.data[100:]
+        chunkstore.add(self.store, self.write_image('root', new),
+                       version='2')
+        self.assertLessEqual(
+            self.get_stored_size() - first, 2 * chunkstore.MAX_CHUNK)
+        self.assertLess(self.get_stored_size(), first + len(new) // 2)
+        self.assertEqual(self.data, self.restore('root', '1'))
+        self.assertEqual(new, self.restore('root', '2'))
+
+    def test_dedup_images(self):
+        """Images with the same content share their chunks."""
+        chunkstore.add(self.store, self.write_image('a', self.data),
+                       version='1')
+        first = self.get_stored_size()
+        chunkstore.add(self.store, self.write_image('b', self.data),
+                       version='1')
+        self.assertEqual(first, self.get_stored_size())
+        self.assertEqual(self.data, self.restore('b', '1'))
+
+    def test_remove(self):
+        """Removing an image frees only the chunks no other uses."""
+        chunkstore.add(self.store, self.write_image('a', self.data),
+                       version='1')
+        other = random_bytes(3, 2 * chunkstore.MEBIBYTE)
+        chunkstore.add(self.store, self.write_image('b', self.data + other),
+                       version='1')
+        freed = chunkstore.remove(self.store, 'b', '1')
+        self.assertGreaterEqual(freed, len(other))
+        self.assertEqual(len(self.data), self.get_stored_size())
+        self.assertEqual(self.data, self.restore('a', '1'))
+        self.assertEqual(len(self.data), chunkstore.remove(
+            self.store, 'a', '1'))
+        self.assertEqual(0, self.get_stored_size())
+        self.assertEqual({'a': [], 'b': []},
+                         chunkstore.list_images(self.store))
+
+    def test_missing_version(self):
+        """Restoring an unknown version fails."""
+        with self.assertRaises(chunkstore.ChunkStoreError):
+            self.restore('root', '1')
+
+    def test_corrupt_chunk(self):
+        """A corrupt chunk fails the restore."""
+        index_path = chunkstore.add(
+            self.store, self.write_image('root', self.data), version='1')
+        index = chunkstore.read_index(self.store, 'root', '1')
+        chunk_path = chunkstore.get_chunk_path(
+            self.store, index['chunks'][1][0])
+        with open(chunk_path, 'r+b') as stream:
+            stream.write(b'corrupt')
+        self.assertTrue(os.path.exists(index_path))
+        with self.assertRaises(chunkstore.ChunkStoreError):
+            self.restore('root', '1')
@@ -0,0 +1,202 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Tests of the installer console capture and progress parsing."""
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from mib.console import ConsoleFollower, ProgressEvent, ProgressParser
+
+CONSOLE = [
+    '[    0.000000] Linux version 3.10.0',
+    'Starting installer, one moment...',
+    'anaconda 21.48.22.147-1 for CentOS 7 started.',
+    '\x1b[1;32mCreating xfs on /dev/vda1\x1b[0m',
+    'Downloading 312 RPMs, 190.12 MiB / 250.00 MiB (76%)',
+    'Installing bash (1/312)',
+    'Installing kernel (2/312)',
+    'Performing post-installation setup tasks',
+    'Running post-installation scripts',
+    'Installing cloud-init',
+    '',
+    'Installation complete',
+    'reboot: Power down',
+    ]
+
+
+class TestProgressParser(unittest.TestCase):
+    """Parsing of console lines into progress events."""
+
+    def feed(self, parser, lines):
+        """Feeds `lines` a second apart, returning the events."""
+        events = []
+        for timestamp, line in enumerate(lines):
+            event = parser.feed(line, timestamp)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def test_stages(self):
+        """Milestones move through the stages of the installation."""
+        events = self.feed(ProgressParser(), CONSOLE)
+        self.assertEqual([
+            'boot', 'boot', 'storage', 'download', 'install', 'install',
+            'configure', 'post', 'post', 'complete', 'poweroff',
+            ], [event.stage for event in events])
+
+    def test_counters(self):
+        """Package counts and percentages are reported."""
+        parser = ProgressParser()
+        self.assertEqual(
+            ProgressEvent(1, 'install', 'Installing bash (1/312)', 1, 312),
+            parser.feed('Installing bash (1/312)', 1))
+        event = parser.feed(
+            'Downloading 312 RPMs, 1.00 MiB / 2.00 MiB (50%)', 2)
+        self.assertEqual((50, 100), (event.current, event.total))
+        event = parser.feed('Downloading packages', 3)
+        self.assertEqual((None, None), (event.current, event.total))
+
+    def test_escapes(self):
+        """Escape sequences and surrounding space are removed."""
+        event = ProgressParser().feed(
+            '\x1b[?25l  \x1b[1mInstallation complete\x1b[0m \r', 0)
+        self.assertEqual('Installation complete', event.message)
+
+    def test_other_lines(self):
+        """Lines that are no milestone are ignored, except while the
+        post-installation scripts run."""
+        parser = ProgressParser()
+        self.assertIsNone(parser.feed('random output', 0))
+        self.assertIsNone(parser.feed('   ', 0))
+        parser.feed('Running post-installation scripts', 1)
+        self.assertEqual(
+            ProgressEvent(2, 'post', 'random output', None, None),
+            parser.feed('random output', 2))
+
+    def test_durations(self):
+        """The time spent in each stage is added up."""
+        parser = ProgressParser()
+        self.feed(parser, CONSOLE)
+        parser.finish(len(CONSOLE))
+        self.assertEqual([
+            ('boot', 2), ('storage', 1), ('download', 1), ('install', 2),
+            ('configure', 1), ('post', 3), ('complete', 1), ('poweroff', 1),
+            ], list(parser.durations.items()))
+        self.assertIsNone(parser.stage)
+
+    def test_custom_patterns(self):
+        """Other installers are parsed with their own patterns."""
+        parser = ProgressParser([('setup', re.compile(r'^Setup'))])
+        self.assertEqual('setup', parser.feed('Setup started', 0).stage)
+        self.assertIsNone(parser.feed('Installation complete', 1))
+
+
+class TestConsoleFollower(unittest.TestCase):
+    """Following the console log while it is written."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, 'console.log')
+        self.progress_path = os.path.join(self.workdir, 'progress.json')
+        self.follower = ConsoleFollower(
+            self.path, progress_path=self.progress_path, tail_lines=3)
+        self.addCleanup(self.follower.close)
+        self.events = []
+        self.follower.add_callback(self.events.append)
+
+    def write(self, data):
+        """Appends `data` to the console log."""
+        with open(self.path, 'ab') as stream:
+            stream.write(data)
+
+    def test_missing_log(self):
+        """The log is read once the VM created it."""
+        self.follower.read()
+        self.write(b'Starting installer\n')
+        self.follower.read()
+        self.assertEqual(['boot'], [event.stage for event in self.events])
+
+    def test_partial_lines(self):
+        """Lines are parsed once complete, with any line ending."""
+        self.write(b'Starting inst')
+        self.follower.read()
+        self.assertEqual([], self.events)
+        self.write(b'aller\r\nInstalling bash (1/2)\r')
+        self.follower.read()
+        self.assertEqual(
+            ['boot', 'install'], [event.stage for event in self.events])
+        self.assertEqual(
+            ['Starting installer', 'Installing bash (1/2)'],
+            self.follower.tail())
+
+    def test_tail(self):
+        """Only the last lines are kept."""
+        self.write(''.join(line + '\n' for line in CONSOLE).encode('utf-8'))
+        self.follower.read()
+        self.assertEqual(CONSOLE[-4:-3] + CONSOLE[-2:], self.follower.tail())
+
+    def test_progress(self):
+        """Events are recorded as JSON lines."""
+        self.write(b'Installing bash (1/2)\nInstallation complete\n')
+        self.follower.close()
+        with open(self.progress_path) as stream:
+            records = [json.loads(line) for line in stream]
+        self.assertEqual(
+            ['install', 'complete'], [record['stage'] for record in records])
+        self.assertEqual(1, records[0]['current'])
+        self.assertIn(
+            'complete', self.follower.parser.durations)
+
+    def test_activity(self):
+        """New output is recorded as activity."""
+        self.follower.last_activity = 0
+        self.follower.read()
+        self.assertEqual(0, self.follower.last_activity)
+        self.write(b'output')
+        self.follower.read()
+        self.assertGreater(self.follower.last_activity, 0)
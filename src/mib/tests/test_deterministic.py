@@ -0,0 +1,213 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Tests of the deterministic outputs: building the same files twice
+gives the same bytes."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mib import outputs, utils
+from mib.tests import disks
+
+EPOCH = 1500000000
+
+
+def make_tree(path):
+    """Creates a small tree of files at `path`, newer than `EPOCH`."""
+    os.makedirs(os.path.join(path, 'etc', 'ssh'))
+    os.makedirs(os.path.join(path, 'usr', 'bin'))
+    with open(os.path.join(path, 'etc', 'hostname'), 'w') as stream:
+        stream.write('image\n')
+    with open(os.path.join(path, 'usr', 'bin', 'ping'), 'wb') as stream:
+        stream.write(os.urandom(64 * 1024))
+    os.chmod(os.path.join(path, 'usr', 'bin', 'ping'), 0o755)
+    os.setxattr(
+        os.path.join(path, 'usr', 'bin', 'ping'), 'user.capability',
+        b'\x01\x00\x00\x02\x00\x20\x00\x00\xff')
+    os.symlink('hostname', os.path.join(path, 'etc', 'name'))
+    os.link(
+        os.path.join(path, 'etc', 'hostname'),
+        os.path.join(path, 'etc', 'hostname.bak'))
+
+
+def touch_tree(path, when):
+    """Changes the access and change times of every file at `path`,
+    leaving their modification times."""
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            name = os.path.join(root, name)
+            stat = os.lstat(name)
+            os.utime(
+                name, (when, stat.st_mtime), follow_symlinks=False)
+
+
+def read_bytes(path):
+    """Returns the contents of the file at `path`."""
+    with open(path, 'rb') as stream:
+        return stream.read()
+
+
+class DeterministicTestCase(unittest.TestCase):
+    """Builds the outputs of a tree of files in a temporary directory."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.root = os.path.join(self.workdir, 'root')
+        make_tree(self.root)
+
+    def assertBuildsSame(self, build):  # pylint: disable=invalid-name
+        """Runs `build(run)` twice, touching the files in between, and
+        checks both runs wrote the same bytes to the paths it returns."""
+        first = second = None
+        for run in range(2):
+            touch_tree(self.root, EPOCH + 1000 + run)
+            paths = build('%s/run-%d' % (self.workdir, run))
+            first, second = second, [read_bytes(path) for path in paths]
+        self.assertEqual(len(first), len(second))
+        for first_bytes, second_bytes in zip(first, second):
+            self.assertEqual(first_bytes, second_bytes)
+
+
+class TestCreateTarball(DeterministicTestCase):
+    """`utils.create_tarball` with an epoch."""
+
+    def build(self, prefix, rsyncable=False):
+        """Creates the tarball of the tree."""
+        output = prefix + '.tar.gz'
+        utils.run_async(utils.create_tarball(
+            output, self.root, rsyncable=rsyncable, epoch=EPOCH))
+        return [output]
+
+    def test_same_bytes(self):
+        """The same tree gives the same tarball."""
+        self.assertBuildsSame(self.build)
+
+    def test_same_bytes_rsyncable(self):
+        """The same tree gives the same rsyncable tarball."""
+        self.assertBuildsSame(
+            lambda prefix: self.build(prefix, rsyncable=True))
+
+
+class TestWriteFilesystemFormats(DeterministicTestCase):
+    """`outputs.write_filesystem_formats` from the mounted tree."""
+
+    def build(self, prefix, formats):
+        """Writes `formats` and the manifest of the tree."""
+        paths = outputs.get_output_paths(prefix, formats)
+        manifest_path = prefix + '.manifest.gz'
+        utils.run_async(outputs.write_filesystem_formats(
+            self.root, paths,
+            squashfs_args=outputs.get_squashfs_args('gzip', epoch=EPOCH),
+            epoch=EPOCH, manifest_path=manifest_path))
+        return [paths[name] for name in formats] + [manifest_path]
+
+    def test_root_tgz(self):
+        """The same tree gives the same root-tgz and manifest."""
+        self.assertBuildsSame(
+            lambda prefix: self.build(prefix, ['root-tgz']))
+
+    @unittest.skipUnless(shutil.which('mksquashfs'), 'needs mksquashfs')
+    def test_squashfs(self):
+        """The same tree gives the same squashfs."""
+        self.assertBuildsSame(
+            lambda prefix: self.build(prefix, ['root-tgz', 'squashfs']))
+
+
+@unittest.skipUnless(disks.has_mkfs_ext4(), 'needs mkfs.ext4')
+class TestStreamFilesystemFormats(DeterministicTestCase):
+    """`outputs.stream_filesystem_formats` through the ext4 reader, from
+    a new disk image each time."""
+
+    def build(self, prefix, formats):
+        """Makes a disk image of the tree and streams `formats` and the
+        manifest of its files out of it."""
+        disk_path = prefix + '.img'
+        disks.make_ext4_image(disk_path, self.root)
+        extra_path = prefix + '-extra'
+        os.makedirs(os.path.join(extra_path, 'curtin'))
+        with open(os.path.join(extra_path, 'curtin', 'hook'), 'w') as stream:
+            stream.write('#!/bin/sh\n')
+        paths = outputs.get_output_paths(prefix, formats)
+        manifest_path = prefix + '.manifest.gz'
+        outputs.stream_filesystem_formats(
+            disk_path, paths, extra_path=extra_path,
+            squashfs_args=outputs.get_squashfs_args('gzip', epoch=EPOCH),
+            epoch=EPOCH, manifest_path=manifest_path)
+        return [paths[name] for name in formats] + [manifest_path]
+
+    def test_root_tgz(self):
+        """The same files give the same root-tgz and manifest."""
+        self.assertBuildsSame(
+            lambda prefix: self.build(prefix, ['root-tgz']))
+
+    @unittest.skipUnless(outputs.has_sqfstar(), 'needs sqfstar')
+    def test_squashfs(self):
+        """The same files give the same squashfs."""
+        self.assertBuildsSame(
+            lambda prefix: self.build(prefix, ['root-tgz', 'squashfs']))
+
+
+@unittest.skipUnless(shutil.which('qemu-img'), 'needs qemu-img')
+class TestWriteBlockFormats(DeterministicTestCase):
+    """`outputs.write_block_formats` from a disk image."""
+
+    def setUp(self):
+        super().setUp()
+        self.disk_path = os.path.join(self.workdir, 'disk.img')
+        with open(self.disk_path, 'wb') as stream:
+            stream.write(os.urandom(1024 * 1024))
+            stream.truncate(8 * 1024 * 1024)
+
+    def build(self, prefix):
+        """Writes the ddtgz of the disk image."""
+        paths = outputs.get_output_paths(prefix, ['ddtgz'])
+        utils.run_async(outputs.write_block_formats(
+            self.disk_path, paths, self.workdir, epoch=EPOCH))
+        return [paths['ddtgz']]
+
+    def test_ddtgz(self):
+        """The same disk image gives the same ddtgz."""
+        self.assertBuildsSame(self.build)
@@ -0,0 +1,254 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Tests of the VM driver, against the qemu and virsh stand-ins."""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from mib import driver, utils
+from mib.driver import LibvirtDomain, LibvirtEvents, VMDriver, VMError
+from mib.tests.standins import FakeVirsh, get_qemu_args
+
+GUEST_SHUTDOWN = ('SHUTDOWN', {'guest': True, 'reason': 'guest-shutdown'})
+
+
+class TestQemuDomain(unittest.TestCase):
+    """QMP events of a fake qemu, through `VMDriver.wait`."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def wait(self, timeout=None, **kwargs):
+        """Starts a fake qemu, planned with `kwargs`, and waits for it.
+
+        :returns: the domain and the `VMError` of the wait, if any.
+        """
+        async def run():
+            vm_driver = VMDriver()
+            try:
+                domain = await vm_driver.start_qemu(
+                    'test', get_qemu_args(**kwargs),
+                    os.path.join(self.workdir, 'qmp.sock'))
+                try:
+                    await vm_driver.wait(domain, timeout=timeout)
+                except VMError as error:
+                    return domain, error
+                return domain, None
+            finally:
+                await vm_driver.close()
+
+        return utils.run_async(run())
+
+    def assertEvents(self, domain, events):  # pylint: disable=invalid-name
+        """Checks the lifecycle events recorded for `domain`."""
+        self.assertEqual(events, [event for _, event in domain.events])
+
+    def test_shutdown(self):
+        """A shutdown by the guest is a clean shutdown."""
+        domain, error = self.wait(events=[GUEST_SHUTDOWN])
+        self.assertIsNone(error)
+        self.assertEqual(driver.SHUTDOWN, domain.result)
+
+    def test_reset(self):
+        """A reset is a reboot, the domain keeps running."""
+        domain, error = self.wait(events=[
+            ('RESET', {'guest': True, 'reason': 'guest-reset'}),
+            GUEST_SHUTDOWN,
+            ])
+        self.assertIsNone(error)
+        self.assertEvents(domain, [driver.REBOOT, driver.SHUTDOWN])
+
+    def test_shutdown_on_panic(self):
+        """A shutdown caused by a guest panic is a crash."""
+        domain, error = self.wait(events=[
+            ('SHUTDOWN', {'guest': True, 'reason': 'guest-panic'})])
+        self.assertIsInstance(error, VMError)
+        self.assertEqual(driver.CRASHED, domain.result)
+
+    def test_shutdown_by_host(self):
+        """A shutdown not caused by the guest destroyed it."""
+        domain, error = self.wait(events=[
+            ('SHUTDOWN', {'guest': False, 'reason': 'host-qmp-quit'})])
+        self.assertIsInstance(error, VMError)
+        self.assertEqual(driver.DESTROYED, domain.result)
+
+    def test_guest_panicked(self):
+        """A guest panic is a crash, also when qemu keeps running."""
+        domain, error = self.wait(
+            events=[('GUEST_PANICKED', {'action': 'pause'})], hang=True)
+        self.assertIsInstance(error, VMError)
+        self.assertEqual(driver.CRASHED, domain.result)
+        self.assertIsNotNone(domain.process.returncode)
+
+    def test_eof_clean_exit(self):
+        """qemu exiting cleanly without an event is a shutdown."""
+        domain, error = self.wait(exit_code=0)
+        self.assertIsNone(error)
+        self.assertEqual(driver.SHUTDOWN, domain.result)
+
+    def test_eof_failed_exit(self):
+        """qemu failing without an event is a crash."""
+        domain, error = self.wait(exit_code=1)
+        self.assertIsInstance(error, VMError)
+        self.assertEqual(driver.CRASHED, domain.result)
+
+    def test_timeout(self):
+        """Timing out destroys the domain."""
+        domain, error = self.wait(hang=True, timeout=0.5)
+        self.assertIn('Timed out', str(error))
+        self.assertEqual(driver.DESTROYED, domain.result)
+        self.assertIsNotNone(domain.process.returncode)
+
+    def test_cancel(self):
+        """Cancelling the wait destroys the domain."""
+        async def run():
+            vm_driver = VMDriver()
+            try:
+                domain = await vm_driver.start_qemu(
+                    'test', get_qemu_args(hang=True),
+                    os.path.join(self.workdir, 'qmp.sock'))
+                task = asyncio.ensure_future(vm_driver.wait(domain))
+                await asyncio.sleep(0.2)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                return domain
+            finally:
+                await vm_driver.close()
+
+        domain = utils.run_async(run())
+        self.assertEqual(driver.DESTROYED, domain.result)
+        self.assertIsNotNone(domain.process.returncode)
+
+
+class TestLibvirtEvents(unittest.TestCase):
+    """Lines of `virsh event` output."""
+
+    def setUp(self):
+        self.events = LibvirtEvents()
+        self.domain = LibvirtDomain('img-build')
+        self.events.domains['img-build'] = self.domain
+
+    def handle(self, line):
+        """Handles `line`, returning the events of the domain."""
+        self.events.handle_line(line)
+        return [event for _, event in self.domain.events]
+
+    def test_shutdown(self):
+        """A stopped domain shut down."""
+        self.assertEqual([driver.SHUTDOWN], self.handle(
+            "event 'lifecycle' for domain 'img-build': Stopped Shutdown"))
+
+    def test_reboot(self):
+        """A reboot is reported as such."""
+        self.assertEqual([driver.REBOOT], self.handle(
+            "event 'reboot' for domain 'img-build'"))
+
+    def test_crashed(self):
+        """A crashed domain, paused or stopped, crashed."""
+        self.assertEqual([driver.CRASHED], self.handle(
+            "event 'lifecycle' for domain 'img-build': Crashed Panicked"))
+
+    def test_destroyed(self):
+        """A destroyed domain was destroyed."""
+        self.assertEqual([driver.DESTROYED], self.handle(
+            "event 'lifecycle' for domain img-build: Stopped Destroyed"))
+
+    def test_other_domain(self):
+        """Events of other domains are ignored."""
+        self.assertEqual([], self.handle(
+            "event 'lifecycle' for domain 'other': Stopped Shutdown"))
+
+
+class TestLibvirtDomain(unittest.TestCase):
+    """Libvirt domains through `VMDriver.wait`, against a fake virsh."""
+
+    def wait(self, timeout=None):
+        """Follows a domain and waits for it.
+
+        :returns: the domain and the `VMError` of the wait, if any.
+        """
+        async def run():
+            vm_driver = VMDriver()
+            try:
+                domain = vm_driver.watch_libvirt('img-build')
+                try:
+                    await vm_driver.wait(domain, timeout=timeout)
+                except VMError as error:
+                    return domain, error
+                return domain, None
+            finally:
+                await vm_driver.close()
+
+        return utils.run_async(run())
+
+    def test_shutdown(self):
+        """The domain shuts down after rebooting."""
+        with FakeVirsh([
+                "event 'reboot' for domain 'img-build'",
+                "event 'lifecycle' for domain 'img-build': Stopped Shutdown",
+                ]):
+            domain, error = self.wait()
+        self.assertIsNone(error)
+        self.assertEqual(
+            [driver.REBOOT, driver.SHUTDOWN],
+            [event for _, event in domain.events])
+
+    def test_timeout(self):
+        """Timing out destroys the domain."""
+        with FakeVirsh() as virsh:
+            domain, error = self.wait(timeout=0.5)
+        self.assertIn('Timed out', str(error))
+        self.assertEqual(driver.DESTROYED, domain.result)
+        self.assertIn(['destroy', 'img-build'], virsh.commands)
+
+    def test_eof(self):
+        """Losing the event stream is a crash."""
+        with FakeVirsh(hang=False):
+            domain, error = self.wait(timeout=10)
+        self.assertIsInstance(error, VMError)
+        self.assertEqual(driver.CRASHED, domain.result)
@@ -0,0 +1,245 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Tests of the ext4 reader, against disk images made with mkfs.ext4."""
+
+import hashlib
+import io
+import os
+import shutil
+import stat
+import struct
+import tarfile
+import tempfile
+import unittest
+
+from mib import ext4
+from mib.tests import disks
+
+CAPABILITY = b'\x01\x00\x00\x02\x00\x20\x00\x00\xff' + b'\0' * 11
+
+# ACL in the format of the system.posix_acl_access xattr.
+ACL = struct.pack('<I', 2) + b''.join(
+    struct.pack('<HHI', tag, perm, qualifier)
+    for tag, perm, qualifier in [
+        (0x01, 6, 0xffffffff), (0x02, 4, 1000), (0x04, 4, 0xffffffff),
+        (0x10, 4, 0xffffffff), (0x20, 4, 0xffffffff)])
+
+IS_ROOT = os.geteuid() == 0
+
+
+def make_tree(root):
+    """Creates files of every type the reader handles at `root`."""
+    os.makedirs(os.path.join(root, 'etc'))
+    os.makedirs(os.path.join(root, 'usr', 'bin'))
+    # Small enough to be stored inline in the inode.
+    with open(os.path.join(root, 'etc', 'hostname'), 'w') as stream:
+        stream.write('image\n')
+    os.setxattr(
+        os.path.join(root, 'etc', 'hostname'), 'user.note', b'hello')
+    os.setxattr(
+        os.path.join(root, 'etc', 'hostname'), 'system.posix_acl_access',
+        ACL)
+    ping = os.path.join(root, 'usr', 'bin', 'ping')
+    with open(ping, 'wb') as stream:
+        stream.write(os.urandom(300 * 1024))
+    os.chmod(ping, 0o4755)
+    os.link(ping, os.path.join(root, 'usr', 'bin', 'ping6'))
+    os.mkfifo(os.path.join(root, 'etc', 'initctl'))
+    os.symlink('hostname', os.path.join(root, 'etc', 'name'))
+    os.symlink('x' * 200, os.path.join(root, 'etc', 'long'))
+    os.utime(os.path.join(root, 'etc', 'hostname'), (2000, 2000))
+    if IS_ROOT:
+        os.setxattr(ping, 'security.capability', CAPABILITY)
+        os.mknod(
+            os.path.join(root, 'etc', 'null'), 0o666 | stat.S_IFCHR,
+            os.makedev(1, 3))
+
+
+@unittest.skipUnless(disks.has_mkfs_ext4(), 'needs mkfs.ext4')
+class TestExt4Filesystem(unittest.TestCase):
+    """Reads a disk image holding an inline_data ext4 filesystem."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        cls.root = os.path.join(cls.workdir, 'root')
+        make_tree(cls.root)
+        cls.disk_path = os.path.join(cls.workdir, 'disk.img')
+        disks.make_ext4_image(
+            cls.disk_path, cls.root, options=('inline_data',))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir)
+
+    def write_tar(self, **kwargs):
+        """Returns the tar archive of the filesystem, as bytes."""
+        stream = io.BytesIO()
+        with ext4.Ext4Filesystem(self.disk_path, partition=0) as filesystem:
+            ext4.write_tar(filesystem, stream, **kwargs)
+        return stream.getvalue()
+
+    def read_tar(self, **kwargs):
+        """Returns the members of the tar archive of the filesystem, by
+        name, with the data of the regular files."""
+        members = {}
+        with tarfile.open(fileobj=io.BytesIO(self.write_tar(**kwargs))) as tar:
+            for info in tar:
+                data = None
+                if info.isreg():
+                    data = tar.extractfile(info).read()
+                members[info.name] = (info, data)
+        return members
+
+    def test_walk(self):
+        """Every file is walked, in name order."""
+        with ext4.Ext4Filesystem(self.disk_path, partition=0) as filesystem:
+            paths = [path for path, _ in filesystem.walk()]
+        self.assertEqual('.', paths[0])
+        self.assertIn('./etc/hostname', paths)
+        self.assertIn('./usr/bin/ping6', paths)
+        self.assertLess(paths.index('./etc'), paths.index('./usr'))
+
+    def test_file_data(self):
+        """Inline and extent mapped data reads back."""
+        members = self.read_tar()
+        for name in ('etc/hostname', 'usr/bin/ping'):
+            with open(os.path.join(self.root, name), 'rb') as stream:
+                self.assertEqual(stream.read(), members['./' + name][1])
+
+    def test_attributes(self):
+        """Modes, including setuid, and modification times are kept."""
+        members = self.read_tar()
+        self.assertEqual(0o4755, members['./usr/bin/ping'][0].mode)
+        self.assertEqual(2000, members['./etc/hostname'][0].mtime)
+
+    def test_mtime_clamped(self):
+        """Modification times are clamped to `mtime`."""
+        members = self.read_tar(mtime=1000)
+        self.assertEqual(
+            {1000}, {info.mtime for info, _ in members.values()})
+
+    def test_special_files(self):
+        """Hardlinks, symlinks and fifos are archived as such."""
+        members = self.read_tar()
+        ping6 = members['./usr/bin/ping6'][0]
+        self.assertTrue(ping6.islnk())
+        self.assertEqual('./usr/bin/ping', ping6.linkname)
+        self.assertEqual('hostname', members['./etc/name'][0].linkname)
+        self.assertEqual('x' * 200, members['./etc/long'][0].linkname)
+        self.assertTrue(members['./etc/initctl'][0].isfifo())
+
+    @unittest.skipUnless(IS_ROOT, 'needs root to create devices')
+    def test_devices(self):
+        """Device numbers are kept."""
+        null = self.read_tar()['./etc/null'][0]
+        self.assertTrue(null.ischr())
+        self.assertEqual((1, 3), (null.devmajor, null.devminor))
+
+    def test_xattrs_and_acls(self):
+        """Extended attributes and ACLs are kept in pax headers."""
+        headers = self.read_tar()['./etc/hostname'][0].pax_headers
+        self.assertEqual('hello', headers['SCHILY.xattr.user.note'])
+        self.assertEqual(
+            'user::rw-,user:1000:r--,group::r--,mask::r--,other::r--',
+            headers['SCHILY.acl.access'])
+        self.assertNotIn('SCHILY.xattr.system.posix_acl_access', headers)
+
+    @unittest.skipUnless(IS_ROOT, 'needs root to set capabilities')
+    def test_binary_xattrs(self):
+        """Binary xattrs are written as raw bytes, without hdrcharset."""
+        data = self.write_tar()
+        self.assertNotIn(b'hdrcharset', data)
+        self.assertIn(b'SCHILY.xattr.security.capability=' + CAPABILITY, data)
+
+    def test_manifest(self):
+        """Files are added to the manifest with their sha256."""
+        entries = []
+
+        class Manifest:  # pylint: disable=too-few-public-methods
+            """Records the entries."""
+
+            @staticmethod
+            def add(info, sha256=None):
+                """Records `info`."""
+                entries.append((info.name, sha256))
+
+        self.write_tar(manifest=Manifest())
+        ping = os.path.join(self.root, 'usr', 'bin', 'ping')
+        with open(ping, 'rb') as stream:
+            digest = hashlib.sha256(stream.read()).hexdigest()
+        self.assertIn(('./usr/bin/ping', digest), entries)
+        self.assertIn(('./usr/bin/ping6', None), entries)
+
+    def test_extra_path(self):
+        """The files of `extra_path` follow those of the filesystem."""
+        extra_path = os.path.join(self.workdir, 'extra')
+        os.makedirs(os.path.join(extra_path, 'curtin'), exist_ok=True)
+        with open(os.path.join(extra_path, 'curtin', 'hook'), 'wb') as stream:
+            stream.write(b'#!/bin/sh\n')
+        members = self.read_tar(extra_path=extra_path)
+        self.assertEqual(b'#!/bin/sh\n', members['./curtin/hook'][1])
+
+    def test_is_ext4(self):
+        """Only ext4 partitions are recognised."""
+        self.assertTrue(ext4.is_ext4(self.disk_path))
+        self.assertFalse(ext4.is_ext4(
+            os.path.join(self.root, 'usr', 'bin', 'ping')))
+
+
+class TestPaxRecords(unittest.TestCase):
+    """Records of the pax extended headers."""
+
+    def test_length_counts_itself(self):
+        """The length of a record includes its own digits."""
+        for size in range(80, 120):
+            records = ext4.get_pax_records({'key': 'v' * size})
+            length, _, _ = records.partition(b' ')
+            self.assertEqual(int(length), len(records))
+
+    def test_raw_bytes(self):
+        """Values decoded with surrogateescape are written back raw."""
+        self.assertEqual(
+            b'9 key=\x01\xff\n',
+            ext4.get_pax_records({'key': b'\x01\xff'.decode(
+                'utf-8', 'surrogateescape')}))
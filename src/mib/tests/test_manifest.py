@@ -0,0 +1,129 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Tests of the per-file manifests."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from mib import manifest
+
+
+class TestManifest(unittest.TestCase):
+    """Manifests of directories, read back and compared."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+
+    def make_tree(self, name, files):
+        """Creates the directory `name` holding `files`, by path, and
+        returns the path of its manifest."""
+        root = os.path.join(self.workdir, name)
+        os.makedirs(root)
+        for path, data in files.items():
+            path = os.path.join(root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as stream:
+                stream.write(data)
+        manifest_path = os.path.join(self.workdir, name + manifest.EXTENSION)
+        manifest.write_directory_manifest(root, manifest_path)
+        return manifest_path
+
+    def test_read_manifest(self):
+        """Every file is listed with its type, size and sha256."""
+        path = self.make_tree('image', {'etc/hostname': b'image\n'})
+        os.symlink('hostname', os.path.join(self.workdir, 'image', 'x'))
+        manifest.write_directory_manifest(
+            os.path.join(self.workdir, 'image'), path)
+        entries = manifest.read_manifest(path)
+        self.assertEqual(
+            ['.', './etc', './etc/hostname', './x'], sorted(entries))
+        self.assertEqual('directory', entries['./etc']['type'])
+        self.assertEqual('file', entries['./etc/hostname']['type'])
+        self.assertEqual(6, entries['./etc/hostname']['size'])
+        self.assertEqual(
+            hashlib.sha256(b'image\n').hexdigest(),
+            entries['./etc/hostname']['sha256'])
+        self.assertEqual('symlink', entries['./x']['type'])
+        self.assertEqual('hostname', entries['./x']['link'])
+
+    def test_same_content_same_bytes(self):
+        """Manifests of the same files are identical."""
+        files = {'etc/hostname': b'image\n', 'usr/bin/true': b'\0' * 100}
+        first = self.make_tree('first', files)
+        second = self.make_tree('second', files)
+        with open(first, 'rb') as stream:
+            first_bytes = stream.read()
+        with open(second, 'rb') as stream:
+            self.assertEqual(first_bytes, stream.read())
+
+    def test_diff(self):
+        """Added, removed and changed paths are listed in path order."""
+        old = manifest.read_manifest(self.make_tree('old', {
+            'etc/hostname': b'old\n',
+            'etc/motd': b'hello\n',
+            'usr/bin/true': b'\0',
+            }))
+        new = manifest.read_manifest(self.make_tree('new', {
+            'etc/hostname': b'new-name\n',
+            'etc/issue': b'welcome\n',
+            'usr/bin/true': b'\0',
+            }))
+        self.assertEqual(
+            (['./etc/issue'], ['./etc/motd'], ['./etc/hostname']),
+            manifest.diff(old, new))
+        self.assertEqual([
+            'M ./etc/hostname (sha256, size)',
+            '+ ./etc/issue',
+            '- ./etc/motd',
+            ], list(manifest.format_diff(old, new)))
+
+    def test_diff_unchanged(self):
+        """Nothing is listed between manifests of the same files."""
+        files = {'etc/hostname': b'image\n'}
+        old = manifest.read_manifest(self.make_tree('old', files))
+        new = manifest.read_manifest(self.make_tree('new', files))
+        self.assertEqual([], list(manifest.format_diff(old, new)))
@@ -0,0 +1,138 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Tests of the streaming uploads, against the upload stand-in."""
+
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from mib import upload
+from mib.tests.standins import UploadServer
+
+
+class TestUploader(unittest.TestCase):
+    """Uploads through `Uploader.upload`, with injected failures."""
+
+    def setUp(self):
+        self.data = os.urandom(10 * 1024 + 123)
+        descriptor, self.path = tempfile.mkstemp()
+        with os.fdopen(descriptor, 'wb') as stream:
+            stream.write(self.data)
+        self.addCleanup(os.unlink, self.path)
+        # No backoff between the retries.
+        patcher = mock.patch.object(upload.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, server, retries=upload.RETRIES):
+        """Uploads the test file to `server`, returning its result."""
+        source = upload.FileFollower(self.path, growing=False)
+        source.finish()
+        uploader = upload.Uploader(
+            server.url + '/image', chunk_size=1024, retries=retries)
+        return uploader.upload(source)
+
+    def assertUploaded(self, server, result):  # pylint: disable=invalid-name
+        """Checks that the server has the whole test file."""
+        self.assertEqual(
+            (len(self.data), hashlib.sha256(self.data).hexdigest()), result)
+        self.assertEqual(self.data, bytes(server.uploads['/image']))
+        self.assertIn('/image', server.complete)
+
+    def test_upload(self):
+        """The file is uploaded chunk by chunk."""
+        with UploadServer() as server:
+            result = self.upload(server)
+        self.assertUploaded(server, result)
+        puts = [value for method, value in server.requests if method == 'PUT']
+        self.assertEqual(11, len(puts))
+        self.assertEqual('bytes 0-1023/*', puts[0])
+        self.assertEqual(
+            'bytes 10240-10362/%d' % len(self.data), puts[-1])
+
+    def test_retries_rejected_chunks(self):
+        """Rejected chunks are sent again."""
+        with UploadServer() as server:
+            server.failures = [None, 'reject', None, 'reject', 'reject']
+            result = self.upload(server)
+        self.assertUploaded(server, result)
+
+    def test_resumes_from_server_offset(self):
+        """Lost replies resume from the offset the server has."""
+        with UploadServer() as server:
+            # The server stores chunks whose replies are lost, the
+            # client resumes from the offset it reports.
+            server.failures = [None, 'lose-reply', None, 'lose-reply']
+            result = self.upload(server)
+        self.assertUploaded(server, result)
+        self.assertEqual(
+            3, sum(1 for method, _ in server.requests if method == 'HEAD'))
+
+    def test_resumes_previous_upload(self):
+        """An interrupted upload resumes where it stopped."""
+        with UploadServer() as server:
+            server.uploads['/image'] = bytearray(self.data[:3000])
+            result = self.upload(server)
+        self.assertUploaded(server, result)
+        puts = [value for method, value in server.requests if method == 'PUT']
+        self.assertEqual('bytes 3000-4023/*', puts[0])
+
+    def test_gives_up_after_retries(self):
+        """Uploads fail once the retries are exhausted."""
+        with UploadServer() as server:
+            server.failures = ['reject'] * 3
+            with self.assertRaises(upload.UploadError):
+                self.upload(server, retries=2)
+
+    def test_last_chunk_on_boundary(self):
+        """A file ending on a chunk boundary ends with an empty request."""
+        self.data = self.data[:4096]
+        with open(self.path, 'wb') as stream:
+            stream.write(self.data)
+        with UploadServer() as server:
+            result = self.upload(server)
+        self.assertUploaded(server, result)
+        puts = [value for method, value in server.requests if method == 'PUT']
+        self.assertEqual('bytes */4096', puts[-1])
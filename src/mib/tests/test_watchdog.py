@@ -0,0 +1,179 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Tests of the watchdog of the install VMs."""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from mib import utils
+from mib.console import ConsoleFollower
+from mib.watchdog import Watchdog
+
+
+class FakeDomain:  # pylint: disable=too-few-public-methods
+    """Domain that records whether it was destroyed."""
+
+    def __init__(self):
+        self.name = 'install'
+        self.finished = False
+        self.destroyed = False
+
+    async def destroy(self):
+        """Destroys the domain."""
+        self.destroyed = True
+        self.finished = True
+
+
+class WatchdogTestCase(unittest.TestCase):
+    """Watches a domain writing a console log and a disk."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.disk_path = os.path.join(self.workdir, 'disk.img')
+        self.console_path = os.path.join(self.workdir, 'console.log')
+        self.domain = FakeDomain()
+        self.follower = ConsoleFollower(self.console_path)
+        self.addCleanup(self.follower.close)
+
+    def write(self, path, data):
+        """Appends `data` to the file at `path`."""
+        with open(path, 'ab') as stream:
+            stream.write(data)
+
+    def get_watchdog(self, **kwargs):
+        """Returns a watchdog of the domain started at time 0."""
+        watchdog = Watchdog(
+            self.domain, self.follower, [self.disk_path], **kwargs)
+        watchdog.started = watchdog.last_activity = 0
+        self.follower.last_activity = 0
+        return watchdog
+
+
+class TestCheck(WatchdogTestCase):
+    """Detection of stalled installations."""
+
+    def test_no_timeouts(self):
+        """Without timeouts the installation never stalls."""
+        self.assertIsNone(self.get_watchdog().check(now=10 ** 6))
+
+    def test_stall_timeout(self):
+        """The installation stalls without progress for the timeout."""
+        watchdog = self.get_watchdog(stall_timeout=60)
+        self.assertIsNone(watchdog.check(now=60))
+        self.assertEqual(
+            'no console output or disk writes for 60s',
+            watchdog.check(now=61))
+
+    def test_disk_writes(self):
+        """Disk writes are progress."""
+        watchdog = self.get_watchdog(stall_timeout=60)
+        self.write(self.disk_path, b'\0' * 4096)
+        self.assertIsNone(watchdog.check(now=50))
+        self.assertIsNone(watchdog.check(now=100))
+        self.assertIsNotNone(watchdog.check(now=111))
+
+    def test_console_output(self):
+        """Console output is progress."""
+        watchdog = self.get_watchdog(stall_timeout=60)
+        self.follower.last_activity = 50
+        self.assertIsNone(watchdog.check(now=100))
+        self.assertIsNotNone(watchdog.check(now=111))
+
+    def test_install_timeout(self):
+        """The installation may not run longer than its timeout."""
+        watchdog = self.get_watchdog(stall_timeout=60, install_timeout=100)
+        self.follower.last_activity = 100
+        self.assertIsNone(watchdog.check(now=100))
+        self.assertEqual(
+            'installation exceeded 100s', watchdog.check(now=101))
+
+    def test_phase_timeout(self):
+        """A stage may not run longer than its timeout."""
+        watchdog = self.get_watchdog(phase_timeouts={'install': 30})
+        self.follower.parser.feed('Installing bash (1/2)', 10)
+        self.assertIsNone(watchdog.check(now=40))
+        self.assertEqual(
+            'install stage exceeded 30s', watchdog.check(now=41))
+        self.follower.parser.feed('Running post-installation scripts', 41)
+        self.assertIsNone(watchdog.check(now=100))
+
+
+class TestWatch(WatchdogTestCase):
+    """Destroying stalled domains."""
+
+    def test_destroys_stalled(self):
+        """A stalled domain is destroyed, recording the reason."""
+        watchdog = Watchdog(
+            self.domain, self.follower, [self.disk_path],
+            stall_timeout=0.05, interval=0.01)
+        with self.assertLogs('mib.watchdog', 'ERROR'):
+            utils.run_async(asyncio.wait_for(watchdog.watch(), 5))
+        self.assertTrue(self.domain.destroyed)
+        self.assertEqual(
+            'no console output or disk writes for 0s', watchdog.reason)
+
+    def test_progress(self):
+        """A domain making progress is left running until it finishes."""
+        watchdog = Watchdog(
+            self.domain, self.follower, [self.disk_path],
+            stall_timeout=0.3, interval=0.01)
+
+        async def install():
+            for _ in range(8):
+                self.write(self.console_path, b'output\n')
+                await asyncio.sleep(0.1)
+            self.domain.finished = True
+
+        async def run():
+            await asyncio.gather(install(), watchdog.watch())
+
+        started = time.time()
+        utils.run_async(asyncio.wait_for(run(), 5))
+        self.assertGreaterEqual(time.time() - started, 0.8)
+        self.assertFalse(self.domain.destroyed)
+        self.assertIsNone(watchdog.reason)
@@ -0,0 +1,317 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Streaming uploads of the built images.
+
+An output is uploaded while it is being written: the uploader follows
+the file in the work directory and sends each chunk once the writer
+has produced it, computing the size and sha256 as it goes, so the image
+is never read back a second time. Only gzip formats are written front
+to back; the others are uploaded once complete, from the page cache.
+
+The endpoint is modelled on the MAAS boot resources upload, chunks of
+application/octet-stream sent with PUT and MAAS API key authentication,
+extended for resuming and for images of unknown length:
+
+- `HEAD url` replies with the bytes already received in an
+  Upload-Offset header, or 404 when there are none.
+- `PUT url` with `Content-Range: bytes START-END/*` appends a chunk at
+  START, the server rejects any other START with 409.
+- The last chunk carries the total length in its Content-Range, and
+  the sha256 of the whole image in X-Upload-SHA256, for the server to
+  verify it. An image whose length is a multiple of the chunk size
+  ends with an empty `Content-Range: bytes */TOTAL` request.
+
+Failed requests are retried from the offset the server reports.
+"""
+
+import hashlib
+import http.client
+import logging
+import os
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+MEBIBYTE = 1024 * 1024
+CHUNK_SIZE = 4 * MEBIBYTE
+
+# Seconds between checks of a file being written.
+POLL_INTERVAL = 0.2
+
+RETRIES = 5
+
+
+class UploadError(Exception):
+    """Error class for failed uploads."""
+
+
+def get_oauth_header(api_key):
+    """Returns the Authorization header of a MAAS API key, made of the
+    consumer key, token key and token secret."""
+    try:
+        consumer_key, token_key, token_secret = api_key.split(':')
+    except ValueError:
+        raise UploadError(
+            "Invalid API key, expected consumer:token:secret.")
+    params = [
+        ('oauth_version', '1.0'),
+        ('oauth_signature_method', 'PLAINTEXT'),
+        ('oauth_consumer_key', consumer_key),
+        ('oauth_token', token_key),
+        ('oauth_signature', '&' + token_secret),
+        ('oauth_nonce', uuid.uuid4().hex),
+        ('oauth_timestamp', str(int(time.time()))),
+        ]
+    return 'OAuth ' + ', '.join('%s="%s"' % param for param in params)
+
+
+class RateLimiter:  # pylint: disable=too-few-public-methods
+    """Bounds the throughput of an upload to `rate` bytes per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.sent = 0
+
+    def wait(self, size):
+        """Sleeps until `size` more bytes can be sent."""
+        self.sent += size
+        delay = self.start + self.sent / self.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FileFollower:
+    """Reads a file while it is being written.
+
+    The writer calls `finish` once the file is complete, or `abort`
+    when it failed. Unless `growing`, the file is not written front to
+    back and is only read once complete.
+    """
+
+    def __init__(self, path, growing=True):
+        self.path = path
+        self.growing = growing
+        self.finished = threading.Event()
+        self.aborted = False
+        self.descriptor = None
+
+    def finish(self):
+        """Marks the file as complete."""
+        self.finished.set()
+
+    def abort(self):
+        """Marks the file as never completing."""
+        self.aborted = True
+        self.finished.set()
+
+    def close(self):
+        """Closes the file."""
+        if self.descriptor is not None:
+            os.close(self.descriptor)
+            self.descriptor = None
+
+    def read(self, offset, size):
+        """Returns the `size` bytes at `offset`, waiting for the writer
+        to produce them. Fewer are returned at the end of the file."""
+        while True:
+            finished = self.finished.is_set()
+            if self.aborted:
+                raise UploadError(
+                    "%s was not written completely." % self.path)
+            if self.descriptor is None and (self.growing or finished):
+                try:
+                    self.descriptor = os.open(self.path, os.O_RDONLY)
+                except FileNotFoundError:
+                    if finished:
+                        raise UploadError("%s was not written." % self.path)
+            if self.descriptor is not None:
+                available = os.fstat(self.descriptor).st_size - offset
+                if finished or (self.growing and available >= size):
+                    return os.pread(self.descriptor, size, offset)
+            self.finished.wait(POLL_INTERVAL)
+
+
+def checksum(source, chunk_size=CHUNK_SIZE):
+    """Returns the size and sha256 of the file read from `source`, a
+    `FileFollower`, hashed while it is being written."""
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        while True:
+            data = source.read(size, chunk_size)
+            digest.update(data)
+            size += len(data)
+            if len(data) < chunk_size:
+                return size, digest.hexdigest()
+    finally:
+        source.close()
+
+
+class Uploader:
+    """Uploads an image to `url`, in chunks of `chunk_size` bytes."""
+
+    def __init__(self, url, api_key=None, rate=None, chunk_size=CHUNK_SIZE,
+                 retries=RETRIES, timeout=60):
+        self.url = urlsplit(url)
+        if self.url.scheme not in ('http', 'https'):
+            raise UploadError("Unsupported upload URL: %s" % url)
+        self.api_key = api_key
+        self.limiter = RateLimiter(rate) if rate else None
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, headers=None, body=None):
+        """Sends a request to the upload URL, and returns the response
+        once read."""
+        if self.connection is None:
+            connection_class = (
+                http.client.HTTPSConnection if self.url.scheme == 'https'
+                else http.client.HTTPConnection)
+            self.connection = connection_class(
+                self.url.netloc, timeout=self.timeout)
+        headers = dict(headers or {})
+        if self.api_key is not None:
+            headers['Authorization'] = get_oauth_header(self.api_key)
+        path = self.url.path or '/'
+        if self.url.query:
+            path += '?' + self.url.query
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+        return response
+
+    def get_offset(self):
+        """Returns the number of bytes the server already received."""
+        response = self.request('HEAD')
+        if response.status == 404:
+            return 0
+        if response.status >= 300:
+            raise UploadError(
+                "Upload status request failed: %d %s" % (
+                    response.status, response.reason))
+        return int(response.getheader('Upload-Offset', 0))
+
+    def put(self, data, offset, total=None, sha256=None):
+        """Sends the chunk `data` at `offset`, the last one when the
+        `total` length is given."""
+        if data:
+            content_range = 'bytes %d-%d/%s' % (
+                offset, offset + len(data) - 1,
+                '*' if total is None else total)
+        else:
+            content_range = 'bytes */%d' % total
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Range': content_range,
+            }
+        if sha256 is not None:
+            headers['X-Upload-SHA256'] = sha256
+        if self.limiter is not None:
+            self.limiter.wait(len(data))
+        response = self.request('PUT', headers=headers, body=data)
+        if response.status >= 500 or response.status == 409:
+            # Retried, from the offset the server has.
+            raise ConnectionError(
+                "Upload failed: %d %s" % (response.status, response.reason))
+        if response.status >= 300:
+            raise UploadError(
+                "Upload rejected: %d %s" % (response.status, response.reason))
+
+    def upload(self, source):
+        """Uploads the file read from `source`, a `FileFollower`, and
+        returns its size and sha256."""
+        digest = hashlib.sha256()
+        hashed = 0
+        attempts = 0
+        offset = None
+        try:
+            while True:
+                try:
+                    if offset is None:
+                        offset = self.get_offset()
+                    # The digest covers every byte, even those the server
+                    # received before a resume.
+                    while hashed < offset:
+                        data = source.read(
+                            hashed, min(self.chunk_size, offset - hashed))
+                        digest.update(data)
+                        hashed += len(data)
+                    data = source.read(offset, self.chunk_size)
+                    if offset + len(data) > hashed:
+                        digest.update(data[hashed - offset:])
+                        hashed = offset + len(data)
+                    if len(data) < self.chunk_size:
+                        size = offset + len(data)
+                        self.put(
+                            data, offset, total=size,
+                            sha256=digest.hexdigest())
+                        return size, digest.hexdigest()
+                    self.put(data, offset)
+                    offset += len(data)
+                    attempts = 0
+                except (OSError, http.client.HTTPException) as error:
+                    attempts += 1
+                    if attempts > self.retries:
+                        raise UploadError(
+                            "Upload to %s failed: %s" % (
+                                self.url.geturl(), error))
+                    logger.warning(
+                        'Upload to %s failed, retrying: %s',
+                        self.url.geturl(), error)
+                    time.sleep(2 ** attempts)
+                    offset = None
+        finally:
+            source.close()
+            if self.connection is not None:
+                self.connection.close()
@@ -42,11 +42,14 @@
 
 """Utilities."""
 
+import asyncio
+import functools
 import os
 import subprocess
 import sys
 import tempfile
 import time
+import uuid
 from contextlib import contextmanager
 from shutil import rmtree
 
@@ -65,6 +68,16 @@ def get_contrib_path(name, path):
     return os.path.join(get_contrib_dir(), name, path)
 
 
+def new_build_id():
+    """Returns a new unique identifier for a build.
+
+    Every resource a build creates (domain, sockets, workdir, tap) is
+    named after it. It is kept short, as tap names are limited to 15
+    characters.
+    """
+    return uuid.uuid4().hex[:8]
+
+
 def get_sudo_user():
     """Gets the name of the user, that launched sudo."""
     if 'SUDO_USER' not in os.environ:
@@ -115,6 +128,109 @@ def subp(args, data=None, rcs=None, env=None, capture=False, shell=False):
     return (out, err)
 
 
+async def subp_async(  # pylint: disable=too-many-branches
+        args, data=None, rcs=None, env=None, capture=False, shell=False,
+        timeout=None):
+    """Executes a subprocess without blocking the event loop.
+
+    Takes the same arguments as `subp`. When `timeout` expires or the
+    calling task is cancelled the process is killed, then the
+    `asyncio.TimeoutError` or `asyncio.CancelledError` is re-raised.
+
+    :param timeout: seconds to wait for the process to exit
+    :returns: (out, err) when capture=True
+    :raises ProcessExecutionError: error executing process
+    """
+    if rcs is None:
+        rcs = [0]
+    if not capture:
+        stdout = None
+        stderr = None
+    else:
+        stdout = subprocess.PIPE
+        stderr = subprocess.PIPE
+    stdin = subprocess.PIPE
+    try:
+        if shell:
+            process = await asyncio.create_subprocess_shell(
+                args, stdout=stdout, stderr=stderr, stdin=stdin, env=env)
+        else:
+            process = await asyncio.create_subprocess_exec(
+                *args, stdout=stdout, stderr=stderr, stdin=stdin, env=env)
+    except OSError as exc:
+        raise ProcessExecutionError(cmd=args, reason=exc)
+    try:
+        (out, err) = await asyncio.wait_for(
+            process.communicate(data), timeout)
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    if isinstance(out, bytes):
+        out = out.decode()
+    if isinstance(err, bytes):
+        err = err.decode()
+    if process.returncode not in rcs:
+        raise ProcessExecutionError(
+            stdout=out, stderr=err, exit_code=process.returncode, cmd=args)
+    if not out and capture:
+        out = ''
+    if not err and capture:
+        err = ''
+    return (out, err)
+
+
+def to_thread(func, *args, **kwargs):
+    """Runs the blocking `func` in the default executor.
+
+    Used from coroutines for steps that block on the filesystem rather
+    than on a subprocess.
+    """
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(
+        None, functools.partial(func, *args, **kwargs))
+
+
+async def gather(*coros):
+    """Runs `coros` concurrently, returning their results in order.
+
+    Unlike `asyncio.gather` the remaining coroutines are cancelled, and
+    waited for, as soon as one of them fails or the caller is cancelled.
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+
+def run_async(coro):
+    """Runs `coro` to completion in a new event loop.
+
+    A KeyboardInterrupt cancels the coroutine, so its cleanup runs
+    before the interrupt is re-raised.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(coro)
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        raise
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
 class ProcessExecutionError(IOError):
     """Exception for subprocess."""
 
@@ -235,11 +351,115 @@ def umount_loop(src, target):
     kpartx_del(src)
 
 
-def fs_sync():
-    """Synchronize cached writes to persistent storage."""
-    subp(['sync'])
+def sync_file(path):
+    """Flushes the cached writes to the file or block device at `path` to
+    persistent storage, leaving the rest of the host alone."""
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fdatasync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def sync_directory(path):
+    """Flushes the entries of the directory at `path`, such as files
+    renamed into it, to persistent storage."""
+    descriptor = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def sync_filesystem(path):
+    """Flushes the cached writes to the filesystem containing `path` to
+    persistent storage."""
+    subp(['sync', '-f', path])
+
+
+# Extended attributes, such as the SELinux labels, are kept in the root
+# tarballs.
+TAR_XATTR_ARGS = ['--xattrs', '--xattrs-include=*']
+
+
+async def extract_tarball(tarball, path, prefix=None):
+    """Extracts the tarball created by `create_tarball` into path.
+
+    :param prefix: arguments to run tar under, such as a numactl call
+    """
+    await subp_async(list(prefix or []) + [
+        'tar', 'xpzf', tarball, '--numeric-owner'] + TAR_XATTR_ARGS + [
+            '-C', path])
 
 
-def create_tarball(output, path):
-    """Creates a tarball from path and places into output."""
-    subp(['tar', 'zcpf', output, '-C', path, '.'])
+def get_gzip_args(rsyncable=False, deterministic=False):
+    """Returns the gzip command line.
+
+    :param rsyncable: periodically reset the compression, for unchanged
+        input to compress to the same bytes wherever it is in the file
+    :param deterministic: leave the name and time stamp out of the
+        header
+    """
+    args = ['gzip']
+    if rsyncable:
+        args.append('--rsyncable')
+    if deterministic:
+        args.append('-n')
+    return args
+
+
+def get_tar_compress_args(rsyncable=False, deterministic=False):
+    """Returns the tar arguments compressing with gzip."""
+    if rsyncable or deterministic:
+        return ['-I', ' '.join(get_gzip_args(rsyncable, deterministic))]
+    return ['-z']
+
+
+def get_tar_deterministic_args(epoch):
+    """Returns the tar arguments archiving in name order, with owners
+    by number and modification times clamped to `epoch`.
+
+    The pax headers `TAR_XATTR_ARGS` brings in would otherwise hold the
+    access and change times, and the tar process id in their names.
+    """
+    return [
+        '--sort=name', '--numeric-owner',
+        '--mtime=@%d' % epoch, '--clamp-mtime',
+        '--pax-option=exthdr.name=%d/PaxHeaders/%f,'
+        'delete=atime,delete=ctime',
+        ]
+
+
+def clamp_mtimes(path, epoch):
+    """Clamps the modification time of the files in the directory at
+    `path` to `epoch`."""
+    paths = [path]
+    for root, dirs, files in os.walk(path):
+        paths.extend(os.path.join(root, name) for name in dirs + files)
+    for name in paths:
+        if os.lstat(name).st_mtime > epoch:
+            os.utime(name, (epoch, epoch), follow_symlinks=False)
+
+
+def get_source_date_env(epoch):
+    """Returns the environment for tools to date their output `epoch`,
+    or None to keep the current environment."""
+    if epoch is None:
+        return None
+    return dict(os.environ, SOURCE_DATE_EPOCH=str(epoch))
+
+
+async def create_tarball(output, path, rsyncable=False, epoch=None,
+                         prefix=None):
+    """Creates a tarball from path and places into output.
+
+    :param rsyncable: compress with `gzip --rsyncable`
+    :param epoch: make the tarball deterministic, with modification
+        times clamped to this time
+    :param prefix: arguments to run tar under, such as a numactl call
+    """
+    args = ['tar', 'cpf', output] + TAR_XATTR_ARGS + get_tar_compress_args(
+        rsyncable, deterministic=epoch is not None)
+    if epoch is not None:
+        args.extend(get_tar_deterministic_args(epoch))
+    await subp_async(list(prefix or []) + args + ['-C', path, '.'])
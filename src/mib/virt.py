@@ -42,8 +42,6 @@
 
 """Utilities for virt."""
 
-import subprocess
-
 from mib import utils
 
 # QEMU Architecture Mapping
@@ -52,7 +50,7 @@ ARCH_MAP = {
     }
 
 
-def create_disk(path, size, disk_format='qcow2'):
+async def create_disk(path, size, disk_format='qcow2'):
     """Creates disk using qemu-img."""
     args = [
         'qemu-img', 'create',
@@ -60,14 +58,16 @@ def create_disk(path, size, disk_format='qcow2'):
         path,
         '%sG' % size,
         ]
-    utils.subp(args)
+    await utils.subp_async(args)
 
 
-def install_location(name, ram, arch, vcpus, os_type, os_variant,
-                     disk, network, location, initrd_inject=None,
-                     extra_args=None, reboot=False, graphics=False,
-                     force=True):
-    """Spawns virt-install."""
+# pylint: disable=too-many-arguments,too-many-locals
+async def install_location(
+        driver, name, ram, arch, vcpus, os_type, os_variant, disk, network,
+        location, initrd_inject=None, extra_args=None, reboot=False,
+        graphics=False, force=True, serial=None, cpuset=None,
+        numa_node=None, hardware_args=None):
+    """Spawns virt-install, returning the domain followed by `driver`."""
     if arch in ARCH_MAP:
         arch = ARCH_MAP[arch]
     args = [
@@ -75,7 +75,7 @@ def install_location(name, ram, arch, vcpus, os_type, os_variant,
         '--name', name,
         '--ram', '%s' % ram,
         '--arch', arch,
-        '--vcpus', vcpus,
+        '--vcpus', vcpus_arg(vcpus, cpuset),
         '--os-type', os_type,
         '--os-variant', os_variant,
         '--disk', disk,
@@ -92,14 +92,20 @@ def install_location(name, ram, arch, vcpus, os_type, os_variant,
         args.append('--nographics')
     if force:
         args.append('--force')
-    subprocess.check_call(args)
+    if serial is not None:
+        args.extend(['--serial', 'file,path=%s' % serial])
+    args.extend(numatune_args(numa_node))
+    if hardware_args is not None:
+        args.extend(hardware_args)
+    return await start_domain(driver, name, args)
 
 
-def install_cdrom(
-        name, ram, arch, vcpus, os_type, os_variant,
+async def install_cdrom(
+        driver, name, ram, arch, vcpus, os_type, os_variant,
         disk, network, cdrom, reboot=False, graphics=False,
-        force=True):
-    """Spawns virt-install."""
+        force=True, serial=None, cpuset=None, numa_node=None,
+        hardware_args=None):
+    """Spawns virt-install, returning the domain followed by `driver`."""
     if arch in ARCH_MAP:
         arch = ARCH_MAP[arch]
     args = [
@@ -107,7 +113,7 @@ def install_cdrom(
         '--name', name,
         '--ram', '%s' % ram,
         '--arch', arch,
-        '--vcpus', vcpus,
+        '--vcpus', vcpus_arg(vcpus, cpuset),
         '--os-type', os_type,
         '--os-variant', os_variant,
         '--disk', disk,
@@ -120,11 +126,49 @@ def install_cdrom(
         args.append('--nographics')
     if force:
         args.append('--force')
-    subprocess.check_call(args)
+    if serial is not None:
+        args.extend(['--serial', 'file,path=%s' % serial])
+    args.extend(numatune_args(numa_node))
+    if hardware_args is not None:
+        args.extend(hardware_args)
+    return await start_domain(driver, name, args)
+# pylint: enable=too-many-arguments,too-many-locals
+
+
+def vcpus_arg(vcpus, cpuset=None):
+    """Returns the --vcpus value, pinning the vcpus to `cpuset`."""
+    if cpuset is None:
+        return vcpus
+    return '%s,cpuset=%s' % (vcpus, cpuset)
+
+
+def numatune_args(numa_node=None):
+    """Returns the arguments binding the memory to `numa_node`."""
+    if numa_node is None:
+        return []
+    return ['--numatune', '%d,mode=strict' % numa_node]
+
+
+async def start_domain(driver, name, args):
+    """Starts the domain with virt-install without waiting for it.
+
+    The domain is followed by `driver` before virt-install runs, so the
+    caller can wait on its lifecycle events.
+    """
+    args = args + ['--noautoconsole']
+    domain = driver.watch_libvirt(name)
+    started = False
+    try:
+        await utils.subp_async(args)
+        started = True
+    finally:
+        if not started:
+            await driver.release(domain)
+    return domain
 
 
-def undefine(name):
+async def undefine(name, rcs=None):
     """Undefines the virtual machine from virsh without deleting
     the storage volume.
     """
-    utils.subp(['virsh', 'undefine', name])
+    await utils.subp_async(['virsh', 'undefine', name], rcs=rcs)
@@ -0,0 +1,133 @@
+# vi: ts=4 expandtab
+# Upstream Author:
+#
+#     Canonical Ltd.
+#
+# Copyright:
+#
+#     (c) 2014-2017 Canonical Ltd.
+#
+# Licence:
+#
+# If you have an executed agreement with a Canonical group company which
+# includes a licence to this software, your use of this software is governed
+# by that agreement.  Otherwise, the following applies:
+#
+# Canonical Ltd. hereby grants to you a world-wide, non-exclusive,
+# non-transferable, revocable, perpetual (unless revoked) licence, to (i) use
+# this software in connection with Canonical's MAAS software to install Windows
+# in non-production environments and (ii) to make a reasonable number of copies
+# of this software for backup and installation purposes.  You may not: use,
+# copy, modify, disassemble, decompile, reverse engineer, or distribute the
+# software except as expressly permitted in this licence; permit access to the
+# software to any third party other than those acting on your behalf; or use
+# this software in connection with a production environment.
+#
+# CANONICAL LTD. MAKES THIS SOFTWARE AVAILABLE "AS-IS".  CANONICAL  LTD. MAKES
+# NO REPRESENTATIONS OR WARRANTIES OF ANY KIND, WHETHER ORAL OR WRITTEN,
+# WHETHER EXPRESS, IMPLIED, OR ARISING BY STATUTE, CUSTOM, COURSE OF DEALING
+# OR TRADE USAGE, WITH RESPECT TO THIS SOFTWARE.  CANONICAL LTD. SPECIFICALLY
+# DISCLAIMS ANY AND ALL IMPLIED WARRANTIES OR CONDITIONS OF TITLE, SATISFACTORY
+# QUALITY, MERCHANTABILITY, SATISFACTORINESS, FITNESS FOR A PARTICULAR PURPOSE
+# AND NON-INFRINGEMENT.
+#
+# IN NO EVENT UNLESS REQUIRED BY APPLICABLE LAW OR AGREED TO IN WRITING WILL
+# CANONICAL LTD. OR ANY OF ITS AFFILIATES, BE LIABLE TO YOU FOR DAMAGES,
+# INCLUDING ANY GENERAL, SPECIAL, INCIDENTAL OR CONSEQUENTIAL DAMAGES ARISING
+# OUT OF THE USE OR INABILITY TO USE THIS SOFTWARE (INCLUDING BUT NOT LIMITED
+# TO LOSS OF DATA OR DATA BEING RENDERED INACCURATE OR LOSSES SUSTAINED BY YOU
+# OR THIRD PARTIES OR A FAILURE OF THE PROGRAM TO OPERATE WITH ANY OTHER
+# PROGRAMS), EVEN IF SUCH HOLDER OR OTHER PARTY HAS BEEN ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGES.
+
+"""Watchdog that destroys install VMs which have stalled."""
+
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Watchdog:  # pylint: disable=too-many-instance-attributes
+    """Destroys the domain when the installation stops making progress.
+
+    Progress is output on the serial console followed by `follower`, or
+    writes to any of `disk_paths`. The domain is destroyed when there
+    was no progress for `stall_timeout` seconds, when the installation
+    ran longer than `install_timeout` seconds or when a stage reported
+    by the console parser ran longer than its entry in
+    `phase_timeouts`.
+    """
+
+    def __init__(self, domain, follower=None, disk_paths=(),
+                 stall_timeout=None, install_timeout=None,
+                 phase_timeouts=None, interval=5):
+        self.domain = domain
+        self.follower = follower
+        self.disk_paths = list(disk_paths)
+        self.stall_timeout = stall_timeout
+        self.install_timeout = install_timeout
+        self.phase_timeouts = dict(phase_timeouts or {})
+        self.interval = interval
+        self.started = time.time()
+        self.last_activity = self.started
+        self.disk_state = self.get_disk_state()
+        self.reason = None
+
+    def get_disk_state(self):
+        """Returns the size, allocation and modification time of the
+        disks, which changes whenever the VM writes to them."""
+        state = []
+        for path in self.disk_paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                state.append(None)
+            else:
+                state.append((stat.st_size, stat.st_blocks, stat.st_mtime))
+        return state
+
+    def check(self, now=None):
+        """Returns the reason the installation is stalled, or None."""
+        if now is None:
+            now = time.time()
+        disk_state = self.get_disk_state()
+        if disk_state != self.disk_state:
+            self.disk_state = disk_state
+            self.last_activity = now
+        if self.follower is not None:
+            self.last_activity = max(
+                self.last_activity, self.follower.last_activity)
+        if (self.install_timeout is not None and
+                now - self.started > self.install_timeout):
+            return 'installation exceeded %ds' % self.install_timeout
+        if (self.stall_timeout is not None and
+                now - self.last_activity > self.stall_timeout):
+            return 'no console output or disk writes for %ds' % (
+                self.stall_timeout)
+        if self.follower is not None:
+            parser = self.follower.parser
+            timeout = self.phase_timeouts.get(parser.stage)
+            if (timeout is not None and
+                    now - parser.stage_started > timeout):
+                return '%s stage exceeded %ds' % (parser.stage, timeout)
+        return None
+
+    async def watch(self):
+        """Checks the domain every `interval` seconds, destroying it once
+        it has stalled."""
+        while not self.domain.finished:
+            await asyncio.sleep(self.interval)
+            if self.follower is not None:
+                self.follower.read()
+            reason = self.check()
+            if reason is not None and not self.domain.finished:
+                self.reason = reason
+                logger.error(
+                    'Destroying stalled VM %s: %s', self.domain.name, reason)
+                if self.follower is not None:
+                    for line in self.follower.tail()[-20:]:
+                        logger.error('console: %s', line)
+                await self.domain.destroy()